@@ -0,0 +1,298 @@
+import sys
+import json
+import math
+import time
+import random
+import tempfile
+import platform
+import tracemalloc
+
+import numpy
+import pyglet
+# Sem janela de sombra o modulo main pode ser importado numa maquina sem display.
+pyglet.options['shadow_window'] = False
+from pyglet.gl import *
+
+import main
+import render
+import light
+import mesher
+import occlusion
+import physics
+import structures
+import terrain
+from blocks import BRICK, STONE, GRASS
+
+SEED = 0
+BENCHMARKS = []
+# Os benchmarks de desenho precisam de contexto GL e so rodam quando pedidos
+# pelo nome (sem display: PYGLET_HEADLESS=1 python bench.py draw_quads draw_instanced).
+GL_BENCHMARKS = set()
+
+def benchmark(n, gl=False):
+    def register(func):
+        name = func.__name__[len('bench_'):]
+        BENCHMARKS.append((name, n, func))
+        if gl: GL_BENCHMARKS.add(name)
+        return func
+    return register
+
+def new_model(**kwargs):
+    return main.Model(seed=SEED, backend=render.NullBackend(), **kwargs)
+
+def sight_vectors(rng, n):
+    vectors = []
+    for _ in range(n):
+        a, b = rng.uniform(0, 2 * math.pi), rng.uniform(-1.4, 1.4)
+        vectors.append((math.cos(b) * math.cos(a), math.sin(b), math.cos(b) * math.sin(a)))
+    return vectors
+
+# Cada benchmark recebe n e devolve uma funcao sem argumentos que executa o trecho medido.
+
+@benchmark(1)
+def bench_initialize(n):
+    return lambda: [new_model().close() for _ in range(n)]
+
+@benchmark(20)
+def bench_change_sectors(n):
+    model = new_model()
+    model.change_sectors(None, (0, 0, 0))
+    model.process_entire_queue()
+    def run():
+        sector = (0, 0, 0)
+        for i in range(n):
+            after = (i % 10 - 5, 0, (i // 10) % 10 - 5)
+            model.change_sectors(sector, after)
+            model.process_entire_queue()
+            sector = after
+    return run
+
+@benchmark(200)
+def bench_lod_mesh(n):
+    # Malhas simplificadas dos tres passos do anel LOD sobre o terreno infinito.
+    origins = [(x, 0, z) for x in range(-10, 10) for z in range(-10, 10)][:n]
+    jobs = []
+    for i, sector in enumerate(origins):
+        step = main.LOD_STEPS[i % len(main.LOD_STEPS)][1]
+        heights, tops = terrain.surface(SEED, sector)
+        jobs.append((numpy.pad(heights, step, mode='edge'), tops, (sector[0] * main.SECTOR_SIZE, main.WORLD_BOTTOM, sector[2] * main.SECTOR_SIZE), step))
+    return lambda: [mesher.lod_mesh(*job) for job in jobs]
+
+@benchmark(50)
+def bench_connectivity(n):
+    # Regioes de ar de setores do terreno infinito, como no worker de malha.
+    sectors = [terrain.generate_sector(SEED, (i % 7, 0, i // 7)) for i in range(n)]
+    return lambda: [occlusion.connectivity(blocks) for blocks in sectors]
+
+@benchmark(500)
+def bench_add_remove_block(n):
+    model = new_model()
+    model.change_sectors(None, (0, 0, 0))
+    model.process_entire_queue()
+    rng = random.Random(SEED)
+    positions = [(rng.randint(-60, 60), rng.randint(0, 8), rng.randint(-60, 60)) for _ in range(n)]
+    def run():
+        for position in positions:
+            model.add_block(position, BRICK)
+        for position in positions:
+            if position in model.world: model.remove_block(position)
+        model.process_entire_queue()
+    return run
+
+@benchmark(500)
+def bench_add_remove_journal(n):
+    # add_remove_block num mundo salvo: cada edicao vai para o diario e o
+    # autosave copia os setores alterados para a thread gravar.
+    model = new_model(path=tempfile.mkdtemp(prefix='bench_journal_'))
+    model.change_sectors(None, (0, 0, 0))
+    model.process_entire_queue()
+    rng = random.Random(SEED)
+    positions = [(rng.randint(-60, 60), rng.randint(0, 8), rng.randint(-60, 60)) for _ in range(n)]
+    def run():
+        for position in positions:
+            model.add_block(position, BRICK)
+        for position in positions:
+            if position in model.world: model.remove_block(position)
+        model.process_entire_queue()
+        model.autosave(force=True)
+    return run
+
+@benchmark(500)
+def bench_add_remove_transaction(n):
+    model = new_model()
+    model.change_sectors(None, (0, 0, 0))
+    model.process_entire_queue()
+    rng = random.Random(SEED)
+    positions = [(rng.randint(-60, 60), rng.randint(0, 8), rng.randint(-60, 60)) for _ in range(n)]
+    def run():
+        with model.transaction():
+            for position in positions:
+                model.add_block(position, BRICK)
+        with model.transaction():
+            for position in positions:
+                if position in model.world: model.remove_block(position)
+        model.process_entire_queue()
+    return run
+
+@benchmark(1000)
+def bench_spatial_queries(n):
+    # Caixas, colunas e bloco mais perto em lote sobre os setores em volta do spawn.
+    model = new_model()
+    model.change_sectors(None, (0, 0, 0))
+    model.process_entire_queue()
+    rng = random.Random(SEED)
+    los = numpy.array([(rng.randint(-60, 60), rng.randint(-8, 16), rng.randint(-60, 60)) for _ in range(n)])
+    his = los + [(rng.randint(0, 12), rng.randint(0, 12), rng.randint(0, 12)) for _ in range(n)]
+    positions = los + 0.5
+    def run():
+        model.spatial.count_many(los, his, STONE)
+        model.spatial.empty_many(los, his)
+        model.spatial.tops(los[:, [0, 2]])
+        model.spatial.nearest_many(positions[:n // 10], GRASS, 16)
+    return run
+
+@benchmark(50)
+def bench_pathfind(n):
+    # Caminhos longos entre celulas de pe ao acaso, com os portais montados do zero.
+    model = new_model()
+    rng = random.Random(SEED)
+    top = lambda x, z: (x, model.spatial.top(x, z)[0] + 1, z)
+    pairs = [(top(rng.randint(-60, 60), rng.randint(-60, 60)), top(rng.randint(-60, 60), rng.randint(-60, 60)))
+             for _ in range(n)]
+    def run():
+        model.paths.locals.clear()
+        model.paths.find_many(pairs)
+    return run
+
+@benchmark(500)
+def bench_light_add_remove(n):
+    # So a luz incremental (BFS) de blocos colocados e tirados, sem remalhar.
+    model = new_model()
+    rng = random.Random(SEED)
+    positions = [(rng.randint(-60, 60), rng.randint(0, 8), rng.randint(-60, 60)) for _ in range(n)]
+    positions = sorted(set(position for position in positions if position not in model.world))
+    def run():
+        for position in positions:
+            model.world[position] = BRICK
+            light.block_added(model.world, position)
+        for position in positions:
+            del model.world[position]
+            light.block_removed(model.world, position)
+    return run
+
+@benchmark(5000)
+def bench_hit_test(n):
+    model = new_model()
+    rng = random.Random(SEED)
+    positions = [(rng.uniform(-60, 60), rng.uniform(-1, 6), rng.uniform(-60, 60)) for _ in range(n)]
+    vectors = sight_vectors(rng, n)
+    return lambda: [model.hit_test(p, v) for p, v in zip(positions, vectors)]
+
+@benchmark(5000)
+def bench_hit_test_many(n):
+    model = new_model()
+    rng = random.Random(SEED)
+    positions = [(rng.uniform(-60, 60), rng.uniform(-1, 6), rng.uniform(-60, 60)) for _ in range(n)]
+    vectors = sight_vectors(rng, n)
+    return lambda: model.hit_test_many(positions, vectors)
+
+def new_entities(model, n):
+    rng = random.Random(SEED)
+    entities = physics.Entities(model.world)
+    for _ in range(n):
+        a = rng.uniform(0, 2 * math.pi)
+        body = entities.add((rng.uniform(-60, 60), rng.uniform(-1, 3), rng.uniform(-60, 60)), speed=main.WALKING_SPEED)
+        entities.motion[body] = (math.cos(a), 0, math.sin(a))
+    return entities
+
+@benchmark(5000)
+def bench_collide(n):
+    entities = new_entities(new_model(), n)
+    ids = numpy.nonzero(entities.alive)[0]
+    return lambda: entities.collide(ids, entities.position[ids].copy())
+
+@benchmark(2000)
+def bench_physics_tick(n):
+    # Um tick (SUBSTEPS passos) com n corpos andando.
+    entities = new_entities(new_model(), n)
+    return lambda: entities.update(1.0 / main.TICKS_PER_SEC)
+
+@benchmark(100)
+def bench_structure_build(n):
+    model = new_model()
+    builder = structures.StructureBuilder(model)
+    rng = random.Random(SEED)
+    blueprints = [structures.SIMPLE_HOUSE, structures.LIGHTHOUSE, structures.MAZE]
+    materials = {0: STONE, 1: BRICK, 2: GRASS}
+    jobs = [((rng.randint(-70, 70), 0, rng.randint(-70, 70)), rng.choice(blueprints)) for _ in range(n)]
+    return lambda: [builder.build(position, blueprint, materials) for position, blueprint in jobs]
+
+@benchmark(500)
+def bench_structure_build_many(n):
+    model = new_model()
+    builder = structures.StructureBuilder(model)
+    rng = random.Random(SEED)
+    blueprints = [structures.SIMPLE_HOUSE, structures.LIGHTHOUSE, structures.MAZE]
+    materials = {0: STONE, 1: BRICK, 2: GRASS}
+    jobs = [((rng.randint(-70, 70), 0, rng.randint(-70, 70)), rng.choice(blueprints), materials,
+             rng.randint(0, 3), rng.random() < 0.5) for _ in range(n)]
+    return lambda: builder.build_many(jobs)
+
+_window = None
+
+def draw_frames(renderer, n):
+    global _window
+    if _window is None:
+        _window = pyglet.window.Window(width=800, height=600, visible=False)
+        main.setup()
+    model = main.Model(seed=SEED, backend=render.BACKENDS[renderer](main.TEXTURE_PATH))
+    model.change_sectors(None, (0, 0, 0))
+    model.process_entire_queue()
+    def run():
+        for i in range(n):
+            glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+            glMatrixMode(GL_PROJECTION)
+            glLoadIdentity()
+            gluPerspective(main.FOV, 800 / 600.0, main.NEAR, main.FAR)
+            glMatrixMode(GL_MODELVIEW)
+            glLoadIdentity()
+            glRotatef(360.0 * i / n, 0, 1, 0)
+            glTranslatef(0, -8, 0)
+            model.draw()
+            glFinish()
+    return run
+
+@benchmark(30, gl=True)
+def bench_draw_quads(n):
+    return draw_frames('quads', n)
+
+@benchmark(30, gl=True)
+def bench_draw_instanced(n):
+    return draw_frames('instanced', n)
+
+def measure(name, n, setup):
+    run = setup(n)
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+    # Segunda passada so para memoria: o tracemalloc distorce o tempo.
+    run = setup(n)
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'name': name, 'n': n, 'seconds': seconds, 'per_op_us': seconds / n * 1e6, 'peak_kb': peak // 1024}
+
+def report(args):
+    results = [measure(name, n, setup) for name, n, setup in BENCHMARKS
+               if name in args or not (args or name in GL_BENCHMARKS)]
+    json.dump({
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'seed': SEED,
+        'benchmarks': results,
+    }, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    report(sys.argv[1:])
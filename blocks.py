@@ -0,0 +1,46 @@
+def tex_coord(x, y, n=4):
+    m = 1.0 / n
+    dx = x * m
+    dy = y * m
+    return dx, dy, dx + m, dy, dx + m, dy + m, dx, dy + m
+
+def tex_coords(top, bottom, side):
+    top = tex_coord(*top)
+    bottom = tex_coord(*bottom)
+    side = tex_coord(*side)
+    result = []
+    result.extend(top)
+    result.extend(bottom)
+    result.extend(side * 4)
+    return result
+
+class Block(object):
+    def __init__(self, id, name, top, bottom, side, light=0):
+        self.id = id
+        self.name = name
+        self.light = light
+        self.tiles = (top, bottom, side)
+        self.tex_coords = tex_coords(top, bottom, side)
+
+# Registro de blocos: o indice na lista e o ID guardado no mundo (uint8).
+# O ID 0 e reservado para o ar.
+AIR = 0
+BLOCKS = [None]
+NAMES = {}
+
+def register(name, top, bottom=None, side=None, light=0):
+    """Registra um tipo de bloco; `light` (0 a 15) e a luz que ele emite."""
+    if len(BLOCKS) > 255:
+        raise ValueError('limite de 255 tipos de bloco atingido')
+    block = Block(len(BLOCKS), name, top, bottom or top, side or top, light)
+    BLOCKS.append(block)
+    NAMES[name] = block.id
+    return block.id
+
+GRASS = register('grass', (1, 0), (0, 1), (0, 0))
+SAND = register('sand', (1, 1))
+BRICK = register('brick', (2, 0))
+STONE = register('stone', (2, 1))
+DIRT = register('dirt', (0, 1))
+# Topo do farol: mesma textura amarela da areia, mas acende.
+LAMP = register('lamp', (1, 1), light=15)
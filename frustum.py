@@ -0,0 +1,41 @@
+import math
+
+def planes(position, rotation, fov, aspect, near, far):
+    """Planos do frustum da camera de Window.set_3d, com normais para dentro.
+
+    Cada plano e (nx, ny, nz, d); um ponto p esta do lado de dentro quando
+    n . p + d >= 0.
+    """
+    x, y = rotation
+    m = math.cos(math.radians(y))
+    forward = (math.cos(math.radians(x - 90)) * m, math.sin(math.radians(y)), math.sin(math.radians(x - 90)) * m)
+    right = (math.cos(math.radians(x)), 0.0, math.sin(math.radians(x)))
+    up = (right[1] * forward[2] - right[2] * forward[1],
+          right[2] * forward[0] - right[0] * forward[2],
+          right[0] * forward[1] - right[1] * forward[0])
+    tan_y = math.tan(math.radians(fov) / 2)
+    tan_x = tan_y * aspect
+    normals = [
+        (forward, near),
+        (tuple(-c for c in forward), -far),
+        (tuple(r + tan_x * f for r, f in zip(right, forward)), 0.0),
+        (tuple(-r + tan_x * f for r, f in zip(right, forward)), 0.0),
+        (tuple(u + tan_y * f for u, f in zip(up, forward)), 0.0),
+        (tuple(-u + tan_y * f for u, f in zip(up, forward)), 0.0),
+    ]
+    result = []
+    for normal, offset in normals:
+        nx, ny, nz = normal
+        d = -(nx * position[0] + ny * position[1] + nz * position[2]) - offset
+        result.append((nx, ny, nz, d))
+    return result
+
+def visible(planes, lo, hi):
+    """Teste conservador de AABB: so descarta caixas inteiramente fora de um plano."""
+    for nx, ny, nz, d in planes:
+        px = hi[0] if nx > 0 else lo[0]
+        py = hi[1] if ny > 0 else lo[1]
+        pz = hi[2] if nz > 0 else lo[2]
+        if nx * px + ny * py + nz * pz + d < 0:
+            return False
+    return True
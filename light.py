@@ -0,0 +1,260 @@
+import collections
+
+import numpy
+
+from blocks import AIR, BLOCKS
+from world import SECTOR_SIZE, WORLD_BOTTOM, WORLD_HEIGHT, FACES
+
+# Niveis de luz de 0 a MAX_LIGHT em dois canais por celula (Sector.light[canal]):
+#   SKY: 15 em toda coluna aberta para o ceu; desce sem perder forca enquanto
+#        vale 15 e perde 1 por bloco em qualquer outra direcao.
+#   BLOCK: emitida por blocos com `light` no registro, perde 1 por bloco.
+# So o ar propaga luz; um bloco solido fica com 0 (ou com o que emite).
+MAX_LIGHT = 15
+SKY, BLOCK = 0, 1
+
+_emission_table = (0, None)
+
+def emission_table():
+    """Tabela [id do bloco] -> luz emitida."""
+    global _emission_table
+    if _emission_table[0] != len(BLOCKS):
+        table = numpy.zeros(256, dtype=numpy.uint8)
+        for block in BLOCKS[1:]:
+            table[block.id] = block.light
+        _emission_table = (len(BLOCKS), table)
+    return _emission_table[1]
+
+def _base(blocks):
+    # Luz sem propagacao lateral: colunas abertas e blocos que emitem.
+    covered = numpy.logical_or.accumulate((blocks != AIR)[:, ::-1], axis=1)[:, ::-1]
+    return numpy.where(covered, 0, MAX_LIGHT).astype(numpy.uint8), emission_table()[blocks]
+
+def _relax(air, light):
+    """Espalha a luz de um canal (`light` (X, Y, Z), alterado no lugar) pelo ar, por relaxacao."""
+    spread = numpy.empty_like(light)
+    for _ in range(MAX_LIGHT - 1):
+        spread[...] = 0
+        for axis in (0, 1, 2):
+            head = [slice(None)] * 3
+            tail = [slice(None)] * 3
+            head[axis], tail[axis] = slice(1, None), slice(None, -1)
+            head, tail = tuple(head), tuple(tail)
+            numpy.maximum(spread[head], light[tail], out=spread[head])
+            numpy.maximum(spread[tail], light[head], out=spread[tail])
+        numpy.subtract(spread, 1, out=spread, where=spread > 0)
+        grown = air & (spread > light)
+        if not grown.any():
+            break
+        numpy.copyto(light, spread, where=grown)
+
+def _solve(world, x0, x1, z0, z1, reset, reach):
+    """Junta os setores [x0, x1) x [z0, z1) num volume denso, volta as celulas
+    marcadas por reset(shape) para a luz base, propaga e grava de volta.
+
+    So a caixa das celulas marcadas, com `reach` celulas de folga, e propagada:
+    fora dela a luz ja estava certa. Devolve os setores cuja luz mudou.
+    """
+    S = SECTOR_SIZE
+    blocks = numpy.zeros(((x1 - x0) * S, WORLD_HEIGHT, (z1 - z0) * S), dtype=numpy.uint8)
+    light = numpy.zeros((2,) + blocks.shape, dtype=numpy.uint8)
+    box = {}
+    for kx in range(x0, x1):
+        for kz in range(z0, z1):
+            sector = world.sectors.get((kx, 0, kz))
+            if sector is not None:
+                cells = (slice((kx - x0) * S, (kx - x0 + 1) * S), slice(None), slice((kz - z0) * S, (kz - z0 + 1) * S))
+                box[sector.key] = cells
+                blocks[cells] = sector.blocks
+                light[(slice(None),) + cells] = sector.light
+    # Setores ausentes contam como solidos e escuros.
+    present = numpy.zeros(blocks.shape, dtype=bool)
+    for cells in box.values():
+        present[cells] = True
+    air = (blocks == AIR) & present
+    mask = reset(blocks.shape) & present
+    sky, emitted = _base(blocks)
+    light[SKY][mask] = sky[mask]
+    light[BLOCK][mask] = emitted[mask]
+    full = light
+
+    xs, ys, zs = [numpy.nonzero(mask.any(axis=axes))[0] for axes in ((1, 2), (0, 2), (0, 1))]
+    if not len(xs):
+        return set()
+    region = tuple(slice(max(int(c[0]) - reach, 0), int(c[-1]) + reach + 1) for c in (xs, ys, zs))
+    air, light = air[region], light[(slice(None),) + region]
+
+    # So mudam as camadas com ar escuro (e a de cima, de onde vem a luz do ceu)
+    # e as que estao ao alcance de quem emite.
+    y0, y1 = WORLD_HEIGHT, 0
+    rows = numpy.nonzero((air & (light[SKY] < MAX_LIGHT)).any(axis=(0, 2)))[0]
+    if len(rows):
+        y0, y1 = int(rows[0]) - 1, int(rows[-1]) + 2
+    rows = numpy.nonzero((light[BLOCK] > 1).any(axis=(0, 2)))[0]
+    if len(rows):
+        y0, y1 = min(y0, int(rows[0]) - MAX_LIGHT), max(y1, int(rows[-1]) + MAX_LIGHT + 1)
+    y0, y1 = max(y0, 0), min(y1, WORLD_HEIGHT)
+    if y0 < y1:
+        _relax(air[:, y0:y1], light[SKY, :, y0:y1])
+        if light[BLOCK].max() > 1:
+            _relax(air[:, y0:y1], light[BLOCK, :, y0:y1])
+
+    changed = set()
+    light = full
+    for key, cells in box.items():
+        sector = world.sectors[key]
+        lit = light[(slice(None),) + cells]
+        if (lit != sector.light).any():
+            sector.light[...] = lit
+            sector.version += 1
+            changed.add(key)
+    return changed
+
+def relight(world, keys):
+    """Acende setores recem-chegados (carregados ou gerados) e devolve os setores cuja luz mudou.
+
+    A luz dos vizinhos so pode aumentar: um setor ausente conta como escuro.
+    """
+    keys = set(key for key in keys if key in world.sectors)
+    if not keys:
+        return set()
+    x0, x1 = min(key[0] for key in keys) - 1, max(key[0] for key in keys) + 2
+    z0, z1 = min(key[2] for key in keys) - 1, max(key[2] for key in keys) + 2
+    def reset(shape):
+        mask = numpy.zeros(shape, dtype=bool)
+        for x, _, z in keys:
+            mask[(x - x0) * SECTOR_SIZE:(x - x0 + 1) * SECTOR_SIZE, :,
+                 (z - z0) * SECTOR_SIZE:(z - z0 + 1) * SECTOR_SIZE] = True
+        return mask
+    return _solve(world, x0, x1, z0, z1, reset, MAX_LIGHT)
+
+def relight_box(world, lo, hi, created=()):
+    """Refaz a luz depois de blocos escritos na caixa [lo, hi) (coordenadas do mundo).
+
+    A luz anda no maximo MAX_LIGHT - 1 blocos, entao basta recalcular a caixa
+    com essa folga para os lados e para cima, e ate o fundo do mundo (colunas
+    que deixaram de ver o ceu). Setores `created` pela escrita sao acesos
+    inteiros. Devolve os setores cuja luz mudou.
+    """
+    S, reach = SECTOR_SIZE, MAX_LIGHT
+    cx0, cx1 = lo[0] - reach, hi[0] + reach
+    cz0, cz1 = lo[2] - reach, hi[2] + reach
+    top = min(hi[1] + reach - WORLD_BOTTOM, WORLD_HEIGHT)
+    if top <= 0:
+        return set()
+    x0, x1 = (cx0 - 1) // S, (cx1 + 1) // S + 1
+    z0, z1 = (cz0 - 1) // S, (cz1 + 1) // S + 1
+    def reset(shape):
+        mask = numpy.zeros(shape, dtype=bool)
+        mask[cx0 - x0 * S:cx1 - x0 * S, :top, cz0 - z0 * S:cz1 - z0 * S] = True
+        for x, _, z in created:
+            mask[(x - x0) * S:(x - x0 + 1) * S, :, (z - z0) * S:(z - z0 + 1) * S] = True
+        return mask
+    return _solve(world, x0, x1, z0, z1, reset, 1 if not created else MAX_LIGHT)
+
+def _spread(channel, level, dy):
+    if channel == SKY and level == MAX_LIGHT and dy == -1:
+        return level
+    return level - 1
+
+def _increase(world, channel, queue, changed):
+    while queue:
+        x, y, z = queue.popleft()
+        sector, index = world._locate((x, y, z))
+        level = int(sector.light[channel][index])
+        if level <= 1:
+            continue
+        for dx, dy, dz in FACES:
+            position = (x + dx, y + dy, z + dz)
+            neighbour, i = world._locate(position)
+            if neighbour is None or neighbour.blocks[i] != AIR:
+                continue
+            spread = _spread(channel, level, dy)
+            if neighbour.light[channel][i] < spread:
+                neighbour.light[channel][i] = spread
+                changed.add(neighbour.key)
+                queue.append(position)
+
+def _decrease(world, channel, position, level, changed):
+    # Apaga a luz que dependia de `position` (que tinha `level`) e reacende a
+    # partir da borda do que foi apagado.
+    darken, refill = collections.deque([(position, level)]), collections.deque()
+    while darken:
+        (x, y, z), level = darken.popleft()
+        for dx, dy, dz in FACES:
+            position = (x + dx, y + dy, z + dz)
+            neighbour, i = world._locate(position)
+            if neighbour is None:
+                continue
+            current = int(neighbour.light[channel][i])
+            if not current:
+                continue
+            if neighbour.blocks[i] == AIR and (current < level or _spread(channel, level, dy) == level):
+                neighbour.light[channel][i] = 0
+                changed.add(neighbour.key)
+                darken.append((position, current))
+            else:
+                # Fonte propria (bloco que emite) ou luz vinda de outro caminho.
+                refill.append(position)
+    _increase(world, channel, refill, changed)
+
+def _finish(world, changed):
+    for key in changed:
+        world.sectors[key].version += 1
+    return changed
+
+def block_added(world, position):
+    """Atualiza a luz em volta de um bloco recem-colocado; devolve os setores alterados."""
+    sector, index = world._locate(position)
+    changed = set([sector.key])
+    for channel in (SKY, BLOCK):
+        level = int(sector.light[channel][index])
+        sector.light[channel][index] = 0
+        if level:
+            _decrease(world, channel, position, level, changed)
+    emitted = int(emission_table()[sector.blocks[index]])
+    if emitted:
+        sector.light[BLOCK][index] = emitted
+        _increase(world, BLOCK, collections.deque([position]), changed)
+    return _finish(world, changed)
+
+def block_removed(world, position):
+    """Atualiza a luz em volta de um bloco recem-removido; devolve os setores alterados."""
+    sector, index = world._locate(position)
+    changed = set([sector.key])
+    level = int(sector.light[BLOCK][index])
+    if level:
+        sector.light[BLOCK][index] = 0
+        _decrease(world, BLOCK, position, level, changed)
+    x, y, z = position
+    for channel in (SKY, BLOCK):
+        best = 0
+        for dx, dy, dz in FACES:
+            neighbour, i = world._locate((x - dx, y - dy, z - dz))
+            if neighbour is not None:
+                best = max(best, _spread(channel, int(neighbour.light[channel][i]), dy))
+            elif channel == SKY and dy == -1 and y + 1 - WORLD_BOTTOM >= WORLD_HEIGHT:
+                best = MAX_LIGHT  # acima do topo do mundo
+        if best > sector.light[channel][index]:
+            sector.light[channel][index] = best
+            _increase(world, channel, collections.deque([position]), changed)
+    return _finish(world, changed)
+
+def padded(world, sector):
+    """Nivel (maximo dos canais) de cada celula do setor com uma borda de 1 em
+    volta, vinda dos vizinhos; usado pelo mesher para a face que da para a celula."""
+    S, H = SECTOR_SIZE, WORLD_HEIGHT
+    # Fora do mundo carregado e acima do topo conta como ceu aberto.
+    levels = numpy.full((S + 2, H + 2, S + 2), MAX_LIGHT, dtype=numpy.uint8)
+    levels[:, 0] = 0
+    levels[1:-1, 1:-1, 1:-1] = sector.light.max(axis=0)
+    x, _, z = sector.key
+    neighbour = world.sectors.get((x - 1, 0, z))
+    if neighbour is not None: levels[0, 1:-1, 1:-1] = neighbour.light[:, -1].max(axis=0)
+    neighbour = world.sectors.get((x + 1, 0, z))
+    if neighbour is not None: levels[-1, 1:-1, 1:-1] = neighbour.light[:, 0].max(axis=0)
+    neighbour = world.sectors.get((x, 0, z - 1))
+    if neighbour is not None: levels[1:-1, 1:-1, 0] = neighbour.light[:, :, :, -1].max(axis=0)
+    neighbour = world.sectors.get((x, 0, z + 1))
+    if neighbour is not None: levels[1:-1, 1:-1, -1] = neighbour.light[:, :, :, 0].max(axis=0)
+    return levels
@@ -1,26 +1,60 @@
 from __future__ import division
 import sys
 import math
-import random
 import time
 import os
+import random
+import argparse
+import contextlib
+import threading
+import multiprocessing
 import structures
-from collections import deque
+import terrain
+import storage
+import raycast
+import frustum
+import render
+import scheduler
+import physics
+import light
+import mesher
+import occlusion
+import pathfind
+import profiler
+import query
+import recording
+from physics import JUMP_SPEED, PLAYER_HEIGHT
+from collections import OrderedDict
+from concurrent import futures
+from blocks import BLOCKS, GRASS, SAND, BRICK, STONE, LAMP, tex_coord, tex_coords
+from world import World, SECTOR_SIZE, WORLD_BOTTOM, FACES, ALL_FACES, normalize, sectorize
+import numpy
 import pyglet 
-from pyglet import image
+# Os workers do gerador (forkserver) importam de novo o script de entrada: neles nao ha janela.
+if multiprocessing.current_process().name != 'MainProcess': pyglet.options['shadow_window'] = False
 from pyglet.gl import *
-from pyglet.graphics import TextureGroup
 from pyglet.window import key, mouse
 
 TICKS_PER_SEC = 60
-SECTOR_SIZE = 16
 WALKING_SPEED = 5
 FLYING_SPEED = 15
-GRAVITY = 20.0
-MAX_JUMP_HEIGHT = 2
-JUMP_SPEED = math.sqrt(2 * GRAVITY * MAX_JUMP_HEIGHT)
-TERMINAL_VELOCITY = 50
-PLAYER_HEIGHT = 2
+FOV = 65.0
+NEAR = 0.1
+# Raio (em setores) das malhas completas e das simplificadas (LOD) depois dele.
+VIEW_DISTANCE = 4
+LOD_DISTANCE = 12
+# Passo (em blocos) das celulas LOD ate cada distancia, em setores.
+LOD_STEPS = ((6, 2), (9, 4), (LOD_DISTANCE, 8))
+FAR = float(LOD_DISTANCE * SECTOR_SIZE)
+MESH_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+GENERATOR_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+# Setores na memoria antes de comecar a descartar os menos usados: cada um tem
+# 128 KB de blocos, mascaras e luz (32 KB + 32 KB + 64 KB), uns 32 MB no limite.
+MAX_SECTORS = 256
+# O diario de edicoes e compactado nas regioes a cada AUTOSAVE_INTERVAL
+# segundos ou depois de JOURNAL_LIMIT edicoes, o que vier antes.
+AUTOSAVE_INTERVAL = 30.0
+JOURNAL_LIMIT = 4096
 
 if sys.version_info[0] >= 3:
     xrange = range
@@ -35,173 +69,459 @@ def cube_vertices(x, y, z, n):
         x+n,y-n,z-n, x-n,y-n,z-n, x-n,y+n,z-n, x+n,y+n,z-n,  # back
     ]
 
-def tex_coord(x, y, n=4):
-    m = 1.0 / n
-    dx = x * m
-    dy = y * m
-    return dx, dy, dx + m, dy, dx + m, dy + m, dx, dy + m
-
-def tex_coords(top, bottom, side):
-    top = tex_coord(*top)
-    bottom = tex_coord(*bottom)
-    side = tex_coord(*side)
-    result = []
-    result.extend(top)
-    result.extend(bottom)
-    result.extend(side * 4)
-    return result
-
 script_dir = os.path.dirname(os.path.abspath(__file__))
 TEXTURE_PATH = os.path.join(script_dir, 'texture.png')
+SAVE_PATH = os.path.join(script_dir, 'save')
+INFINITE_SAVE_PATH = os.path.join(script_dir, 'save_infinite')
+TRACE_PATH = os.path.join(script_dir, 'trace_%Y%m%d_%H%M%S.json')
+# Etapas mostradas no overlay de tempos (F3), na ordem do frame.
+STAGES = ['process_queue', 'change_sectors', 'physics', 'draw', 'focused_block', 'hud']
+# Frames no grafico do overlay e pixels por milissegundo.
+GRAPH_FRAMES = 240
+GRAPH_SCALE = 4
+# Segundos que um aviso (como o do trace salvo) fica no HUD.
+STATUS_SECONDS = 5.0
 
-GRASS = tex_coords((1, 0), (0, 1), (0, 0))
-SAND = tex_coords((1, 1), (1, 1), (1, 1))
-BRICK = tex_coords((2, 0), (2, 0), (2, 0))
-STONE = tex_coords((2, 1), (2, 1), (2, 1))
+def save_path(infinite, record=False):
+    # Uma gravacao parte do mundo da seed, sem o salvo, para o replay comecar igual.
+    if record: return None
+    return INFINITE_SAVE_PATH if infinite else SAVE_PATH
 
-FACES = [(0, 1, 0), (0, -1, 0), (-1, 0, 0), (1, 0, 0), (0, 0, 1), (0, 0, -1)]
+def lod_step(distance):
+    """Passo das celulas LOD de um setor a `distance` (ao quadrado, em setores) do jogador."""
+    for radius, step in LOD_STEPS:
+        if distance <= radius ** 2:
+            return step
+    return LOD_STEPS[-1][1]
 
-def normalize(position):
-    x, y, z = position
-    return (int(round(x)), int(round(y)), int(round(z)))
+def mesh_sector(mesh, blocks, masks, levels, origin, depth):
+    # No worker: a malha e a conectividade do ar (para o occlusion culling) saem juntas.
+    return mesh(blocks, masks, levels, origin, depth), occlusion.connectivity(blocks)
 
-def sectorize(position):
-    x, y, z = normalize(position)
-    return (x // SECTOR_SIZE, 0, z // SECTOR_SIZE)
+def generator_pool(workers=GENERATOR_WORKERS):
+    # Gerar terreno e numpy puro, entao processos escalam com os nucleos. Os
+    # workers so nascem no primeiro submit, quando o mesher, o diario e o
+    # audio ja tem threads: com forkserver eles saem de um processo servidor
+    # sem threads, em vez de um fork deste, e nao herdam locks presos. Sem
+    # forkserver a geracao fica em threads.
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['terrain'])
+        return futures.ProcessPoolExecutor(workers, mp_context=context)
+    return futures.ThreadPoolExecutor(workers)
 
 class Model(object):
-    def __init__(self):
-        self.batch = pyglet.graphics.Batch()
-        self.group = TextureGroup(image.load(TEXTURE_PATH).get_texture())
-        self.world = {}
+    def __init__(self, seed=None, path=None, executor=None, backend=None, infinite=False, generator=None):
+        self.backend = backend or render.GLBackend(TEXTURE_PATH)
+        self.world = World(storage.Storage(path) if path else None)
+        saved = self.world.storage and self.world.storage.exists()
+        meta = self.world.storage.read_meta() if self.world.storage else {}
+        self.infinite = meta.get('infinite', infinite)
+        # Sem seed sorteia uma, para o mundo (e uma gravacao dele) poder ser refeito.
+        self.seed = meta.get('seed', random.randrange(1 << 31) if seed is None else seed)
         self.shown = {}
         self._shown = {}
-        self.sectors = {}
-        self.queue = deque()
-        self._initialize()
+        self.bounds = {}
+        self.culled = (0, 0)
+        self.occluded = (0, 0)
+        # Conectividade das faces de cada setor com malha, e caches da busca de visibilidade.
+        self.links = {}
+        self.links_version = 0
+        self._camera = (None, None, None, None)
+        self._visible = (None, None)
+        self.sectors = self.world.sectors
+        self.queue = scheduler.Scheduler()
+        self.budget = scheduler.FrameBudget(1.0 / TICKS_PER_SEC)
+        self.pending = {}
+        self.entities = physics.Entities(self.world)
+        # Consultas por caixa, esfera, coluna e bloco mais perto (query.py).
+        self.spatial = query.SpatialIndex(self.world)
+        # Caminhos a pe entre portais dos setores (pathfind.py).
+        self.paths = pathfind.Pathfinder(self.world)
+        # Setores a refazer no fim da transacao aberta (None fora de uma).
+        self.deferred_sectors = None
+        self.generating = {}
+        self.view = set()
+        self.near = set()
+        self.lru = OrderedDict()
+        # Anel de malhas LOD: o passo desejado de cada setor, o das malhas ja
+        # enviadas e os mapas de alturas (versao, heights, tops).
+        self.far = {}
+        self.steps = {}
+        self.lods = {}
+        self._lods = {}
+        self.lod_bounds = {}
+        self.lod_pending = {}
+        self.lod_queue = scheduler.Scheduler()
+        self.summaries = {}
+        # Diario de edicoes (so com armazenamento) e contador de ticks gravado nele.
+        self.tick = 0
+        self.journal = None
+        self.next_autosave = time.perf_counter() + AUTOSAVE_INTERVAL
+        # Um stamp() pede a compactacao do proximo autosave (uma so por tick).
+        self.stamped = False
+        self.generator = (generator or generator_pool()) if self.infinite else None
+        self.executor = executor or futures.ThreadPoolExecutor(MESH_WORKERS)
+        if self.world.storage and self.infinite:
+            self.world.storage.write_meta({'seed': self.seed, 'infinite': True})
+        if not (saved or self.infinite):
+            self._initialize(self.seed)
+            # O mundo novo ja vai para o disco: e a base sobre a qual o diario e
+            # reaplicado. A seed vai junto, para reabrir o mesmo mundo.
+            self.save()
+            if self.world.storage:
+                self.world.storage.write_meta({'seed': self.seed, 'infinite': False})
+        if self.world.storage:
+            self.journal = storage.Journal(self.world.storage)
+            if saved or self.infinite: self.recover()
+            else: self.journal.discard()
 
-    def _initialize(self):
+    def _initialize(self, seed=None):
         builder = structures.StructureBuilder(self)
-        n, s, y = 80, 1, 0
-        
-        # Terreno base
-        for x in xrange(-n, n + 1, s):
-            for z in xrange(-n, n + 1, s):
-                self.add_block((x, y - 2, z), GRASS, immediate=False)
-                self.add_block((x, y - 3, z), STONE, immediate=False)
-                if x in (-n, n) or z in (-n, n):
-                    for dy in xrange(-2, 3):
-                        self.add_block((x, y + dy, z), STONE, immediate=False)
-
-        # Morros
-        o = n - 10
-        for _ in xrange(120):
-            a, b, c = random.randint(-o, o), random.randint(-o, o), -1
-            h, s = random.randint(1, 6), random.randint(4, 8)
-            t = random.choice([GRASS, SAND, BRICK])
-            for y_hill in xrange(c, c + h):
-                for x_hill in xrange(a - s, a + s + 1):
-                    for z_hill in xrange(b - s, b + s + 1):
-                        if (x_hill - a) ** 2 + (z_hill - b) ** 2 > (s + 1) ** 2: continue
-                        if (x_hill) ** 2 + (z_hill) ** 2 < 25: continue
-                        self.add_block((x_hill, y_hill, z_hill), t, immediate=False)
-                s -= 1
 
         # Estruturas
         house_m = {0: STONE, 1: BRICK, 2: GRASS}
-        light_m = {0: STONE, 1: STONE, 2: SAND}
+        light_m = {0: STONE, 1: STONE, 2: LAMP}
         maze_m = {0: SAND, 1: GRASS, 2: STONE}
 
-        builder.build((10, 0, 10), structures.SIMPLE_HOUSE, house_m)
-        builder.build((-15, 0, -10), structures.SIMPLE_HOUSE, house_m)
-        builder.build((-20, 0, 20), structures.LIGHTHOUSE, light_m)
-        builder.build((20, 0, -20), structures.MAZE, maze_m)
+        # Terreno e estruturas num paste so: mascaras e luz sao calculadas uma vez.
+        self.stamp([terrain.generate(80, seed)] + builder.volumes([
+            ((10, 0, 10), structures.SIMPLE_HOUSE, house_m),
+            ((-15, 0, -10), structures.SIMPLE_HOUSE, house_m),
+            ((-20, 0, 20), structures.LIGHTHOUSE, light_m),
+            ((20, 0, -20), structures.MAZE, maze_m),
+        ]))
+
+    def recover(self):
+        """Reaplica nas regioes o diario de uma sessao que nao fechou direito.
+
+        Cada setor citado parte do que esta no disco (ou, se nunca foi gravado,
+        do terreno gerado pela seed) e recebe as edicoes na ordem em que foram
+        feitas; quem ja estava gravado so recebe os mesmos valores de novo.
+        """
+        records = self.journal.read()
+        sectors = {}
+        for x, y, z, old, new, tick in records:
+            key = sectorize((x, y, z))
+            blocks = sectors.get(key)
+            if blocks is None:
+                blocks = self.world.storage.load(key)
+                if blocks is None and self.infinite:
+                    blocks = terrain.generate_sector(self.seed, key)
+                elif blocks is None:
+                    blocks = numpy.zeros(storage.SECTOR_SHAPE, dtype=numpy.uint8)
+                sectors[key] = blocks
+            blocks[x % SECTOR_SIZE, y - WORLD_BOTTOM, z % SECTOR_SIZE] = new
+        self.world.storage.write(dict((key, blocks if blocks.any() else None) for key, blocks in sectors.items()))
+        self.journal.discard()
+        return len(records)
+
+    def autosave(self, force=False):
+        """Compacta o diario se passou AUTOSAVE_INTERVAL ou JOURNAL_LIMIT, se
+        houve stamp() (ou se `force`): copia os setores alterados e a thread do
+        diario os grava. Dentro de uma transacao espera ela terminar."""
+        if self.journal is None or self.deferred_sectors is not None: return
+        # Sem a thread do diario nada mais chega ao disco: o erro sobe ja.
+        self.journal.check()
+        now = time.perf_counter()
+        if not (force or self.stamped or now >= self.next_autosave or self.journal.count >= JOURNAL_LIMIT): return
+        self.next_autosave = now + AUTOSAVE_INTERVAL
+        self.stamped = False
+        if self.world.dirty or self.journal.count:
+            self.journal.compact(self.world.storage.stage(self.world))
 
     def hit_test(self, position, vector, max_distance=8):
-        m = 8
-        x, y, z = position
-        dx, dy, dz = vector
-        previous = None
-        for _ in xrange(max_distance * m):
-            key = normalize((x, y, z))
-            if key != previous and key in self.world:
-                return key, previous
-            previous = key
-            x, y, z = x + dx / m, y + dy / m, z + dz / m
-        return None, None
+        block, previous, face = raycast.raycast(self.world, position, vector, max_distance)
+        return block, previous
+
+    def hit_test_many(self, positions, vectors, max_distance=8):
+        return raycast.raycast_many(self.world, positions, vectors, max_distance)
 
     def exposed(self, position):
-        x, y, z = position
-        for dx, dy, dz in FACES:
-            if (x + dx, y + dy, z + dz) not in self.world:
-                return True
-        return False
+        return self.world.mask(position) != ALL_FACES
 
-    def add_block(self, position, texture, immediate=True):
+    def add_block(self, position, block, immediate=True):
+        if not self.world.in_bounds(position): return
         if position in self.world:
             self.remove_block(position, immediate)
-        self.world[position] = texture
-        self.sectors.setdefault(sectorize(position), []).append(position)
+        sector = sectorize(position)
+        created = sector not in self.sectors
+        self.world[position] = block
+        self.paths.invalidate(position)
+        if self.journal: self.journal.append(position, 0, block, self.tick)
+        # So a frente de luz afetada e refeita; um setor novo e aceso inteiro.
+        lit = light.relight(self.world, [sector]) if created else light.block_added(self.world, position)
         if immediate:
-            if self.exposed(position):
-                self.show_block(position)
             self.check_neighbors(position)
+            self.refresh(lit)
 
     def remove_block(self, position, immediate=True):
+        old = self.world[position]
         del self.world[position]
-        self.sectors[sectorize(position)].remove(position)
+        self.paths.invalidate(position)
+        if self.journal: self.journal.append(position, old, 0, self.tick)
+        lit = light.block_removed(self.world, position)
         if immediate:
-            if position in self.shown:
-                self.hide_block(position)
             self.check_neighbors(position)
+            self.refresh(lit)
+
+    def stamp(self, volumes):
+        """Escreve varios (origin, volume) no mundo e refaz as malhas visiveis afetadas uma vez."""
+        before = set(self.sectors)
+        touched = self.world.paste_many(volumes)
+        if not touched: return touched
+        self.paths.invalidate_sectors(touched)
+        lo = [min(origin[k] for origin, volume in volumes) for k in (0, 1, 2)]
+        hi = [max(origin[k] + volume.shape[k] for origin, volume in volumes) for k in (0, 1, 2)]
+        sectors = light.relight_box(self.world, lo, hi, touched - before) | touched
+        for x, y, z in touched:
+            sectors.update([(x - 1, y, z), (x + 1, y, z), (x, y, z - 1), (x, y, z + 1)])
+        self.refresh(sectors)
+        # Volumes nao cabem no diario: os setores tocados vao inteiros para a
+        # base no proximo autosave, junto com o resto, e o diario recomeca. Gravar
+        # so eles nao basta: o recover() reaplicaria por cima as edicoes anteriores.
+        self.stamped = True
+        return touched
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Agrupa edicoes: dentro do bloco `with`, add_block/remove_block so anotam
+        os setores afetados, e cada um deles e refeito uma unica vez na saida.
+        Transacoes aninhadas se juntam a de fora."""
+        if self.deferred_sectors is not None:
+            yield self
+            return
+        self.deferred_sectors = set()
+        try:
+            yield self
+        finally:
+            sectors, self.deferred_sectors = self.deferred_sectors, None
+            self.refresh(sectors)
+
+    def refresh(self, sectors):
+        if self.deferred_sectors is not None:
+            self.deferred_sectors.update(sectors)
+            return
+        for sector in sectors:
+            if sector in self.shown or sector in self.pending: self._show_sector(sector)
+            if sector in self.lods or sector in self.lod_pending: self.lod_queue.push(sector, self._show_lod, sector)
 
     def check_neighbors(self, position):
         x, y, z = position
-        for dx, dy, dz in FACES:
-            key = (x + dx, y + dy, z + dz)
-            if key not in self.world: continue
-            if self.exposed(key):
-                if key not in self.shown: self.show_block(key)
-            elif key in self.shown:
-                self.hide_block(key)
-
-    def show_block(self, position, immediate=True):
-        texture = self.world[position]
-        self.shown[position] = texture
+        self.refresh(set(sectorize((x + dx, y, z + dz)) for dx, dy, dz in FACES))
+
+    def show_sector(self, sector, immediate=False):
         if immediate:
-            self._show_block(position, texture)
+            self._show_sector(sector)
+        elif sector in self.shown or sector in self.pending:
+            self.queue.cancel(sector)
         else:
-            self._enqueue(self._show_block, position, texture)
+            self.queue.push(sector, self._show_sector, sector)
 
-    def _show_block(self, position, texture):
-        x, y, z = position
-        vertex_data = cube_vertices(x, y, z, 0.5)
-        self._shown[position] = self.batch.add(24, GL_QUADS, self.group,
-            ('v3f/static', vertex_data),
-            ('t2f/static', list(texture)))
+    def _show_sector(self, sector):
+        # O worker recebe uma copia do setor; a versao diz se o resultado ainda vale.
+        data = self.sectors.get(sector)
+        if data is None: return
+        pending = self.pending.pop(sector, None)
+        if pending: pending[1].cancel()
+        future = self.executor.submit(mesh_sector, self.backend.mesh, data.blocks.copy(), data.masks.copy(),
+                                      light.padded(self.world, data), data.origin, self.backend.depth)
+        self.pending[sector] = (data.version, future)
 
-    def hide_block(self, position, immediate=True):
-        self.shown.pop(position)
+    def _upload(self, sector):
+        version, future = self.pending.pop(sector)
+        data = self.sectors.get(sector)
+        if data is None or sector in self.far: return
+        if data.version != version:
+            self._show_sector(sector)
+            return
+        (count, data, bounds), self.links[sector] = future.result()
+        self.links_version += 1
+        vertex_list = self._shown.pop(sector, None)
+        if vertex_list: vertex_list.delete()
+        # A malha completa substitui a simplificada de quando o setor estava longe.
+        self._hide_lod(sector)
+        self.shown[sector] = count
+        if not count: return
+        self.bounds[sector] = bounds
+        self._shown[sector] = self.backend.upload(count, data)
+
+    def hide_sector(self, sector, immediate=False):
         if immediate:
-            self._hide_block(position)
+            self._hide_sector(sector)
+        elif sector in self.shown or sector in self.pending:
+            self.queue.push(sector, self._hide_sector, sector)
+        else:
+            self.queue.cancel(sector)
+
+    def _hide_sector(self, sector):
+        pending = self.pending.pop(sector, None)
+        if pending: pending[1].cancel()
+        self.shown.pop(sector, None)
+        self.bounds.pop(sector, None)
+        if self.links.pop(sector, None) is not None: self.links_version += 1
+        vertex_list = self._shown.pop(sector, None)
+        if vertex_list: vertex_list.delete()
+        if sector not in self.far: self._hide_lod(sector)
+
+    def summary(self, sector):
+        """Mapa de alturas (heights, tops) de um setor para as malhas LOD, ou None se ele nao existe.
+
+        Vem dos blocos na memoria, do disco (sem carregar o setor no mundo) ou,
+        no mundo infinito, direto do ruido do terreno.
+        """
+        data = self.sectors.get(sector)
+        version = None if data is None else data.version
+        cached = self.summaries.get(sector)
+        if cached is not None and cached[0] == version:
+            return cached[1:]
+        storage = self.world.storage
+        if data is not None:
+            heights, tops = mesher.heightmap(data.blocks)
+        elif storage and sector in storage:
+            heights, tops = mesher.heightmap(storage.load(sector))
+        elif self.infinite:
+            heights, tops = terrain.surface(self.seed, sector)
         else:
-            self._enqueue(self._hide_block, position)
+            return None
+        self.summaries[sector] = (version, heights, tops)
+        return heights, tops
 
-    def _hide_block(self, position):
-        self._shown.pop(position).delete()
+    def _show_lod(self, sector):
+        step = self.far.get(sector)
+        summary = self.summary(sector) if step else None
+        if summary is None:
+            self._hide_lod(sector)
+            if sector not in self.view: self._hide_sector(sector)
+            return
+        heights, tops = summary
+        # Borda de `step` colunas dos vizinhos; sem vizinho, a borda repete o setor (sem paredes).
+        x, y, z = sector
+        padded = numpy.pad(heights, step, mode='edge')
+        inner = slice(step, -step)
+        for dx, dz, target, source in ((-1, 0, (slice(None, step), inner), (slice(-step, None),)),
+                                       (1, 0, (slice(-step, None), inner), (slice(None, step),)),
+                                       (0, -1, (inner, slice(None, step)), (slice(None), slice(-step, None))),
+                                       (0, 1, (inner, slice(-step, None)), (slice(None), slice(None, step)))):
+            neighbour = self.summary((x + dx, y, z + dz))
+            if neighbour is not None: padded[target] = neighbour[0][source]
+        pending = self.lod_pending.pop(sector, None)
+        if pending: pending[1].cancel()
+        origin = (x * SECTOR_SIZE, WORLD_BOTTOM, z * SECTOR_SIZE)
+        future = self.executor.submit(self.backend.lod, padded, tops.copy(), origin, step, self.backend.depth)
+        self.lod_pending[sector] = (step, future)
 
-    def show_sector(self, sector):
-        for position in self.sectors.get(sector, []):
-            if position not in self.shown and self.exposed(position):
-                self.show_block(position, False)
+    def _upload_lod(self, sector):
+        step, future = self.lod_pending.pop(sector)
+        if self.far.get(sector) != step: return
+        count, data, bounds = future.result()
+        self._hide_lod(sector)
+        # A malha simplificada substitui a completa de quando o setor estava perto.
+        if sector not in self.view: self._hide_sector(sector)
+        self.steps[sector] = step
+        self.lods[sector] = count
+        if not count: return
+        self.lod_bounds[sector] = bounds
+        self._lods[sector] = self.backend.upload(count, data)
 
-    def hide_sector(self, sector):
-        for position in self.sectors.get(sector, []):
-            if position in self.shown:
-                self.hide_block(position, False)
+    def _hide_lod(self, sector):
+        pending = self.lod_pending.pop(sector, None)
+        if pending: pending[1].cancel()
+        self.steps.pop(sector, None)
+        self.lods.pop(sector, None)
+        self.lod_bounds.pop(sector, None)
+        mesh = self._lods.pop(sector, None)
+        if mesh: mesh.delete()
+
+    def change_lods(self, center):
+        """Refaz o anel LOD em volta de `center`: setores fora da distancia de
+        visao e ate LOD_DISTANCE, com celulas maiores quanto mais longe.
+
+        Um setor que entra na visao continua com a malha LOD ate a completa
+        chegar, e um que sai mantem a completa ate a LOD chegar.
+        """
+        far = {}
+        if center is not None:
+            cx, cy, cz = center
+            for dx in xrange(-LOD_DISTANCE, LOD_DISTANCE + 1):
+                for dz in xrange(-LOD_DISTANCE, LOD_DISTANCE + 1):
+                    distance = dx ** 2 + dz ** 2
+                    sector = (cx + dx, cy, cz + dz)
+                    if distance > (LOD_DISTANCE + 1) ** 2 or sector in self.view: continue
+                    far[sector] = lod_step(distance)
+            self.lod_queue.recenter(center)
+        for sector in set(self.far) - set(far):
+            if sector in self.view: self.lod_queue.cancel(sector)
+            else: self.lod_queue.push(sector, self._hide_lod, sector)
+        self.far = far
+        for sector, step in far.items():
+            current = self.lod_pending[sector][0] if sector in self.lod_pending else self.steps.get(sector)
+            if current != step: self.lod_queue.push(sector, self._show_lod, sector)
+        # Mapas de alturas so do anel e da borda dele.
+        for sector in list(self.summaries):
+            if center is None or max(abs(sector[0] - center[0]), abs(sector[2] - center[2])) > LOD_DISTANCE + 1:
+                del self.summaries[sector]
+
+    def request_sector(self, sector):
+        # Do disco se ja foi salvo; senao, no mundo infinito, gerado num processo do pool.
+        # Devolve o setor quando ele vem do disco (a luz fica para quem chamou, em lote).
+        if sector in self.sectors or sector in self.generating: return None
+        data = self.world.load(sector)
+        if data is not None:
+            self.lru[sector] = None
+        elif self.infinite:
+            self.generating[sector] = self.generator.submit(terrain.generate_sector, self.seed, sector)
+        return data
+
+    def ready(self, sector):
+        # No mundo infinito a malha espera os vizinhos, senao a borda sairia errada e seria refeita.
+        x, y, z = sector
+        return sector in self.sectors and (not self.infinite or all(
+            (x + dx, y, z + dz) in self.sectors for dx, dz in ((-1, 0), (1, 0), (0, -1), (0, 1))))
+
+    def _receive(self, sector):
+        blocks = self.generating.pop(sector).result()
+        if sector in self.sectors: return
+        self.world.insert(sector, blocks)
+        self.lru[sector] = None
+        x, y, z = sector
+        around = [(x + dx, y, z + dz) for dx, dz in ((0, 0), (-1, 0), (1, 0), (0, -1), (0, 1))]
+        self.refresh((light.relight(self.world, [sector]) | set(around)) - set([sector]))
+        for neighbour in around:
+            if neighbour in self.shown or neighbour in self.pending: continue
+            if neighbour in self.view and self.ready(neighbour):
+                self.show_sector(neighbour)
+
+    def evict_sectors(self):
+        """Descarta os setores usados ha mais tempo acima de MAX_SECTORS.
+
+        Setores editados sao gravados antes de sair; sem armazenamento eles
+        ficam. Os limpos so saem se der para recupera-los (disco ou gerador).
+        """
+        excess = len(self.sectors) - MAX_SECTORS
+        if excess <= 0: return
+        storage = self.world.storage
+        order = [sector for sector in self.sectors if sector not in self.lru] + list(self.lru)
+        victims, dirty = [], []
+        for sector in order:
+            if len(victims) >= excess: break
+            if sector in self.near or sector in self.shown or sector in self.pending: continue
+            if sector in self.world.dirty:
+                if storage is None: continue
+                dirty.append(sector)
+            elif not (self.infinite or (storage and sector in storage)):
+                continue
+            victims.append(sector)
+        if dirty and self.journal: self.journal.write(storage.stage(self.world, dirty))
+        elif dirty: storage.save(self.world, dirty)
+        for sector in victims:
+            self.world.evict(sector)
+            self.lru.pop(sector, None)
+        self.spatial.forget(victims)
+        self.paths.invalidate_sectors(victims)
 
     def change_sectors(self, before, after):
-        before_set, after_set, pad = set(), set(), 4
+        before_set, after_set, pad = set(), set(), VIEW_DISTANCE
         for dx in xrange(-pad, pad + 1):
             for dy in [0]:
                 for dz in xrange(-pad, pad + 1):
@@ -209,48 +529,252 @@ class Model(object):
                     if before: before_set.add((before[0] + dx, before[1] + dy, before[2] + dz))
                     if after: after_set.add((after[0] + dx, after[1] + dy, after[2] + dz))
         
-        for sector in (after_set - before_set): self.show_sector(sector)
-        for sector in (before_set - after_set): self.hide_sector(sector)
+        if after: self.queue.recenter(after)
+        self.view = after_set
+        self.near = set((x + dx, y, z + dz) for x, y, z in after_set
+                        for dx, dz in ((0, 0), (-1, 0), (1, 0), (0, -1), (0, 1)))
+        loaded = []
+        for sector in sorted(self.near - self.generating.keys(), key=self.queue.distance):
+            if self.request_sector(sector) is not None: loaded.append(sector)
+            if sector in self.lru: self.lru.move_to_end(sector)
+        if loaded: self.refresh(light.relight(self.world, loaded))
+        for sector in (after_set - before_set):
+            if self.ready(sector): self.show_sector(sector)
+        self.change_lods(after)
+        for sector in (before_set - after_set):
+            # No anel LOD a malha completa so sai quando a simplificada estiver pronta.
+            if sector not in self.far or sector in self.lods: self.hide_sector(sector)
+            else: self.queue.cancel(sector)
+        for sector, future in list(self.generating.items()):
+            if sector not in self.near and future.cancel(): del self.generating[sector]
+        self.evict_sectors()
+
+    def visible_sectors(self, position):
+        """Setores que podem ser vistos de `position` segundo a conectividade do
+        ar (occlusion.visible), ou None se nao da para descartar nada."""
+        x, y, z = normalize(position)
+        sector = sectorize(position)
+        data = self.sectors.get(sector)
+        if data is None or not self.world.in_bounds((x, y, z)):
+            return None
+        key, version, labels, regions = self._camera
+        if key != sector or version != data.version:
+            labels, regions = occlusion.components(data.blocks)
+            self._camera = (sector, data.version, labels, regions)
+        # A camera dentro de um bloco nao restringe nada.
+        label = int(labels[x % SECTOR_SIZE, y - WORLD_BOTTOM, z % SECTOR_SIZE])
+        faces = regions.get(label, 0) if label >= 0 else ALL_FACES
+        cache = (sector, faces, self.links_version)
+        if self._visible[0] != cache:
+            links = lambda sector: self.links.get(sector, occlusion.OPEN)
+            self._visible = (cache, occlusion.visible(sector, faces, links, LOD_DISTANCE))
+        return self._visible[1]
 
-    def _enqueue(self, func, *args):
-        self.queue.append((func, args))
+    def draw(self, planes=None, visible=None):
+        # Cada setor tem seu proprio vertex list; os que estao fora do frustum nao sao
+        # enviados, nem os que a conectividade diz que nao aparecem (fora de `visible`).
+        sectors = faces = hidden = hidden_faces = 0
+        self.backend.begin()
+        for meshes, bounds, counts in ((self._shown, self.bounds, self.shown),
+                                       (self._lods, self.lod_bounds, self.lods)):
+            for sector, mesh in meshes.items():
+                if visible is not None and sector not in visible:
+                    hidden += 1
+                    hidden_faces += counts[sector]
+                    continue
+                if planes and not frustum.visible(planes, *bounds[sector]):
+                    sectors += 1
+                    faces += counts[sector]
+                    continue
+                self.backend.draw(mesh)
+        self.backend.end()
+        self.culled = (sectors, faces)
+        self.occluded = (hidden, hidden_faces)
+
+    def save(self):
+        if self.world.storage: self.world.storage.save(self.world)
 
     def _dequeue(self):
-        func, args = self.queue.popleft()
+        func, args = self.queue.pop()
         func(*args)
 
     def process_queue(self):
-        start = time.perf_counter()
-        while self.queue and time.perf_counter() - start < 1.0 / TICKS_PER_SEC:
+        self.tick += 1
+        self.autosave()
+        start, budget = time.perf_counter(), self.budget()
+        while self.queue and time.perf_counter() - start < budget:
             self._dequeue()
+        # O anel LOD so usa o que sobra depois dos setores perto.
+        while self.lod_queue and time.perf_counter() - start < budget:
+            func, args = self.lod_queue.pop()
+            func(*args)
+        generated = [sector for sector, future in self.generating.items() if future.done()]
+        for sector in sorted(generated, key=self.queue.distance):
+            if time.perf_counter() - start >= budget: break
+            self._receive(sector)
+        done = [sector for sector, (version, future) in self.pending.items() if future.done()]
+        for sector in sorted(done, key=self.queue.distance):
+            if time.perf_counter() - start >= budget: break
+            self._upload(sector)
+        done = [sector for sector, (step, future) in self.lod_pending.items() if future.done()]
+        for sector in sorted(done, key=self.queue.distance):
+            if time.perf_counter() - start >= budget: break
+            self._upload_lod(sector)
 
     def process_entire_queue(self):
+        while self.generating:
+            futures.wait(list(self.generating.values()), return_when=futures.FIRST_COMPLETED)
+            for sector in [sector for sector, future in self.generating.items() if future.done()]:
+                self._receive(sector)
         while self.queue: self._dequeue()
+        while self.pending:
+            futures.wait([future for version, future in self.pending.values()])
+            for sector, (version, future) in list(self.pending.items()):
+                if future.done(): self._upload(sector)
+        while self.lod_queue:
+            func, args = self.lod_queue.pop()
+            func(*args)
+        futures.wait([future for step, future in self.lod_pending.values()])
+        for sector in list(self.lod_pending):
+            self._upload_lod(sector)
 
-class Window(pyglet.window.Window):
-    def __init__(self, *args, **kwargs):
-        self.inventory_names = ["Tijolo", "Grama", "Areia"]
-        self.label = pyglet.text.Label('', font_name='Arial', font_size=18, x=10, y=10, 
-                                     anchor_x='left', anchor_y='top', color=(0, 0, 0, 255))
-        super(Window, self).__init__(*args, **kwargs)
+    def near_progress(self):
+        """(prontos, total) dos setores da distancia de visao: com malha pronta,
+        ou que nunca vao ter (fora do mundo)."""
+        done = 0
+        for sector in self.view:
+            pending = self.pending.get(sector)
+            if sector in self.shown or (pending and pending[1].done()):
+                done += 1
+            elif sector not in self.sectors and sector not in self.generating and not self.infinite:
+                done += 1
+        return done, len(self.view)
+
+    def preload(self, sector, progress=None, stop=None):
+        """Prepara o mundo em volta de `sector` fora da thread da janela: gera,
+        acende e malha os setores perto e depois o anel LOD, sem tocar na GL
+        (attach envia as malhas). `progress(prontos, total)` acompanha os setores
+        perto; `stop` (threading.Event) interrompe entre uma operacao e outra,
+        e o que faltar segue pela fila normal."""
+        self.change_sectors(None, sector)
+        while not (stop and stop.is_set()):
+            for generated in [key for key, future in self.generating.items() if future.done()]:
+                self._receive(generated)
+            done, total = self.near_progress()
+            if progress: progress(done, total)
+            if self.queue:
+                self._dequeue()
+            elif done >= total and self.lod_queue:
+                func, args = self.lod_queue.pop()
+                func(*args)
+            else:
+                waiting = list(self.generating.values()) + [future for version, future in self.pending.values()]
+                waiting += [future for step, future in self.lod_pending.values()]
+                if not any(not future.done() for future in waiting): break
+                futures.wait(waiting, timeout=0.05, return_when=futures.FIRST_COMPLETED)
+
+    def attach(self, backend):
+        """Troca o backend provisorio do preload pelo de verdade (na thread com o
+        contexto GL) e envia as malhas que ja ficaram prontas."""
+        self.backend = backend
+        for sector in [key for key, (version, future) in self.pending.items() if future.done()]:
+            self._upload(sector)
+        for sector in [key for key, (step, future) in self.lod_pending.items() if future.done()]:
+            self._upload_lod(sector)
+        return self
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.generator: self.generator.shutdown(wait=False, cancel_futures=True)
+        try:
+            if self.journal: self.journal.close()
+        finally:
+            self.save()
+        # Tudo ja esta nas regioes: o diario so serviria para uma sessao interrompida.
+        if self.journal: self.journal.discard()
+
+class Loader(object):
+    """Prepara o Model numa thread enquanto o menu esta aberto (Model.preload).
+
+    `ready` e sinalizado quando os setores perto do spawn tem malha (ou se a
+    preparacao falhou); finish() para a thread, entrega o modelo com o backend
+    de verdade e o resto do mundo continua chegando pela fila normal.
+    """
+
+    def __init__(self, seed=None, infinite=False, renderer='quads', record=False):
+        self.renderer = renderer
+        self.progress = (0, 1)
+        self.model = None
+        self.error = None
+        self.ready = threading.Event()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(seed, save_path(infinite, record), infinite))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, seed, path, infinite):
+        try:
+            self.model = Model(seed=seed, path=path, infinite=infinite,
+                               backend=render.DeferredBackend(render.BACKENDS[self.renderer]))
+            self.model.preload(sectorize((0, 0, 0)), self._progress, self.stop)
+        except Exception as error:
+            self.error = error
+        self.ready.set()
+
+    def _progress(self, done, total):
+        self.progress = (done, total)
+        if done >= total: self.ready.set()
+
+    def finish(self, backend):
+        self.stop.set()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.model.attach(backend)
+
+class Player(object):
+    """Estado e controles do jogador: teclas, mouse e o tick do Model com a
+    fisica. Nao toca em janela nem GL, entao o replay (replay.py) roda o
+    mesmo codigo sem display; a Window herda daqui.
+    """
+
+    def setup_player(self, model, preloaded=False, recorder=None):
+        self.model = model
+        self.preloaded = preloaded
+        self.recorder = recorder
         self.exclusive = False
         self.flying = False
         self.strafe = [0, 0]
-        self.position = (0, 0, 0)
         self.rotation = (0, 0)
         self.sector = None
-        self.reticle = None
-        self.dy = 0
+        self.focus = (None, (None, None))
+        self.update_cost = 0.0
+        self.profiler = profiler.Profiler()
+        self.overlay = False
+        # (texto, ate quando) do aviso mostrado no HUD.
+        self.status = ('', 0.0)
         self.inventory = [BRICK, GRASS, SAND]
         self.block = self.inventory[0]
         self.num_keys = [key._1, key._2, key._3, key._4, key._5, key._6, key._7, key._8, key._9, key._0]
-        self.model = Model()
-        self.label.y = self.height - 10
-        pyglet.clock.schedule_interval(self.update, 1.0 / TICKS_PER_SEC)
+        spawn = int(terrain.height(self.model.seed, 0, 0)) + PLAYER_HEIGHT if self.model.infinite else 0
+        self.player = self.model.entities.add((0, spawn, 0), PLAYER_HEIGHT)
 
-    def set_exclusive_mouse(self, exclusive):
-        super(Window, self).set_exclusive_mouse(exclusive)
-        self.exclusive = exclusive
+    # O jogador e so um dos corpos de model.entities.
+    @property
+    def position(self):
+        return tuple(self.model.entities.position[self.player].tolist())
+
+    @position.setter
+    def position(self, position):
+        self.model.entities.position[self.player] = position
+
+    @property
+    def dy(self):
+        return float(self.model.entities.dy[self.player])
+
+    @dy.setter
+    def dy(self, dy):
+        self.model.entities.dy[self.player] = dy
 
     def get_sight_vector(self):
         x, y = self.rotation
@@ -260,6 +784,13 @@ class Window(pyglet.window.Window):
         dz = math.sin(math.radians(x - 90)) * m
         return (dx, dy, dz)
 
+    def get_focused_block(self):
+        # Com a camera parada e o mundo inalterado o resultado nao muda entre frames.
+        key = (self.position, self.rotation, self.model.world.edits)
+        if self.focus[0] != key:
+            self.focus = (key, self.model.hit_test(self.position, self.get_sight_vector()))
+        return self.focus[1]
+
     def get_motion_vector(self):
         if any(self.strafe):
             x, y = self.rotation
@@ -277,47 +808,28 @@ class Window(pyglet.window.Window):
         return (dx, dy, dz)
 
     def update(self, dt):
-        self.model.process_queue()
+        with self.profiler.section('process_queue'):
+            self.model.process_queue()
+        start = time.perf_counter()
         sector = sectorize(self.position)
         if sector != self.sector:
-            self.model.change_sectors(self.sector, sector)
-            if self.sector is None: self.model.process_entire_queue()
+            with self.profiler.section('change_sectors'):
+                self.model.change_sectors(self.sector, sector)
+                if self.sector is None and not self.preloaded: self.model.process_entire_queue()
             self.sector = sector
         dt = min(dt, 0.2)
-        for _ in xrange(8): self._update(dt / 8)
-
-    def _update(self, dt):
-        speed = FLYING_SPEED if self.flying else WALKING_SPEED
-        d = dt * speed
-        dx, dy, dz = self.get_motion_vector()
-        dx, dy, dz = dx * d, dy * d, dz * d
-        if not self.flying:
-            self.dy -= dt * GRAVITY
-            self.dy = max(self.dy, -TERMINAL_VELOCITY)
-            dy += self.dy * dt
-        self.position = self.collide((self.position[0] + dx, self.position[1] + dy, self.position[2] + dz), PLAYER_HEIGHT)
-
-    def collide(self, position, height):
-        pad, p, np = 0.25, list(position), normalize(position)
-        for face in FACES:
-            for i in xrange(3):
-                if not face[i]: continue
-                d = (p[i] - np[i]) * face[i]
-                if d < pad: continue
-                for dy in xrange(height):
-                    op = list(np)
-                    op[1] -= dy
-                    op[i] += face[i]
-                    if tuple(op) not in self.model.world: continue
-                    p[i] -= (d - pad) * face[i]
-                    if face[1]: self.dy = 0
-                    break
-        return tuple(p)
+        entities = self.model.entities
+        entities.motion[self.player] = self.get_motion_vector()
+        entities.speed[self.player] = FLYING_SPEED if self.flying else WALKING_SPEED
+        entities.flying[self.player] = self.flying
+        with self.profiler.section('physics'):
+            entities.update(dt)
+        self.update_cost = time.perf_counter() - start
+        if self.recorder: self.recorder.tick(dt, self.position, self.rotation, self.dy)
 
     def on_mouse_press(self, x, y, button, modifiers):
         if self.exclusive:
-            vector = self.get_sight_vector()
-            block, previous = self.model.hit_test(self.position, vector)
+            block, previous = self.get_focused_block()
             if (button == mouse.RIGHT) or (button == mouse.LEFT and modifiers & key.MOD_CTRL):
                 if previous: self.model.add_block(previous, self.block)
             elif button == mouse.LEFT and block:
@@ -339,6 +851,10 @@ class Window(pyglet.window.Window):
         elif symbol == key.SPACE and self.dy == 0: self.dy = JUMP_SPEED
         elif symbol == key.ESCAPE: self.set_exclusive_mouse(False)
         elif symbol == key.TAB: self.flying = not self.flying
+        elif symbol == key.F3: self.overlay = not self.overlay
+        elif symbol == key.F2:
+            path = self.profiler.dump(time.strftime(TRACE_PATH))
+            self.status = ('trace salvo em %s' % path, time.perf_counter() + STATUS_SECONDS)
         elif symbol in self.num_keys:
             self.block = self.inventory[(symbol - self.num_keys[0]) % len(self.inventory)]
 
@@ -348,8 +864,46 @@ class Window(pyglet.window.Window):
         elif symbol == key.A: self.strafe[1] += 1
         elif symbol == key.D: self.strafe[1] -= 1
 
+class Window(Player, pyglet.window.Window):
+    def __init__(self, *args, **kwargs):
+        seed, infinite = kwargs.pop('seed', None), kwargs.pop('infinite', False)
+        renderer = kwargs.pop('renderer', 'quads')
+        loader = kwargs.pop('loader', None)
+        record = kwargs.pop('record', None)
+        self.inventory_names = ["Tijolo", "Grama", "Areia"]
+        self.label = pyglet.text.Label('', font_name='Arial', font_size=18, x=10, y=10, 
+                                     anchor_x='left', anchor_y='top', color=(0, 0, 0, 255))
+        self.timings = pyglet.text.Label('', font_name='Courier New', font_size=11, x=10, y=10, width=400,
+                                         multiline=True, anchor_x='left', anchor_y='top', color=(0, 0, 0, 255))
+        super(Window, self).__init__(*args, **kwargs)
+        self.reticle = None
+        self.last_frame = None
+        if loader is not None:
+            # Mundo ja preparado durante o menu: so falta enviar as malhas.
+            model = loader.finish(render.BACKENDS[loader.renderer](TEXTURE_PATH))
+        else:
+            model = Model(seed=seed, path=save_path(infinite, record is not None), infinite=infinite,
+                          backend=render.BACKENDS[renderer](TEXTURE_PATH))
+        recorder = None
+        if record is not None:
+            recorder = recording.Recorder(record, model.seed, model.infinite)
+            self.push_handlers(recorder)
+        self.setup_player(model, loader is not None, recorder)
+        self.label.y = self.height - 10
+        pyglet.clock.schedule_interval(self.update, 1.0 / TICKS_PER_SEC)
+
+    def on_close(self):
+        self.model.close()
+        if self.recorder: self.recorder.close()
+        super(Window, self).on_close()
+
+    def set_exclusive_mouse(self, exclusive):
+        super(Window, self).set_exclusive_mouse(exclusive)
+        self.exclusive = exclusive
+
     def on_resize(self, width, height):
         self.label.y = height - 10
+        self.timings.y = height - 40
         if self.reticle: self.reticle.delete()
         x, y, n = width // 2, height // 2, 10
         self.reticle = pyglet.graphics.vertex_list(4, ('v2i', (x - n, y, x + n, y, x, y - n, x, y + n)))
@@ -370,7 +924,7 @@ class Window(pyglet.window.Window):
         glViewport(0, 0, *self.get_viewport_size())
         glMatrixMode(GL_PROJECTION)
         glLoadIdentity()
-        gluPerspective(65.0, width / float(height), 0.1, 60.0)
+        gluPerspective(FOV, width / float(height), NEAR, FAR)
         glMatrixMode(GL_MODELVIEW)
         glLoadIdentity()
         x, y = self.rotation
@@ -379,17 +933,29 @@ class Window(pyglet.window.Window):
         glTranslatef(*[-pos for pos in self.position])
 
     def on_draw(self):
+        start = time.perf_counter()
+        # Tempo de frame: de um on_draw ao proximo.
+        if self.last_frame is not None: self.profiler.record('frame', self.last_frame, start - self.last_frame)
+        self.last_frame = start
         self.clear()
         self.set_3d()
         glColor3d(1, 1, 1)
-        self.model.batch.draw()
-        self.draw_focused_block()
-        self.set_2d()
-        self.draw_label()
-        self.draw_reticle()
+        width, height = self.get_size()
+        with self.profiler.section('draw'):
+            self.model.draw(frustum.planes(self.position, self.rotation, FOV, width / float(height), NEAR, FAR),
+                            self.model.visible_sectors(self.position))
+        with self.profiler.section('focused_block'):
+            self.draw_focused_block()
+        with self.profiler.section('hud'):
+            self.set_2d()
+            self.draw_label()
+            self.draw_reticle()
+            if self.overlay: self.draw_overlay()
+        # O que sobra do frame vira orcamento para a fila do modelo no proximo tick.
+        self.model.budget.record(self.update_cost + time.perf_counter() - start)
 
     def draw_focused_block(self):
-        block = self.model.hit_test(self.position, self.get_sight_vector())[0]
+        block = self.get_focused_block()[0]
         if block:
             vertex_data = cube_vertices(block[0], block[1], block[2], 0.51)
             glColor3d(0, 0, 0)
@@ -399,10 +965,34 @@ class Window(pyglet.window.Window):
 
     def draw_label(self):
         x, y, z = self.position
-        self.label.text = '%02d (%.2f, %.2f, %.2f) %d / %d' % (
-            pyglet.clock.get_fps(), x, y, z, len(self.model._shown), len(self.model.world))
+        self.label.text = '%02d (%.2f, %.2f, %.2f) %d / %d  culled: %d setores, %d faces  ocultos: %d, %d' % (
+            pyglet.clock.get_fps(), x, y, z, sum(self.model.shown.values()) + sum(self.model.lods.values()),
+            len(self.model.world),
+            self.model.culled[0], self.model.culled[1], self.model.occluded[0], self.model.occluded[1])
+        text, until = self.status
+        if time.perf_counter() < until: self.label.text += '  ' + text
         self.label.draw()
 
+    def draw_overlay(self):
+        # p50/p99 de cada etapa e grafico dos ultimos frames, com a linha dos 60 fps.
+        lines = ['%-15s %7s %7s' % ('etapa (ms)', 'p50', 'p99')]
+        for name in STAGES + ['frame']:
+            p50, p99 = self.profiler.percentiles(name)
+            lines.append('%-15s %7.2f %7.2f' % (name, p50 * 1000, p99 * 1000))
+        self.timings.text = '\n'.join(lines)
+        self.timings.draw()
+        frames = self.profiler.durations('frame')[-GRAPH_FRAMES:] * 1000 * GRAPH_SCALE
+        x0, y0 = 10, 10
+        target = y0 + 1000.0 / TICKS_PER_SEC * GRAPH_SCALE
+        glColor3d(1, 0, 0)
+        pyglet.graphics.draw(2, GL_LINES, ('v2f', (x0, target, x0 + GRAPH_FRAMES, target)))
+        if len(frames) > 1:
+            glColor3d(0, 0, 0)
+            points = numpy.empty((len(frames), 2))
+            points[:, 0] = x0 + numpy.arange(len(frames))
+            points[:, 1] = y0 + frames
+            pyglet.graphics.draw(len(frames), GL_LINE_STRIP, ('v2f', points.ravel().tolist()))
+
     def draw_reticle(self):
         if self.reticle:
             glColor3d(0, 0, 0)
@@ -413,8 +1003,8 @@ def setup_fog():
     glFogfv(GL_FOG_COLOR, (GLfloat * 4)(0.5, 0.69, 1.0, 1))
     glHint(GL_FOG_HINT, GL_DONT_CARE)
     glFogi(GL_FOG_MODE, GL_LINEAR)
-    glFogf(GL_FOG_START, 20.0)
-    glFogf(GL_FOG_END, 60.0)
+    glFogf(GL_FOG_START, FAR / 3)
+    glFogf(GL_FOG_END, FAR)
 
 def setup():
     glClearColor(0.5, 0.69, 1.0, 1)
@@ -423,8 +1013,23 @@ def setup():
     glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
     setup_fog()
 
-def main():
-    window = Window(width=800, height=600, caption='Pyglet', resizable=True)
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--infinite', action='store_true', help='mundo infinito gerado sob demanda')
+    parser.add_argument('--seed', type=int, help='seed do terreno')
+    parser.add_argument('--renderer', choices=sorted(render.BACKENDS), default='quads',
+                        help='quads: GL_QUADS no pipeline fixo; instanced: shader com uma chamada por setor')
+    parser.add_argument('--record', metavar='ARQUIVO',
+                        help='grava a seed e as entradas de cada tick (sem carregar nem salvar o mundo); '
+                             'rode de novo com python replay.py ARQUIVO')
+    args, _ = parser.parse_known_args()
+    return args
+
+def main(loader=None):
+    args = parse_args()
+    window = Window(width=800, height=600, caption='Pyglet', resizable=True,
+                    seed=args.seed, infinite=args.infinite, renderer=args.renderer, loader=loader,
+                    record=args.record)
     window.set_exclusive_mouse(True)
     setup()
     pyglet.app.run()
@@ -1,4 +1,7 @@
 import pyglet
+import multiprocessing
+# Os workers do gerador (forkserver) importam de novo o script de entrada: neles não há janela.
+if multiprocessing.current_process().name != 'MainProcess': pyglet.options['shadow_window'] = False
 from pyglet.window import mouse, key # Importado 'key' para o atalho de tela cheia
 import os
 import webbrowser
@@ -62,6 +65,13 @@ class Menu:
                                   font_name='Arial', font_size=28,
                                   anchor_x='center', batch=self.batch)
 
+        # O mundo começa a ser gerado já com o menu aberto; JOGAR só espera o que faltar.
+        self.loader = main.Loader(**self.loader_options())
+        self.starting = False
+        self.progress_label = pyglet.text.Label('',
+                                  font_name='Arial', font_size=14,
+                                  anchor_x='center', batch=self.batch)
+
         self.credits_batch = pyglet.graphics.Batch()
         
         self.credits_title = pyglet.text.Label('CRÉDITOS',
@@ -89,6 +99,7 @@ class Menu:
 
         self.show_credits = False
         pyglet.clock.schedule_interval(self.change_subtitle, 5.0)
+        pyglet.clock.schedule_interval(self.update_progress, 0.1)
         
         # Registro de eventos atualizado
         self.window.push_handlers(
@@ -111,6 +122,7 @@ class Menu:
         self.start_label.x, self.start_label.y = cx, cy + 50
         self.credits_label.x, self.credits_label.y = cx, cy - 20
         self.exit_label.x, self.exit_label.y = cx, cy - 90
+        self.progress_label.x, self.progress_label.y = cx, 30
 
         # Créditos
         self.credits_title.x, self.credits_title.y = cx, height - 100
@@ -126,6 +138,29 @@ class Menu:
 
     # --- FIM DAS NOVAS FUNÇÕES ---
 
+    def loader_options(self):
+        args = main.parse_args()
+        return {'seed': args.seed, 'infinite': args.infinite, 'renderer': args.renderer,
+                'record': args.record is not None}
+
+    def update_progress(self, dt):
+        """Mostra quanto do mundo em volta do spawn já está pronto e, depois do
+        clique em JOGAR, abre o jogo assim que estiver."""
+        if self.loader.ready.is_set():
+            self.progress_label.text = 'Mundo pronto'
+            if self.starting:
+                self.start_game()
+            return
+        done, total = self.loader.progress
+        text = 'Gerando mundo: %d%%' % (100 * done // max(total, 1))
+        self.progress_label.text = text + (' (aguarde...)' if self.starting else '')
+
+    def start_game(self):
+        pyglet.clock.unschedule(self.update_progress)
+        pyglet.clock.unschedule(self.change_subtitle)
+        self.window.close()
+        main.main(self.loader)
+
     def change_subtitle(self, dt):
         self.current_subtitle = (self.current_subtitle + 1) % len(self.subtitle_messages)
         self.subtitle_label.text = self.subtitle_messages[self.current_subtitle]
@@ -182,8 +217,8 @@ class Menu:
             
             if not self.show_credits:
                 if self.update_button_hover(self.start_label, x, y):
-                    self.window.close()
-                    main.main()
+                    self.starting = True
+                    self.update_progress(0)
                 elif self.update_button_hover(self.credits_label, x, y):
                     self.show_credits = True
                 elif self.update_button_hover(self.exit_label, x, y):
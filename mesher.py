@@ -0,0 +1,201 @@
+import numpy
+
+from blocks import BLOCKS
+from world import SECTOR_SIZE, WORLD_HEIGHT, FACES
+from light import MAX_LIGHT
+
+TILES = 4
+
+# Brilho (0-255) de uma face em cada nivel de luz; luz cheia mantem a textura original.
+SHADES = [int(round(255 * max(0.8 ** (MAX_LIGHT - level), 0.08))) for level in range(MAX_LIGHT + 1)]
+
+# Cantos de cada face na mesma ordem de main.cube_vertices (anti-horario visto de fora).
+CORNERS = [
+    ((-1, 1, -1), (-1, 1, 1), (1, 1, 1), (1, 1, -1)),  # top
+    ((-1, -1, -1), (1, -1, -1), (1, -1, 1), (-1, -1, 1)),  # bottom
+    ((-1, -1, -1), (-1, -1, 1), (-1, 1, 1), (-1, 1, -1)),  # left
+    ((1, -1, 1), (1, -1, -1), (1, 1, -1), (1, 1, 1)),  # right
+    ((-1, -1, 1), (1, -1, 1), (1, 1, 1), (-1, 1, 1)),  # front
+    ((1, -1, -1), (-1, -1, -1), (-1, 1, -1), (1, 1, -1)),  # back
+]
+
+# Eixos u (canto 0 -> 1) e v (canto 1 -> 2) de cada face, usados para repetir a textura.
+UV_AXES = [
+    ([i for i in range(3) if c[0][i] != c[1][i]][0], [i for i in range(3) if c[1][i] != c[2][i]][0])
+    for c in CORNERS
+]
+
+_tile_table = (0, None)
+
+def tile_table():
+    """Tabela [id do bloco, face] -> indice do tile no atlas (y * TILES + x)."""
+    global _tile_table
+    if _tile_table[0] != len(BLOCKS):
+        table = numpy.full((256, 6), -1, dtype=numpy.int16)
+        for block in BLOCKS[1:]:
+            top, bottom, side = block.tiles
+            for face, (x, y) in enumerate((top, bottom, side, side, side, side)):
+                table[block.id, face] = y * TILES + x
+        _tile_table = (len(BLOCKS), table)
+    return _tile_table[1]
+
+def greedy(grid):
+    """Junta celulas vizinhas com o mesmo tile em retangulos. Consome `grid`."""
+    rows, cols = len(grid), len(grid[0])
+    for i in range(rows):
+        row = grid[i]
+        j = 0
+        while j < cols:
+            tile = row[j]
+            if tile < 0:
+                j += 1
+                continue
+            w = 1
+            while j + w < cols and row[j + w] == tile:
+                w += 1
+            h, span = 1, [tile] * w
+            while i + h < rows and grid[i + h][j:j + w] == span:
+                h += 1
+            empty = [-1] * w
+            for k in range(i, i + h):
+                grid[k][j:j + w] = empty
+            yield i, j, h, w, tile
+            j += w
+
+def build(blocks, masks, levels, origin):
+    """Gera os quads das faces expostas de um setor.
+
+    A face i de um bloco e emitida quando o bit i de `masks` (vizinho solido)
+    esta zerado. `levels` e a luz do setor com borda (light.padded); cada face
+    recebe a luz da celula para a qual aponta, e so faces com o mesmo tile e
+    a mesma luz sao juntadas. Cada quad e (face, tile, lo, hi, luz), com lo/hi
+    sendo os blocos extremos (inclusive) cobertos pelo quad em coordenadas do mundo.
+    """
+    S, H = SECTOR_SIZE, WORLD_HEIGHT
+    solid = blocks != 0
+    table = tile_table()
+    quads = []
+    for face, (dx, dy, dz) in enumerate(FACES):
+        exposed = solid & ((masks & (1 << face)) == 0)
+        if not exposed.any():
+            continue
+        axis = [dx, dy, dz].index(dx + dy + dz)
+        others = [i for i in range(3) if i != axis]
+        lit = levels[1 + dx:S + 1 + dx, 1 + dy:H + 1 + dy, 1 + dz:S + 1 + dz]
+        keys = numpy.where(exposed, table[blocks, face] * (MAX_LIGHT + 1) + lit, -1)
+        keys = numpy.moveaxis(keys, axis, 0)
+        for layer in numpy.nonzero(exposed.any(axis=tuple(others)))[0].tolist():
+            for i, j, h, w, key in greedy(keys[layer].tolist()):
+                lo, hi = [0, 0, 0], [0, 0, 0]
+                lo[axis] = hi[axis] = layer + origin[axis]
+                lo[others[0]], hi[others[0]] = i + origin[others[0]], i + h - 1 + origin[others[0]]
+                lo[others[1]], hi[others[1]] = j + origin[others[1]], j + w - 1 + origin[others[1]]
+                quads.append((face, key // (MAX_LIGHT + 1), lo, hi, key % (MAX_LIGHT + 1)))
+    return quads
+
+def heightmap(blocks):
+    """Resumo de um setor para as malhas LOD: a altura (y relativo ao fundo do
+    setor, -1 para coluna vazia) e o ID do bloco mais alto de cada coluna."""
+    solid = blocks != 0
+    heights = WORLD_HEIGHT - 1 - numpy.argmax(solid[:, ::-1], axis=1)
+    heights[~solid.any(axis=1)] = -1
+    tops = numpy.take_along_axis(blocks, numpy.maximum(heights, 0)[:, None], axis=1)[:, 0]
+    return heights.astype(numpy.int16), tops
+
+def lod(heights, tops, origin, step):
+    """Quads simplificados de um setor distante, feitos so do mapa de alturas.
+
+    Cada celula de step x step colunas vira um topo na altura da coluna mais
+    alta (com o bloco dela), mais paredes descendo ate cada celula vizinha mais
+    baixa. `heights` traz uma borda de `step` colunas dos setores vizinhos;
+    `tops` e so o do setor. Mesmo formato de quad de build().
+    """
+    n, m, T = SECTOR_SIZE // step, SECTOR_SIZE // step + 2, TILES * TILES
+    blocks = heights.astype(numpy.int64).reshape(m, step, m, step)
+    cells = blocks.max(axis=(1, 3))
+    height = cells[1:-1, 1:-1]
+    # O vizinho de outro setor pode ter celulas menores (e mais baixas): a
+    # parede ate ele desce ate a coluna mais baixa da borda, sem deixar fresta.
+    lows = blocks.min(axis=(1, 3))
+    for edge in ((0,), (-1,), (slice(None), 0), (slice(None), -1)):
+        cells[edge] = lows[edge]
+    inner = heights[step:-step, step:-step].reshape(n, step, n, step).transpose(0, 2, 1, 3).reshape(n, n, -1)
+    ids = tops.reshape(n, step, n, step).transpose(0, 2, 1, 3).reshape(n, n, -1)
+    ids = numpy.take_along_axis(ids, inner.argmax(axis=2)[..., None], axis=2)[..., 0]
+    table = tile_table()
+    ox, oy, oz = origin
+    quads = []
+    keys = numpy.where(height >= 0, height * T + table[ids, 0], -1)
+    for i, j, h, w, key in greedy(keys.tolist()):
+        y = oy + key // T
+        quads.append((0, key % T, (ox + i * step, y, oz + j * step),
+                      (ox + (i + h) * step - 1, y, oz + (j + w) * step - 1), MAX_LIGHT))
+    for face in (2, 3, 4, 5):
+        dx, _, dz = FACES[face]
+        below = cells[1 + dx:m - 1 + dx, 1 + dz:m - 1 + dz]
+        walls = numpy.where(height > below, (height * WORLD_HEIGHT + below + 1) * T + table[ids, face], -1)
+        # Paredes so se juntam ao longo do proprio plano: uma linha de celulas por vez.
+        for a, line in enumerate((walls if dx else walls.T).tolist()):
+            for _, b, _, w, key in greedy([line]):
+                top, bottom, tile = key // T // WORLD_HEIGHT, key // T % WORLD_HEIGHT, key % T
+                (i0, i1), (j0, j1) = ((a, a + 1), (b, b + w)) if dx else ((b, b + w), (a, a + 1))
+                lo = [ox + i0 * step, oy + bottom, oz + j0 * step]
+                hi = [ox + i1 * step - 1, oy + top, oz + j1 * step - 1]
+                if dx: lo[0] = hi[0] = hi[0] if dx > 0 else lo[0]
+                else: lo[2] = hi[2] = hi[2] if dz > 0 else lo[2]
+                quads.append((face, tile, lo, hi, MAX_LIGHT))
+    return quads
+
+def vertex_data(quads, depth=TILES * TILES):
+    """Converte quads em listas v3f/t3f/c3B para GL_QUADS, com o tile na coordenada r
+    e a luz da face como cor dos vertices."""
+    vertices, tex_coords, colors = [], [], []
+    for face, tile, lo, hi, light in quads:
+        u, v = UV_AXES[face]
+        du, dv = hi[u] - lo[u] + 1, hi[v] - lo[v] + 1
+        r = (tile + 0.5) / depth
+        for corner in CORNERS[face]:
+            for k in (0, 1, 2):
+                vertices.append((hi[k] + 0.5) if corner[k] > 0 else (lo[k] - 0.5))
+        tex_coords.extend((0, 0, r, du, 0, r, du, dv, r, 0, dv, r))
+        colors.extend((SHADES[light],) * 12)
+    return vertices, tex_coords, colors
+
+def bounds(quads):
+    """Caixa (lo, hi) que envolve os quads, usada no frustum culling."""
+    if not quads:
+        return None
+    lo = [min(quad[2][k] for quad in quads) - 0.5 for k in (0, 1, 2)]
+    hi = [max(quad[3][k] for quad in quads) + 0.5 for k in (0, 1, 2)]
+    return lo, hi
+
+def instance_data(quads, origin):
+    """Empacota cada quad em 8 bytes para o renderer instanciado:
+    (lo - origin, face | tile << 3, hi - origin, luz), com coordenadas relativas ao setor."""
+    data = numpy.zeros((len(quads), 8), dtype=numpy.uint8)
+    if quads:
+        data[:, 3] = [quad[0] | quad[1] << 3 for quad in quads]
+        data[:, 7] = [quad[4] for quad in quads]
+        data[:, 0:3] = numpy.array([quad[2] for quad in quads]) - origin
+        data[:, 4:7] = numpy.array([quad[3] for quad in quads]) - origin
+    return data
+
+def mesh(blocks, masks, levels, origin, depth=TILES * TILES):
+    """Ponto de entrada dos workers: so usa a copia recebida, nunca o mundo."""
+    quads = build(blocks, masks, levels, origin)
+    return len(quads), vertex_data(quads, depth), bounds(quads)
+
+def instances(blocks, masks, levels, origin, depth=TILES * TILES):
+    """Como mesh(), mas devolve os dados por instancia e a origem do setor."""
+    quads = build(blocks, masks, levels, origin)
+    return len(quads), (instance_data(quads, origin), origin), bounds(quads)
+
+def lod_mesh(heights, tops, origin, step, depth=TILES * TILES):
+    """Como mesh(), para a malha simplificada de lod()."""
+    quads = lod(heights, tops, origin, step)
+    return len(quads), vertex_data(quads, depth), bounds(quads)
+
+def lod_instances(heights, tops, origin, step, depth=TILES * TILES):
+    """Como instances(), para a malha simplificada de lod()."""
+    quads = lod(heights, tops, origin, step)
+    return len(quads), (instance_data(quads, origin), origin), bounds(quads)
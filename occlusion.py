@@ -0,0 +1,96 @@
+import collections
+
+import numpy
+
+from world import SECTOR_SIZE, WORLD_HEIGHT, FACES
+
+# Conectividade de um setor: para cada face i (na ordem de FACES), os bits j
+# das faces que o ar do setor liga a ela. Um setor desconhecido (sem malha,
+# LOD ou fora do mundo) conta como todo aberto.
+OPEN = (0x3F,) * 6
+
+# Faces laterais: so por elas se passa de um setor (uma coluna inteira) para outro.
+SIDES = [i for i, (dx, dy, dz) in enumerate(FACES) if dy == 0]
+
+_BORDERS = [
+    (slice(None), -1), (slice(None), 0),  # top, bottom
+    (0,), (-1,),  # left, right
+    (slice(None), slice(None), -1), (slice(None), slice(None), 0),  # front, back
+]
+
+def components(blocks):
+    """Rotula as regioes conexas de ar do setor (vizinhanca de 6).
+
+    Cada celula de ar comeca com o proprio indice e fica com o menor rotulo
+    do trecho reto de ar em que esta, um eixo por vez, ate nada mudar: cada
+    rodada atravessa uma curva do caminho, entao terreno aberto converge em
+    poucas rodadas. Retorna (labels, faces), com labels -1 nos blocos e
+    faces[rotulo] = bits das faces do setor que a regiao toca.
+    """
+    air = blocks == 0
+    labels = numpy.where(air, numpy.arange(air.size).reshape(air.shape), -1)
+    sweeps = []
+    for axis in (1, 0, 2):
+        order = [k for k in (0, 1, 2) if k != axis] + [axis]
+        lines = air.transpose(order).reshape(-1, air.shape[axis])
+        starts = lines & ~numpy.pad(lines[:, :-1], ((0, 0), (1, 0)))
+        cells = numpy.flatnonzero(lines)
+        first = numpy.flatnonzero(starts.ravel()[cells])
+        sweeps.append((order, cells, first, numpy.diff(numpy.append(first, len(cells)))))
+    changed = True
+    while changed:
+        changed = False
+        for order, cells, first, lengths in sweeps:
+            flat = labels.transpose(order).ravel()
+            values = flat[cells]
+            merged = numpy.repeat(numpy.minimum.reduceat(values, first), lengths)
+            if (merged != values).any():
+                changed = True
+                flat[cells] = merged
+                labels = flat.reshape([labels.shape[k] for k in order]).transpose(numpy.argsort(order))
+    faces = collections.defaultdict(int)
+    for face, border in enumerate(_BORDERS):
+        for label in numpy.unique(labels[border]).tolist():
+            if label >= 0:
+                faces[label] |= 1 << face
+    return labels, dict(faces)
+
+def connectivity(blocks):
+    """Tupla com, para cada face, os bits das faces ligadas a ela pelo ar do setor."""
+    links = [0] * 6
+    for bits in components(blocks)[1].values():
+        for face in range(6):
+            if bits & (1 << face):
+                links[face] |= bits
+    return tuple(links)
+
+def visible(start, faces, links, radius):
+    """Setores que podem aparecer a partir do setor `start`, cujo ar em volta
+    da camera toca as faces `faces` (bits).
+
+    Busca em largura pelas faces laterais: entra-se num vizinho pela face
+    oposta e sai-se dele so pelas faces que o ar liga a ela. Uma linha de
+    visao nunca volta num eixo, entao a busca tambem nao anda no sentido
+    contrario de um passo ja dado. `links(setor)` da a conectividade.
+    """
+    x0, _, z0 = start
+    seen, states = set([start]), set()
+    queue = collections.deque([(start, faces, 0)])
+    while queue:
+        (x, y, z), exits, taken = queue.popleft()
+        for face in SIDES:
+            dx, _, dz = FACES[face]
+            if not exits & (1 << face) or taken & (1 << (face ^ 1)):
+                continue
+            sector = (x + dx, y, z + dz)
+            if max(abs(sector[0] - x0), abs(sector[2] - z0)) > radius:
+                continue
+            # Um setor pode ser revisitado por outra face ou com outros passos:
+            # so assim a busca nunca esconde o que uma linha de visao alcanca.
+            state = (sector, face, taken | (1 << face))
+            if state in states:
+                continue
+            states.add(state)
+            seen.add(sector)
+            queue.append((sector, links(sector)[face ^ 1], state[2]))
+    return seen
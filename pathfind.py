@@ -0,0 +1,298 @@
+import heapq
+
+import numpy
+
+from blocks import AIR
+from physics import PLAYER_HEIGHT
+from world import SECTOR_SIZE, WORLD_BOTTOM, WORLD_HEIGHT, normalize
+
+S, H = SECTOR_SIZE, WORLD_HEIGHT
+# Passos laterais; subir ou descer um bloco por passo (com espaco para a cabeca).
+STEPS = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+# Quantas celulas abaixo da posicao pedida procurar o chao.
+GROUND = 3
+# Nos expandidos na busca entre portais antes de desistir.
+MAX_NODES = 4096
+
+def _cost(a, b):
+    """Limite inferior de passos entre duas celulas: cada passo anda 1 em x ou z e ate 1 em y."""
+    return max(abs(a[0] - b[0]) + abs(a[2] - b[2]), abs(a[1] - b[1]))
+
+def _union(parent, a, b):
+    while parent[a] != a:
+        parent[a] = a = parent[parent[a]]
+    while parent[b] != b:
+        parent[b] = b = parent[parent[b]]
+    if a != b:
+        parent[max(a, b)] = min(a, b)
+
+class Local(object):
+    """O que um setor permite andar: `walk[x, y, z]` e uma celula de pe (chao
+    solido embaixo e PLAYER_HEIGHT de ar), `tall` uma delas com mais um de
+    ar acima (de onde se sobe um degrau ou para onde se desce), e `regions`
+    o rotulo da regiao conexa de cada celula de pe dentro do setor (-1 fora).
+    """
+
+    def __init__(self, sector):
+        self.sector = sector
+        air = numpy.ones((S, H + PLAYER_HEIGHT + 1, S), dtype=bool)
+        air[:, :H] = sector.blocks == AIR
+        walk = numpy.zeros((S, H, S), dtype=bool)
+        walk[:, 1:] = ~air[:, :H - 1]
+        for dy in range(PLAYER_HEIGHT):
+            walk &= air[:, dy:H + dy]
+        self.walk = walk
+        self.tall = walk & air[:, PLAYER_HEIGHT:H + PLAYER_HEIGHT]
+        self.regions = self._label()
+
+    def _pairs(self):
+        # Pares de celulas vizinhas ligadas por um passo: mesmo y, ou degrau com
+        # a de baixo `tall`. Indices planos em (S, H, S).
+        walk, tall = self.walk, self.tall
+        index = numpy.arange(walk.size).reshape(walk.shape)
+        pairs = []
+        for axis in (0, 2):
+            a = [slice(None)] * 3
+            b = [slice(None)] * 3
+            a[axis], b[axis] = slice(None, -1), slice(1, None)
+            a, b = tuple(a), tuple(b)
+            pairs.append((index[a][walk[a] & walk[b]], index[b][walk[a] & walk[b]]))
+            lo, hi = a[:1] + (slice(None, -1),) + a[2:], b[:1] + (slice(1, None),) + b[2:]
+            up = tall[lo] & walk[hi]
+            pairs.append((index[lo][up], index[hi][up]))
+            lo, hi = b[:1] + (slice(None, -1),) + b[2:], a[:1] + (slice(1, None),) + a[2:]
+            down = tall[lo] & walk[hi]
+            pairs.append((index[lo][down], index[hi][down]))
+        return pairs
+
+    def _label(self):
+        parent = list(range(self.walk.size))
+        for a, b in self._pairs():
+            for u, v in zip(a.tolist(), b.tolist()):
+                _union(parent, u, v)
+        # Rotulo = menor indice plano da regiao, que cabe em int16 (S * H * S = 2 ** 15).
+        regions = numpy.full(self.walk.size, -1, dtype=numpy.int16)
+        cells = numpy.flatnonzero(self.walk)
+        for cell in cells.tolist():
+            root = cell
+            while parent[root] != root:
+                root = parent[root]
+            regions[cell] = root
+        return regions.reshape(self.walk.shape)
+
+class Pathfinder(object):
+    """Caminhos a pe entre celulas (o ar logo acima do chao) dos setores carregados.
+
+    Em dois niveis: cada par de setores vizinhos tem portais, um por par de
+    regioes que uma travessia da borda liga, e a busca A* roda sobre eles
+    (dentro de um setor, de um portal aos outros da mesma regiao). Depois cada
+    trecho dentro de um setor e refinado por um A* celula a celula so nele.
+
+    Os dados de um setor (Local) e os portais das bordas dele ficam em cache.
+    add_block/remove_block chamam invalidate() so para o setor alterado; setores
+    descarregados ou trocados sao percebidos pela identidade do objeto Sector.
+    """
+
+    def __init__(self, world):
+        self.world = world
+        self.locals = {}
+        self.edges = {}
+
+    def invalidate(self, position):
+        """Esquece o setor de `position` (os portais dele caem junto)."""
+        x, y, z = position
+        self.locals.pop((x // S, 0, z // S), None)
+
+    def invalidate_sectors(self, keys):
+        """Esquece os setores `keys` e as bordas deles (editados ou descartados)."""
+        keys = set(keys)
+        for key in keys:
+            self.locals.pop(key, None)
+        for edge in [edge for edge in self.edges if edge[0] in keys or edge[1] in keys]:
+            del self.edges[edge]
+
+    def local(self, key):
+        sector = self.world.sectors.get(key)
+        if sector is None:
+            return None
+        local = self.locals.get(key)
+        if local is None or local.sector is not sector:
+            local = self.locals[key] = Local(sector)
+        return local
+
+    def _edge(self, a, b):
+        """Portais entre o setor a e o vizinho b (a leste ou ao sul): lista de
+        (celula em a, celula em b), uma por par de regioes ligadas pela borda."""
+        first, second = self.local(a), self.local(b)
+        if first is None or second is None:
+            return []
+        cached = self.edges.get((a, b))
+        if cached is not None and cached[0] is first and cached[1] is second:
+            return cached[2]
+        axis = 0 if b[0] != a[0] else 2
+        def side(array, i):
+            # Fatia (S, H) da borda, indexada [u, y] com u ao longo dela.
+            return array[i].T if axis == 0 else array[:, :, i]
+        wa, ta, ra = side(first.walk, -1), side(first.tall, -1), side(first.regions, -1)
+        wb, tb, rb = side(second.walk, 0), side(second.tall, 0), side(second.regions, 0)
+        crossings = []
+        for dy, ok in ((0, wa & wb), (1, ta[:, :-1] & wb[:, 1:]), (-1, wa[:, 1:] & tb[:, :-1])):
+            u, y = numpy.nonzero(ok)
+            ya = y if dy >= 0 else y + 1
+            yb = ya + dy
+            crossings.extend(zip(ra[u, ya].tolist(), rb[u, yb].tolist(), u.tolist(), ya.tolist(), yb.tolist()))
+        groups = {}
+        for region_a, region_b, u, ya, yb in crossings:
+            groups.setdefault((region_a, region_b), []).append((u, ya, yb))
+        portals = []
+        for cells in groups.values():
+            u, ya, yb = sorted(cells)[len(cells) // 2]
+            cell_a, cell_b = [0, 0, 0], [0, 0, 0]
+            cell_a[axis], cell_b[axis] = (a[axis] + 1) * S - 1, b[axis] * S
+            other = 2 - axis
+            cell_a[other] = cell_b[other] = a[other] * S + u
+            cell_a[1], cell_b[1] = ya + WORLD_BOTTOM, yb + WORLD_BOTTOM
+            portals.append((tuple(cell_a), tuple(cell_b)))
+        self.edges[(a, b)] = (first, second, portals)
+        return portals
+
+    def portals(self, key):
+        """(celula no setor `key`, celula no vizinho) de todos os portais das quatro bordas."""
+        x, _, z = key
+        result = list(self._edge(key, (x + 1, 0, z))) + list(self._edge(key, (x, 0, z + 1)))
+        result += [(b, a) for a, b in self._edge((x - 1, 0, z), key)]
+        result += [(b, a) for a, b in self._edge((x, 0, z - 1), key)]
+        return result
+
+    def region(self, cell):
+        """(setor, regiao) da celula de pe, ou None se ela nao e de pe."""
+        x, y, z = cell
+        key = (x // S, 0, z // S)
+        local = self.local(key)
+        if local is None or not 0 <= y - WORLD_BOTTOM < H:
+            return None
+        region = int(local.regions[x % S, y - WORLD_BOTTOM, z % S])
+        return None if region < 0 else (key, region)
+
+    def ground(self, position):
+        """A celula de pe em `position` ou ate GROUND abaixo dela, ou None."""
+        x, y, z = normalize(position)
+        for cell in [(x, y - dy, z) for dy in range(GROUND + 1)]:
+            if self.region(cell) is not None:
+                return cell
+        return None
+
+    def _neighbours(self, cell, key):
+        # Passos de `cell` que ficam dentro do setor `key`.
+        local = self.locals[key]
+        x, y, z = cell
+        lx, ly, lz = x - key[0] * S, y - WORLD_BOTTOM, z - key[2] * S
+        walk, tall = local.walk, local.tall
+        for dx, dz in STEPS:
+            nx, nz = lx + dx, lz + dz
+            if not (0 <= nx < S and 0 <= nz < S):
+                continue
+            if walk[nx, ly, nz]:
+                yield (x + dx, y, z + dz)
+            if ly + 1 < H and tall[lx, ly, lz] and walk[nx, ly + 1, nz]:
+                yield (x + dx, y + 1, z + dz)
+            if ly > 0 and tall[nx, ly - 1, nz]:
+                yield (x + dx, y - 1, z + dz)
+
+    def _refine(self, start, goal, key):
+        """A* celula a celula de start a goal sem sair do setor `key`."""
+        came = {start: None}
+        cost = {start: 0}
+        heap = [(_cost(start, goal), 0, start)]
+        while heap:
+            _, g, cell = heapq.heappop(heap)
+            if cell == goal:
+                path = []
+                while cell is not None:
+                    path.append(cell)
+                    cell = came[cell]
+                return path[::-1]
+            if g > cost[cell]:
+                continue
+            for neighbour in self._neighbours(cell, key):
+                if g + 1 < cost.get(neighbour, g + 2):
+                    cost[neighbour], came[neighbour] = g + 1, cell
+                    heapq.heappush(heap, (g + 1 + _cost(neighbour, goal), g + 1, neighbour))
+        return None
+
+    def _abstract(self, start, goal, start_region, goal_region, max_nodes):
+        """A* sobre os portais: lista de celulas start, portais..., goal, ou None.
+
+        Dentro de uma regiao se vai de uma celula a qualquer portal dela (ou ao
+        objetivo) pelo custo minimo _cost; um portal leva ao outro lado da
+        borda com um passo. Os setores entram no grafo conforme a busca chega.
+        """
+        doors, partners, visited = {}, {}, set()
+        def visit(key):
+            if key in visited: return
+            visited.add(key)
+            for inside, outside in self.portals(key):
+                partners.setdefault(inside, []).append(outside)
+                doors.setdefault(self.region(inside), []).append(inside)
+
+        visit(start_region[0])
+        came = {start: None}
+        cost = {start: 0}
+        places = {start: start_region}
+        heap = [(_cost(start, goal), 0, start)]
+        expanded = 0
+        while heap and expanded < max_nodes:
+            _, g, cell = heapq.heappop(heap)
+            if cell == goal:
+                path = []
+                while cell is not None:
+                    path.append(cell)
+                    cell = came[cell]
+                return path[::-1]
+            if g > cost[cell]:
+                continue
+            expanded += 1
+            place = places[cell]
+            steps = [(door, _cost(cell, door)) for door in doors.get(place, ()) if door != cell]
+            if place == goal_region:
+                steps.append((goal, _cost(cell, goal)))
+            steps.extend((outside, 1) for outside in partners.get(cell, ()))
+            for neighbour, step in steps:
+                if neighbour not in places:
+                    places[neighbour] = self.region(neighbour)
+                    visit(places[neighbour][0])
+                if g + step < cost.get(neighbour, g + step + 1):
+                    cost[neighbour], came[neighbour] = g + step, cell
+                    heapq.heappush(heap, (g + step + _cost(neighbour, goal), g + step, neighbour))
+        return None
+
+    def find(self, start, goal, max_nodes=MAX_NODES):
+        """Caminho a pe (lista de celulas) de `start` ate `goal`, ou None.
+
+        As posicoes podem ser de corpos: cada uma cai para a celula de pe em
+        ate GROUND blocos abaixo dela.
+        """
+        start, goal = self.ground(start), self.ground(goal)
+        if start is None or goal is None:
+            return None
+        start_region, goal_region = self.region(start), self.region(goal)
+        if start_region == goal_region:
+            return self._refine(start, goal, start_region[0])
+        route = self._abstract(start, goal, start_region, goal_region, max_nodes)
+        if route is None:
+            return None
+        path = [route[0]]
+        for a, b in zip(route, route[1:]):
+            key_a, key_b = self.region(a)[0], self.region(b)[0]
+            if key_a != key_b:
+                path.append(b)
+                continue
+            piece = self._refine(a, b, key_a)
+            if piece is None:
+                return None
+            path.extend(piece[1:])
+        return path
+
+    def find_many(self, pairs, max_nodes=MAX_NODES):
+        """find() de varios (start, goal) de uma vez, com os caches compartilhados."""
+        return [self.find(start, goal, max_nodes) for start, goal in pairs]
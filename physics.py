@@ -0,0 +1,111 @@
+import math
+
+import numpy
+
+from world import FACES
+
+GRAVITY = 20.0
+MAX_JUMP_HEIGHT = 2
+JUMP_SPEED = math.sqrt(2 * GRAVITY * MAX_JUMP_HEIGHT)
+TERMINAL_VELOCITY = 50
+PLAYER_HEIGHT = 2
+# Distancia minima entre a borda do corpo e um bloco solido.
+PAD = 0.25
+SUBSTEPS = 8
+
+_FACES = numpy.array(FACES)
+_AXES = numpy.abs(_FACES).argmax(axis=1)
+_SIGNS = _FACES.sum(axis=1)
+
+class Entities(object):
+    """Corpos simulados em lote (jogador, mobs, itens), um por linha dos arrays.
+
+    `motion` e a direcao pedida pelo controle do corpo e `speed` a velocidade
+    nela; `dy` e a velocidade vertical da gravidade e dos pulos. Corpos voando
+    ignoram a gravidade. Indices de corpos removidos sao reaproveitados.
+    """
+
+    def __init__(self, world, capacity=16):
+        self.world = world
+        self.position = numpy.zeros((capacity, 3))
+        self.motion = numpy.zeros((capacity, 3))
+        self.speed = numpy.zeros(capacity)
+        self.dy = numpy.zeros(capacity)
+        self.height = numpy.ones(capacity, dtype=numpy.int64)
+        self.flying = numpy.zeros(capacity, dtype=bool)
+        self.alive = numpy.zeros(capacity, dtype=bool)
+        self.free = list(range(capacity - 1, -1, -1))
+
+    def _grow(self):
+        capacity = len(self.alive)
+        for name in ('position', 'motion', 'speed', 'dy', 'height', 'flying', 'alive'):
+            array = getattr(self, name)
+            grown = numpy.zeros((2 * capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[:capacity] = array
+            setattr(self, name, grown)
+        self.free = list(range(2 * capacity - 1, capacity - 1, -1))
+
+    def add(self, position, height=PLAYER_HEIGHT, speed=0.0, flying=False):
+        if not self.free:
+            self._grow()
+        i = self.free.pop()
+        self.position[i] = position
+        self.motion[i] = 0.0
+        self.speed[i] = speed
+        self.dy[i] = 0.0
+        self.height[i] = height
+        self.flying[i] = flying
+        self.alive[i] = True
+        return i
+
+    def remove(self, i):
+        self.alive[i] = False
+        self.free.append(i)
+
+    def __len__(self):
+        return int(numpy.count_nonzero(self.alive))
+
+    def collide(self, ids, position):
+        """Empurra os corpos `ids` em `position` ((N, 3), alterado no lugar) para fora dos blocos.
+
+        Cada face em que o corpo passou de PAD dentro da celula e testada contra
+        os blocos vizinhos em toda a altura dele; num eixo so uma das duas faces
+        pode disparar, entao as seis sao resolvidas juntas. Bater no chao ou no
+        teto zera `dy`.
+        """
+        cells = numpy.round(position).astype(numpy.int64)
+        depth = (position[:, _AXES] - cells[:, _AXES]) * _SIGNS
+        face, row = numpy.nonzero((depth >= PAD).T)
+        if not len(row):
+            return position
+        heights = self.height[ids[row]]
+        tall = int(heights.max())
+        probes = numpy.repeat(cells[row][None], tall, axis=0)
+        probes[:, numpy.arange(len(row)), _AXES[face]] += _SIGNS[face]
+        probes[:, :, 1] -= numpy.arange(tall)[:, None]
+        solid = self.world.get_many(probes.reshape(-1, 3)).reshape(tall, len(row)) != 0
+        solid &= numpy.arange(tall)[:, None] < heights
+        hit = solid.any(axis=0)
+        face, row = face[hit], row[hit]
+        axes = _AXES[face]
+        position[row, axes] -= (depth[row, face] - PAD) * _SIGNS[face]
+        self.dy[ids[row[axes == 1]]] = 0
+        return position
+
+    def step(self, dt):
+        ids = numpy.nonzero(self.alive)[0]
+        falling = ids[~self.flying[ids]]
+        self.dy[falling] = numpy.maximum(self.dy[falling] - dt * GRAVITY, -TERMINAL_VELOCITY)
+        delta = self.motion[ids] * (dt * self.speed[ids])[:, None]
+        delta[:, 1] += numpy.where(self.flying[ids], 0.0, self.dy[ids] * dt)
+        self.position[ids] = self.collide(ids, self.position[ids] + delta)
+
+    def update(self, dt):
+        """Avanca `dt` segundos em SUBSTEPS passos (mais, se algum corpo andaria mais que PAD num passo)."""
+        ids = numpy.nonzero(self.alive)[0]
+        if not len(ids):
+            return
+        reach = float((self.speed[ids] + numpy.abs(self.dy[ids])).max()) + dt * GRAVITY
+        steps = max(SUBSTEPS, int(math.ceil(dt * reach / PAD)))
+        for _ in range(steps):
+            self.step(dt / steps)
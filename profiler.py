@@ -0,0 +1,86 @@
+import json
+import time
+import contextlib
+
+import numpy
+
+# Amostras guardadas por etapa; as mais antigas sao sobrescritas.
+CAPACITY = 1024
+
+class Ring(object):
+    """Buffer circular de tamanho fixo com (inicio, duracao) em segundos."""
+
+    def __init__(self, capacity=CAPACITY):
+        self.samples = numpy.zeros((capacity, 2))
+        self.count = 0
+
+    def append(self, start, duration):
+        self.samples[self.count % len(self.samples)] = (start, duration)
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, len(self.samples))
+
+    def last(self):
+        """Duracao da amostra mais nova."""
+        return float(self.samples[(self.count - 1) % len(self.samples), 1])
+
+    def values(self):
+        """Amostras da mais antiga para a mais nova."""
+        if self.count <= len(self.samples):
+            return self.samples[:self.count]
+        return numpy.roll(self.samples, -(self.count % len(self.samples)), axis=0)
+
+class Profiler(object):
+    """Tempos por etapa do frame (fila, setores, fisica, desenho...) em buffers
+    circulares, para o overlay e para exportar como trace do Chrome.
+
+    Medir custa duas chamadas de perf_counter; as etapas sao criadas no
+    primeiro uso e mantem a ordem em que apareceram.
+    """
+
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self.stages = {}
+        self.origin = time.perf_counter()
+
+    def record(self, name, start, duration):
+        ring = self.stages.get(name)
+        if ring is None:
+            ring = self.stages[name] = Ring(self.capacity)
+        ring.append(start, duration)
+
+    @contextlib.contextmanager
+    def section(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter() - start)
+
+    def percentiles(self, name, q=(50, 99)):
+        """Percentis `q` da duracao da etapa, em segundos (zeros se nao ha amostras)."""
+        ring = self.stages.get(name)
+        if ring is None or not len(ring):
+            return [0.0] * len(q)
+        return numpy.percentile(ring.values()[:, 1], q).tolist()
+
+    def durations(self, name):
+        ring = self.stages.get(name)
+        return numpy.zeros(0) if ring is None else ring.values()[:, 1]
+
+    def trace(self):
+        """Eventos no formato do chrome://tracing (e do Perfetto), em microssegundos."""
+        events = []
+        for tid, (name, ring) in enumerate(self.stages.items()):
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': tid, 'args': {'name': name}})
+            for start, duration in ring.values().tolist():
+                events.append({'name': name, 'ph': 'X', 'pid': 0, 'tid': tid,
+                               'ts': (start - self.origin) * 1e6, 'dur': duration * 1e6})
+        events.sort(key=lambda event: event.get('ts', -1))
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.trace(), f)
+        return path
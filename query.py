@@ -0,0 +1,253 @@
+import math
+
+import numpy
+
+from blocks import AIR, BLOCKS
+from mesher import heightmap
+from world import SECTOR_SIZE, WORLD_BOTTOM, WORLD_HEIGHT
+
+# Celulas de uma camada (um y) de um setor.
+LAYER = SECTOR_SIZE * SECTOR_SIZE
+# y devolvido por tops() para colunas sem bloco ou fora dos setores carregados.
+NO_TOP = WORLD_BOTTOM - 1
+
+def _bits(rows):
+    """Linhas bool (N, WORLD_HEIGHT) -> N inteiros com o bit y ligado onde a linha e verdadeira."""
+    packed = numpy.packbits(rows, axis=1, bitorder='little')
+    return [int.from_bytes(row.tobytes(), 'little') for row in packed]
+
+def _span(y0, y1):
+    return ((1 << (y1 - y0)) - 1) << y0
+
+class Summary(object):
+    """Resumo de um setor para as consultas.
+
+    `counts[t]` e quantos blocos do tipo t ha no setor (AIR conta o ar).
+    `present[t]` e `full[t]` sao bitsets das camadas (y a partir do fundo) em
+    que o tipo aparece e que ele preenche inteiras; `solid` e `filled` sao o
+    mesmo para qualquer bloco que nao seja ar. `heights` e `tops` sao os do
+    mesher.heightmap, para as consultas de coluna.
+    """
+
+    def __init__(self, blocks):
+        types = max(len(BLOCKS), int(blocks.max()) + 1)
+        layers = numpy.arange(WORLD_HEIGHT)[None, :, None]
+        keys = blocks.astype(numpy.int64) * WORLD_HEIGHT + layers
+        per_layer = numpy.bincount(keys.ravel(), minlength=types * WORLD_HEIGHT).reshape(types, WORLD_HEIGHT)
+        self.counts = per_layer.sum(axis=1)
+        self.present = _bits(per_layer > 0)
+        self.full = _bits(per_layer == LAYER)
+        self.solid, self.filled = _bits(numpy.array([per_layer[AIR] < LAYER, per_layer[AIR] == 0]))
+        self.heights, self.tops = heightmap(blocks)
+
+    def layers(self, block):
+        """(present, full) do tipo `block`, ou de qualquer bloco solido se None."""
+        if block is None:
+            return self.solid, self.filled
+        if block >= len(self.present):
+            return 0, 0
+        return self.present[block], self.full[block]
+
+class SpatialIndex(object):
+    """Consultas espaciais sobre os setores carregados do mundo.
+
+    Cada setor tem um Summary, refeito quando a versao dele muda; com ele
+    setores (ou faixas de camadas) sem o tipo procurado sao pulados sem olhar
+    os blocos, e os preenchidos inteiros por ele sao respondidos direto.
+    Setores que nao estao carregados contam como vazios.
+
+    Caixas sao de coordenadas de bloco, inclusivas nos dois cantos. `block`
+    None quer dizer qualquer bloco solido. As versoes *_many respondem um lote
+    de consultas numa chamada, agrupando o trabalho por setor.
+    """
+
+    def __init__(self, world):
+        self.world = world
+        self.summaries = {}
+
+    def forget(self, keys):
+        """Descarta os resumos dos setores `keys` (tirados do mundo)."""
+        for key in keys:
+            self.summaries.pop(key, None)
+
+    def summary(self, key):
+        """(setor, Summary) de um setor carregado, ou (None, None)."""
+        sector = self.world.sectors.get(key)
+        if sector is None:
+            self.summaries.pop(key, None)
+            return None, None
+        cached = self.summaries.get(key)
+        if cached is None or cached[0] != sector.version:
+            cached = self.summaries[key] = (sector.version, Summary(sector.blocks))
+        return sector, cached[1]
+
+    def _pieces(self, los, his):
+        """Pedacos das caixas por setor: {setor: [(consulta, x0, x1, y0, y1, z0, z1)]},
+        com intervalos locais meio abertos e y ja cortado a altura do mundo."""
+        S = SECTOR_SIZE
+        los = numpy.asarray(los, dtype=numpy.int64).reshape(-1, 3)
+        his = numpy.asarray(his, dtype=numpy.int64).reshape(-1, 3)
+        groups = {}
+        for i, ((ax, ay, az), (bx, by, bz)) in enumerate(zip(los.tolist(), his.tolist())):
+            y0, y1 = max(ay - WORLD_BOTTOM, 0), min(by - WORLD_BOTTOM + 1, WORLD_HEIGHT)
+            if y0 >= y1 or ax > bx or az > bz:
+                continue
+            for kx in range(ax // S, bx // S + 1):
+                for kz in range(az // S, bz // S + 1):
+                    groups.setdefault((kx, 0, kz), []).append((
+                        i, max(ax - kx * S, 0), min(bx - kx * S + 1, S), y0, y1,
+                        max(az - kz * S, 0), min(bz - kz * S + 1, S)))
+        return groups, len(los)
+
+    @staticmethod
+    def _mask(blocks, block):
+        return blocks != AIR if block is None else blocks == block
+
+    def count_many(self, los, his, block=None):
+        """Quantos blocos (do tipo `block`) ha em cada caixa los[i]..his[i]."""
+        groups, n = self._pieces(los, his)
+        result = numpy.zeros(n, dtype=numpy.int64)
+        for key, pieces in groups.items():
+            sector, summary = self.summary(key)
+            if sector is None:
+                continue
+            present, full = summary.layers(block)
+            rest = []
+            for piece in pieces:
+                i, x0, x1, y0, y1, z0, z1 = piece
+                span = _span(y0, y1)
+                if not present & span:
+                    continue
+                if full & span == span:
+                    result[i] += (x1 - x0) * (y1 - y0) * (z1 - z0)
+                else:
+                    rest.append(piece)
+            if len(rest) == 1:
+                i, x0, x1, y0, y1, z0, z1 = rest[0]
+                result[i] += numpy.count_nonzero(self._mask(sector.blocks[x0:x1, y0:y1, z0:z1], block))
+            elif rest:
+                # Varias caixas no mesmo setor: somas acumuladas 3D, e cada caixa
+                # sai com oito leituras (inclusao-exclusao).
+                table = numpy.zeros((SECTOR_SIZE + 1, WORLD_HEIGHT + 1, SECTOR_SIZE + 1), dtype=numpy.int32)
+                table[1:, 1:, 1:] = self._mask(sector.blocks, block).cumsum(0).cumsum(1).cumsum(2)
+                i, x0, x1, y0, y1, z0, z1 = numpy.array(rest).T
+                counts = (table[x1, y1, z1] - table[x0, y1, z1] - table[x1, y0, z1] - table[x1, y1, z0]
+                          + table[x0, y0, z1] + table[x0, y1, z0] + table[x1, y0, z0] - table[x0, y0, z0])
+                numpy.add.at(result, i, counts)
+        return result
+
+    def count(self, lo, hi, block=None):
+        return int(self.count_many([lo], [hi], block)[0])
+
+    def empty_many(self, los, his):
+        """Se cada caixa los[i]..his[i] esta toda vazia (so ar)."""
+        return self.count_many(los, his) == 0
+
+    def empty(self, lo, hi):
+        return bool(self.empty_many([lo], [hi])[0])
+
+    def box(self, lo, hi, block=None):
+        """Posicoes (N, 3) dos blocos (do tipo `block`) na caixa lo..hi, setor a setor."""
+        groups, _ = self._pieces([lo], [hi])
+        found = []
+        for key, pieces in groups.items():
+            sector, summary = self.summary(key)
+            if sector is None:
+                continue
+            present, full = summary.layers(block)
+            for i, x0, x1, y0, y1, z0, z1 in pieces:
+                layers = present & _span(y0, y1)
+                if not layers:
+                    continue
+                # So as camadas entre a mais baixa e a mais alta em que o tipo aparece.
+                y0, y1 = (layers & -layers).bit_length() - 1, layers.bit_length()
+                if full & _span(y0, y1) == _span(y0, y1):
+                    cells = numpy.indices((x1 - x0, y1 - y0, z1 - z0)).reshape(3, -1).T
+                else:
+                    cells = numpy.argwhere(self._mask(sector.blocks[x0:x1, y0:y1, z0:z1], block))
+                found.append(cells + (sector.origin[0] + x0, sector.origin[1] + y0, sector.origin[2] + z0))
+        if not found:
+            return numpy.zeros((0, 3), dtype=numpy.int64)
+        return numpy.concatenate(found).astype(numpy.int64)
+
+    def sphere(self, center, radius, block=None):
+        """Posicoes (N, 3) dos blocos (do tipo `block`) a ate `radius` de `center`."""
+        center = numpy.asarray(center, dtype=numpy.float64)
+        lo = numpy.ceil(center - radius).astype(numpy.int64)
+        hi = numpy.floor(center + radius).astype(numpy.int64)
+        cells = self.box(lo, hi, block)
+        return cells[((cells - center) ** 2).sum(axis=1) <= radius * radius]
+
+    def tops(self, columns):
+        """(ys, blocks) do bloco solido mais alto de cada coluna (x, z) de `columns`;
+        NO_TOP e 0 onde a coluna esta vazia ou o setor nao esta carregado."""
+        columns = numpy.asarray(columns, dtype=numpy.int64).reshape(-1, 2)
+        ys = numpy.full(len(columns), NO_TOP, dtype=numpy.int64)
+        blocks = numpy.zeros(len(columns), dtype=numpy.uint8)
+        keys = columns // SECTOR_SIZE
+        for kx, kz in set(map(tuple, keys.tolist())):
+            sector, summary = self.summary((kx, 0, kz))
+            if sector is None or not summary.solid:
+                continue
+            rows = numpy.flatnonzero((keys[:, 0] == kx) & (keys[:, 1] == kz))
+            x, z = columns[rows, 0] % SECTOR_SIZE, columns[rows, 1] % SECTOR_SIZE
+            heights = summary.heights[x, z]
+            ys[rows] = numpy.where(heights >= 0, heights + WORLD_BOTTOM, NO_TOP)
+            blocks[rows] = numpy.where(heights >= 0, summary.tops[x, z], 0)
+        return ys, blocks
+
+    def top(self, x, z):
+        """(y, bloco) do bloco solido mais alto da coluna, ou None."""
+        ys, blocks = self.tops([(x, z)])
+        return None if ys[0] == NO_TOP else (int(ys[0]), int(blocks[0]))
+
+    def nearest_many(self, positions, block=None, max_distance=32):
+        """O bloco (do tipo `block`) mais perto de cada posicao, ate `max_distance`.
+
+        Retorna (cells (N, 3), found (N,)). Os setores sao visitados do mais
+        perto ao mais longe e a busca para quando o proximo nao pode ter nada
+        melhor; as posicoes do tipo em cada setor sao montadas uma vez por lote.
+        Nos empates fica o primeiro visto: o do setor mais perto (ou de menor
+        chave) e, dentro dele, o de menor (x, y, z).
+        """
+        S = SECTOR_SIZE
+        positions = numpy.asarray(positions, dtype=numpy.float64).reshape(-1, 3)
+        cells = numpy.zeros((len(positions), 3), dtype=numpy.int64)
+        found = numpy.zeros(len(positions), dtype=bool)
+        candidates = {}
+        for i, (px, py, pz) in enumerate(positions.tolist()):
+            best = max_distance * max_distance
+            ring = []
+            for kx in range(int(math.floor((px - max_distance) / S)), int(math.floor((px + max_distance) / S)) + 1):
+                for kz in range(int(math.floor((pz - max_distance) / S)), int(math.floor((pz + max_distance) / S)) + 1):
+                    # Distancia horizontal ate a celula mais perto do setor.
+                    dx = max(kx * S - px, 0, px - (kx * S + S - 1))
+                    dz = max(kz * S - pz, 0, pz - (kz * S + S - 1))
+                    ring.append((dx * dx + dz * dz, (kx, 0, kz)))
+            ring.sort()
+            y = py - WORLD_BOTTOM
+            for distance, key in ring:
+                if distance > best:
+                    break
+                sector, summary = self.summary(key)
+                if sector is None:
+                    continue
+                layers = summary.layers(block)[0]
+                if not layers:
+                    continue
+                dy = max((layers & -layers).bit_length() - 1 - y, 0, y - (layers.bit_length() - 1))
+                if distance + dy * dy > best:
+                    continue
+                points = candidates.get(key)
+                if points is None:
+                    points = candidates[key] = numpy.argwhere(self._mask(sector.blocks, block)) + sector.origin
+                d2 = ((points - (px, py, pz)) ** 2).sum(axis=1)
+                j = int(d2.argmin())
+                if d2[j] <= best and not (found[i] and d2[j] == best):
+                    best, cells[i], found[i] = d2[j], points[j], True
+        return cells, found
+
+    def nearest(self, position, block=None, max_distance=32):
+        """(x, y, z) do bloco (do tipo `block`) mais perto de `position`, ou None."""
+        cells, found = self.nearest_many([position], block, max_distance)
+        return tuple(cells[0].tolist()) if found[0] else None
@@ -0,0 +1,81 @@
+import math
+
+import numpy
+
+from world import FACES
+
+NO_HIT = -1
+INSIDE = -2
+
+def _face(axis, step):
+    normal = [0, 0, 0]
+    normal[axis] = -step
+    return FACES.index(tuple(normal))
+
+def raycast(world, position, vector, max_distance=8):
+    """Percorre a grade voxel a voxel (Amanatides & Woo) ate achar um bloco.
+
+    Retorna (bloco, anterior, face): o bloco atingido, a celula de ar de onde
+    o raio veio e o indice em FACES da face atingida. Se o raio comeca dentro
+    de um bloco, anterior e face sao None; se nada e atingido ate
+    max_distance, tudo e None.
+    """
+    block = [int(math.floor(c + 0.5)) for c in position]
+    if tuple(block) in world:
+        return tuple(block), None, None
+    step, t_max, t_delta = [0, 0, 0], [math.inf] * 3, [math.inf] * 3
+    for i in range(3):
+        d = vector[i]
+        if d > 0:
+            step[i], t_max[i], t_delta[i] = 1, (block[i] + 0.5 - position[i]) / d, 1.0 / d
+        elif d < 0:
+            step[i], t_max[i], t_delta[i] = -1, (block[i] - 0.5 - position[i]) / d, -1.0 / d
+    while True:
+        axis = t_max.index(min(t_max))
+        if t_max[axis] > max_distance:
+            return None, None, None
+        previous = tuple(block)
+        block[axis] += step[axis]
+        t_max[axis] += t_delta[axis]
+        key = tuple(block)
+        if key in world:
+            return key, previous, _face(axis, step[axis])
+
+def raycast_many(world, positions, vectors, max_distance=8):
+    """Versao em lote de raycast: todos os raios avancam juntos, um voxel por passo.
+
+    Retorna (blocks, previous, faces) com formas (N, 3), (N, 3) e (N,). Raios
+    sem acerto tem face NO_HIT; raios que comecam dentro de um bloco, INSIDE.
+    """
+    positions = numpy.asarray(positions, dtype=numpy.float64).reshape(-1, 3)
+    vectors = numpy.asarray(vectors, dtype=numpy.float64).reshape(-1, 3)
+    n = len(positions)
+    block = numpy.floor(positions + 0.5).astype(numpy.int64)
+    step = numpy.sign(vectors).astype(numpy.int64)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        t_delta = numpy.where(step != 0, 1.0 / numpy.abs(vectors), numpy.inf)
+        t_max = numpy.where(step != 0, (block + 0.5 * step - positions) / vectors, numpy.inf)
+    blocks = numpy.zeros((n, 3), dtype=numpy.int64)
+    previous = numpy.zeros((n, 3), dtype=numpy.int64)
+    faces = numpy.full(n, NO_HIT, dtype=numpy.int64)
+
+    inside = world.get_many(block) != 0
+    blocks[inside], previous[inside], faces[inside] = block[inside], block[inside], INSIDE
+    active = numpy.nonzero(~inside)[0]
+    face_table = numpy.array([[_face(axis, s) if s else -1 for s in (-1, 0, 1)] for axis in range(3)])
+    while len(active):
+        axis = numpy.argmin(t_max[active], axis=1)
+        t = t_max[active, axis]
+        active = active[t <= max_distance]
+        axis = axis[t <= max_distance]
+        if not len(active):
+            break
+        previous[active] = block[active]
+        block[active, axis] += step[active, axis]
+        t_max[active, axis] += t_delta[active, axis]
+        hit = world.get_many(block[active]) != 0
+        done = active[hit]
+        blocks[done] = block[done]
+        faces[done] = face_table[axis[hit], step[done, axis[hit]] + 1]
+        active = active[~hit]
+    return blocks, previous, faces
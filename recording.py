@@ -0,0 +1,73 @@
+import gzip
+import json
+import struct
+
+# Arquivo de gravacao (gzip): uma linha JSON com a seed e o tipo de mundo,
+# depois um registro por tick:
+#   TICK: dt (float64) e quantos eventos chegaram antes do tick (uint16);
+#   EVENT por evento: tipo (uint8) e dois int32, os argumentos do handler
+#     (tecla e modificadores, botao e modificadores, ou dx e dy do mouse);
+#   STATE: posicao, rotacao e dy do jogador depois do tick (float64), para o
+#     replay conferir e corrigir a trajetoria.
+VERSION = 1
+TICK = struct.Struct('<dH')
+EVENT = struct.Struct('<Bii')
+STATE = struct.Struct('<6d')
+KEY_PRESS, KEY_RELEASE, MOUSE_PRESS, MOUSE_MOTION = range(1, 5)
+
+class Recorder(object):
+    """Grava as entradas da janela tick a tick. Entra na pilha de handlers da
+    janela (push_handlers), entao ve cada evento antes da Window e nao o consome;
+    Player.update chama tick() no fim de cada tick.
+    """
+
+    def __init__(self, path, seed, infinite):
+        self.file = gzip.open(path, 'wb')
+        header = {'version': VERSION, 'seed': seed, 'infinite': infinite}
+        self.file.write(json.dumps(header).encode() + b'\n')
+        self.events = []
+
+    def on_key_press(self, symbol, modifiers):
+        self.events.append(EVENT.pack(KEY_PRESS, symbol, modifiers))
+
+    def on_key_release(self, symbol, modifiers):
+        self.events.append(EVENT.pack(KEY_RELEASE, symbol, modifiers))
+
+    def on_mouse_press(self, x, y, button, modifiers):
+        self.events.append(EVENT.pack(MOUSE_PRESS, button, modifiers))
+
+    def on_mouse_motion(self, x, y, dx, dy):
+        self.events.append(EVENT.pack(MOUSE_MOTION, int(dx), int(dy)))
+
+    def tick(self, dt, position, rotation, dy):
+        self.file.write(TICK.pack(dt, len(self.events)))
+        self.file.write(b''.join(self.events))
+        self.file.write(STATE.pack(*(tuple(position) + tuple(rotation) + (dy,))))
+        del self.events[:]
+
+    def close(self):
+        self.file.close()
+
+def load(path):
+    """(cabecalho, ticks) de uma gravacao, com cada tick como
+    (dt, [(tipo, a, b)], (x, y, z, rx, ry, dy))."""
+    with gzip.open(path, 'rb') as f:
+        header = json.loads(f.readline().decode())
+        data = bytearray()
+        try:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                data += chunk
+        except EOFError:
+            pass  # o jogo fechou sem fechar o arquivo: fica o que foi gravado
+    if header.get('version') != VERSION:
+        raise ValueError('versao de gravacao desconhecida: %r' % header.get('version'))
+    ticks, offset = [], 0
+    while offset + TICK.size <= len(data):
+        dt, count = TICK.unpack_from(data, offset)
+        offset += TICK.size
+        if offset + count * EVENT.size + STATE.size > len(data): break  # cortada no meio de um tick
+        events = [EVENT.unpack_from(data, offset + i * EVENT.size) for i in range(count)]
+        offset += count * EVENT.size
+        ticks.append((dt, events, STATE.unpack_from(data, offset)))
+        offset += STATE.size
+    return header, ticks
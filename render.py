@@ -0,0 +1,245 @@
+import ctypes
+
+import pyglet
+from pyglet import image
+from pyglet.gl import *
+from pyglet.graphics import TextureGroup
+
+import mesher
+
+def load_tiles(path, n=mesher.TILES):
+    # Cada tile do atlas vira uma fatia de uma textura 3D, para que os quads
+    # mesclados pelo mesher possam repetir o tile com GL_REPEAT.
+    texture = image.Texture3D.create_for_image_grid(image.ImageGrid(image.load(path), n, n))
+    glBindTexture(texture.target, texture.id)
+    glTexParameteri(texture.target, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+    glTexParameteri(texture.target, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+    glTexParameteri(texture.target, GL_TEXTURE_WRAP_S, GL_REPEAT)
+    glTexParameteri(texture.target, GL_TEXTURE_WRAP_T, GL_REPEAT)
+    glBindTexture(texture.target, 0)
+    return texture
+
+class GLBackend(object):
+    """Envia as malhas dos setores como vertex lists GL_QUADS (pipeline fixo)."""
+
+    mesh = staticmethod(mesher.mesh)
+    lod = staticmethod(mesher.lod_mesh)
+
+    def __init__(self, texture_path):
+        self.group = TextureGroup(load_tiles(texture_path))
+        self.depth = self.group.texture.images
+
+    def upload(self, count, data):
+        vertices, tex_coords, colors = data
+        return pyglet.graphics.vertex_list(count * 4,
+            ('v3f/static', vertices),
+            ('t3f/static', tex_coords),
+            ('c3B/static', colors))
+
+    def begin(self):
+        self.group.set_state()
+
+    def draw(self, mesh):
+        mesh.draw(GL_QUADS)
+
+    def end(self):
+        self.group.unset_state()
+
+# Cantos (0/1 = lo/hi em cada eixo) e eixos de textura de cada face, em GLSL,
+# gerados das tabelas do mesher para os dois caminhos desenharem o mesmo quad.
+_CORNERS = ', '.join('vec3(%d, %d, %d)' % tuple(int(k > 0) for k in corner)
+                     for corners in mesher.CORNERS for corner in corners)
+_AXES = ', '.join('ivec2(%d, %d)' % axes for axes in mesher.UV_AXES)
+_SHADES = ', '.join('%.6f' % (shade / 255.0) for shade in mesher.SHADES)
+
+VERTEX_SHADER = """#version 330
+layout(location = 0) in uvec4 lo_face;
+layout(location = 1) in uvec4 hi_light;
+uniform mat4 projection;
+uniform mat4 modelview;
+uniform vec3 origin;
+uniform float depth;
+const vec3 corners[24] = vec3[24](%s);
+const ivec2 axes[6] = ivec2[6](%s);
+const float shades[16] = float[16](%s);
+out vec3 uvw;
+out float shade;
+out float distance;
+void main() {
+    int face = int(lo_face.w & 7u);
+    vec3 lo = vec3(lo_face.xyz) - 0.5;
+    vec3 hi = vec3(hi_light.xyz) + 0.5;
+    vec3 corner = corners[face * 4 + gl_VertexID];
+    vec3 size = hi - lo;
+    ivec2 axis = axes[face];
+    vec2 uv = vec2(gl_VertexID == 1 || gl_VertexID == 2 ? size[axis.x] : 0.0,
+                   gl_VertexID >= 2 ? size[axis.y] : 0.0);
+    uvw = vec3(uv, (float(lo_face.w >> 3u) + 0.5) / depth);
+    shade = shades[hi_light.w];
+    vec4 eye = modelview * vec4(origin + mix(lo, hi, corner), 1.0);
+    distance = -eye.z;
+    gl_Position = projection * eye;
+}
+""" % (_CORNERS, _AXES, _SHADES)
+
+FRAGMENT_SHADER = """#version 330
+in vec3 uvw;
+in float shade;
+in float distance;
+uniform sampler3D tiles;
+uniform vec3 fog_color;
+uniform vec2 fog_range;
+out vec4 color;
+void main() {
+    vec4 texel = texture(tiles, uvw);
+    float fog = clamp((fog_range.y - distance) / (fog_range.y - fog_range.x), 0.0, 1.0);
+    color = vec4(mix(fog_color, texel.rgb * shade, fog), texel.a);
+}
+"""
+
+def _compile(kind, source):
+    shader = glCreateShader(kind)
+    text = ctypes.create_string_buffer(source.encode('ascii'))
+    glShaderSource(shader, 1, ctypes.cast(ctypes.pointer(ctypes.pointer(text)),
+                                          ctypes.POINTER(ctypes.POINTER(GLchar))), None)
+    glCompileShader(shader)
+    status = GLint()
+    glGetShaderiv(shader, GL_COMPILE_STATUS, ctypes.byref(status))
+    if not status.value:
+        log = ctypes.create_string_buffer(4096)
+        glGetShaderInfoLog(shader, len(log), None, log)
+        raise RuntimeError('erro compilando shader: %s' % log.value.decode())
+    return shader
+
+def program(vertex_source, fragment_source):
+    """Compila e liga um programa GLSL; levanta RuntimeError com o log do driver."""
+    program = glCreateProgram()
+    shaders = [_compile(GL_VERTEX_SHADER, vertex_source), _compile(GL_FRAGMENT_SHADER, fragment_source)]
+    for shader in shaders:
+        glAttachShader(program, shader)
+    glLinkProgram(program)
+    for shader in shaders:
+        glDeleteShader(shader)
+    status = GLint()
+    glGetProgramiv(program, GL_LINK_STATUS, ctypes.byref(status))
+    if not status.value:
+        log = ctypes.create_string_buffer(4096)
+        glGetProgramInfoLog(program, len(log), None, log)
+        raise RuntimeError('erro ligando shader: %s' % log.value.decode())
+    return program
+
+class InstancedMesh(object):
+    """Um VAO por setor: um buffer com 8 bytes por quad, desenhado numa chamada instanciada."""
+
+    def __init__(self, count, data, origin):
+        self.count = count
+        self.origin = origin
+        self.vao, self.vbo = GLuint(), GLuint()
+        glGenVertexArrays(1, ctypes.byref(self.vao))
+        glGenBuffers(1, ctypes.byref(self.vbo))
+        glBindVertexArray(self.vao)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        glBufferData(GL_ARRAY_BUFFER, data.nbytes, data.ctypes.data, GL_STATIC_DRAW)
+        for location in (0, 1):
+            glEnableVertexAttribArray(location)
+            glVertexAttribIPointer(location, 4, GL_UNSIGNED_BYTE, 8, location * 4)
+            glVertexAttribDivisor(location, 1)
+        glBindVertexArray(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def delete(self):
+        glDeleteVertexArrays(1, ctypes.byref(self.vao))
+        glDeleteBuffers(1, ctypes.byref(self.vbo))
+
+class InstancedBackend(object):
+    """Desenha cada setor com um glDrawArraysInstanced: uma instancia por quad,
+    os 4 cantos montados no vertex shader. Precisa de GL 3.3 (o llvmpipe do Mesa serve).
+
+    As matrizes e a neblina sao lidas do estado fixo em begin(), entao set_3d e
+    setup_fog continuam valendo para os dois backends.
+
+    A imagem e a mesma do GLBackend a menos de alguns pixels: o shader e o
+    pipeline fixo arredondam diferente nas bordas dos triangulos e dos texels,
+    e o GL nao garante o mesmo resultado entre os dois (tests/test_render.py).
+    """
+
+    mesh = staticmethod(mesher.instances)
+    lod = staticmethod(mesher.lod_instances)
+
+    def __init__(self, texture_path):
+        self.texture = load_tiles(texture_path)
+        self.depth = self.texture.images
+        self.program = program(VERTEX_SHADER, FRAGMENT_SHADER)
+        self.uniforms = dict((name, glGetUniformLocation(self.program, name.encode('ascii'))) for name in
+                             ('projection', 'modelview', 'origin', 'depth', 'tiles', 'fog_color', 'fog_range'))
+
+    def upload(self, count, data):
+        instances, origin = data
+        return InstancedMesh(count, instances, origin)
+
+    def begin(self):
+        projection, modelview, fog_color = (GLfloat * 16)(), (GLfloat * 16)(), (GLfloat * 4)()
+        fog_start, fog_end = GLfloat(), GLfloat()
+        glGetFloatv(GL_PROJECTION_MATRIX, projection)
+        glGetFloatv(GL_MODELVIEW_MATRIX, modelview)
+        glGetFloatv(GL_FOG_COLOR, fog_color)
+        glGetFloatv(GL_FOG_START, ctypes.byref(fog_start))
+        glGetFloatv(GL_FOG_END, ctypes.byref(fog_end))
+        glUseProgram(self.program)
+        glUniformMatrix4fv(self.uniforms['projection'], 1, GL_FALSE, projection)
+        glUniformMatrix4fv(self.uniforms['modelview'], 1, GL_FALSE, modelview)
+        glUniform3f(self.uniforms['fog_color'], *fog_color[:3])
+        glUniform2f(self.uniforms['fog_range'], fog_start.value, fog_end.value)
+        glUniform1f(self.uniforms['depth'], self.depth)
+        glUniform1i(self.uniforms['tiles'], 0)
+        glActiveTexture(GL_TEXTURE0)
+        glBindTexture(self.texture.target, self.texture.id)
+
+    def draw(self, mesh):
+        glUniform3f(self.uniforms['origin'], *mesh.origin)
+        glBindVertexArray(mesh.vao)
+        glDrawArraysInstanced(GL_TRIANGLE_FAN, 0, 4, mesh.count)
+
+    def end(self):
+        glBindVertexArray(0)
+        glBindTexture(self.texture.target, 0)
+        glUseProgram(0)
+
+BACKENDS = {'quads': GLBackend, 'instanced': InstancedBackend}
+
+class DeferredBackend(object):
+    """Fica no lugar de um backend enquanto ainda nao ha contexto GL (mundo
+    preparado durante o menu): as malhas sao geradas com as funcoes do backend
+    `cls`, mas so enviadas depois que Model.attach troca pelo backend de verdade."""
+
+    depth = mesher.TILES * mesher.TILES
+
+    def __init__(self, cls):
+        self.mesh = cls.mesh
+        self.lod = cls.lod
+
+class NullMesh(object):
+    def __init__(self, count):
+        self.count = count
+
+    def delete(self):
+        pass
+
+class NullBackend(object):
+    """Backend sem contexto GL, para rodar o Model em testes e benchmarks sem janela."""
+
+    mesh = staticmethod(mesher.mesh)
+    lod = staticmethod(mesher.lod_mesh)
+    depth = mesher.TILES * mesher.TILES
+
+    def upload(self, count, data):
+        return NullMesh(count)
+
+    def begin(self):
+        pass
+
+    def draw(self, mesh):
+        pass
+
+    def end(self):
+        pass
@@ -0,0 +1,122 @@
+import sys
+import csv
+import json
+import time
+import argparse
+
+import pyglet
+# O replay nao abre janela: sem janela de sombra o modulo main carrega sem display.
+pyglet.options['shadow_window'] = False
+
+import main
+import render
+import profiler
+import recording
+
+# Etapas de Player.update medidas por tick.
+STAGES = ['process_queue', 'change_sectors', 'physics']
+# Diferenca (em blocos, graus ou blocos/s) a partir da qual o estado do
+# jogador no replay conta como divergente e e corrigido pelo gravado.
+TOLERANCE = 1e-3
+
+class Headless(main.Player):
+    """Jogador sem janela: os eventos gravados chamam os mesmos handlers da Window."""
+
+    def __init__(self, model):
+        self.setup_player(model)
+        # main() prende o mouse antes do primeiro tick.
+        self.exclusive = True
+
+    def set_exclusive_mouse(self, exclusive):
+        self.exclusive = exclusive
+
+    def dispatch(self, kind, a, b):
+        if kind == recording.KEY_PRESS: self.on_key_press(a, b)
+        elif kind == recording.KEY_RELEASE: self.on_key_release(a, b)
+        elif kind == recording.MOUSE_PRESS: self.on_mouse_press(0, 0, a, b)
+        elif kind == recording.MOUSE_MOTION: self.on_mouse_motion(0, 0, a, b)
+
+def replay(path, realtime=True, dt=None, tolerance=TOLERANCE):
+    """Roda a gravacao `path` num Model sem GL. Retorna (relatorio, ticks,
+    profiler), com uma linha em ticks por tick: indice, dt, update inteiro e
+    cada etapa de STAGES, em segundos (0 se a etapa nao rodou no tick).
+
+    Cada tick usa o dt gravado (ou `dt`, fixo) em vez do relogio, entao a
+    trajetoria nao depende da velocidade da maquina. O que ainda depende
+    dela (setores gerados ou com malha a tempo, colisao contra eles) pode
+    desviar o jogador: o estado gravado depois de cada tick e conferido e,
+    se divergiu, restaurado. `realtime` espera entre ticks como o jogo, para
+    as threads de malha e os processos do gerador terem o mesmo tempo.
+    """
+    header, ticks = recording.load(path)
+    model = main.Model(seed=header['seed'], infinite=header['infinite'], backend=render.NullBackend())
+    player = Headless(model)
+    player.profiler = profiler.Profiler(max(len(ticks), profiler.CAPACITY))
+    rows, divergences = [], 0
+    start = clock = time.perf_counter()
+    try:
+        for index, (recorded, events, state) in enumerate(ticks):
+            step = dt or recorded
+            if realtime:
+                clock += step
+                time.sleep(max(0.0, clock - time.perf_counter()))
+            for kind, a, b in events:
+                player.dispatch(kind, a, b)
+            counts = dict((name, ring.count) for name, ring in player.profiler.stages.items())
+            tick = time.perf_counter()
+            player.update(step)
+            row = [index, step, time.perf_counter() - tick]
+            for name in STAGES:
+                ring = player.profiler.stages.get(name)
+                row.append(ring.last() if ring and ring.count > counts.get(name, 0) else 0.0)
+            rows.append(row)
+            player.profiler.record('update', tick, row[2])
+            # Sem desenho, o custo do frame que sobra para a fila e so o do tick.
+            model.budget.record(player.update_cost)
+            actual = player.position + player.rotation + (player.dy,)
+            if max(abs(x - y) for x, y in zip(actual, state)) > tolerance:
+                divergences += 1
+                player.position, player.rotation, player.dy = state[:3], tuple(state[3:5]), state[5]
+    finally:
+        model.close()
+    seconds = time.perf_counter() - start
+    stages = {}
+    for name in ['update'] + STAGES:
+        p50, p99 = player.profiler.percentiles(name)
+        durations = player.profiler.durations(name)
+        stages[name] = {'samples': len(durations), 'p50_ms': p50 * 1000, 'p99_ms': p99 * 1000,
+                        'max_ms': float(durations.max()) * 1000 if len(durations) else 0.0}
+    report = {
+        'recording': path,
+        'seed': header['seed'],
+        'infinite': header['infinite'],
+        'ticks': len(rows),
+        'recorded_seconds': sum(row[1] for row in rows),
+        'seconds': seconds,
+        'divergences': divergences,
+        'stages': stages,
+    }
+    return report, rows, player.profiler
+
+def command(args=None):
+    parser = argparse.ArgumentParser(description='roda uma gravacao (main.py --record) sem janela e mede cada tick')
+    parser.add_argument('recording')
+    parser.add_argument('--fast', action='store_true', help='nao espera entre ticks (o mundo tem menos tempo para carregar)')
+    parser.add_argument('--dt', type=float, help='dt fixo em vez do gravado')
+    parser.add_argument('--csv', help='grava os tempos de cada tick (ms) neste arquivo')
+    parser.add_argument('--trace', help='grava o trace do Chrome das etapas neste arquivo')
+    args = parser.parse_args(args)
+    report, rows, timings = replay(args.recording, realtime=not args.fast, dt=args.dt)
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['tick', 'dt_ms', 'update_ms'] + ['%s_ms' % name for name in STAGES])
+            for row in rows:
+                writer.writerow([row[0]] + ['%.3f' % (value * 1000) for value in row[1:]])
+    if args.trace:
+        timings.dump(args.trace)
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    command()
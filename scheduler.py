@@ -0,0 +1,59 @@
+import heapq
+
+class Scheduler(object):
+    """Fila de operacoes por setor, atendida do setor mais perto do jogador para o mais longe.
+
+    Cada setor tem no maximo uma operacao pendente: agendar outra substitui a
+    anterior (um hide agendado depois de um show ganha, e vice-versa).
+    """
+
+    def __init__(self, center=(0, 0, 0)):
+        self.center = center
+        self.heap = []
+        self.ops = {}
+        self.seq = 0
+
+    def distance(self, sector):
+        return (sector[0] - self.center[0]) ** 2 + (sector[2] - self.center[2]) ** 2
+
+    def push(self, sector, func, *args):
+        self.seq += 1
+        self.ops[sector] = (self.seq, func, args)
+        heapq.heappush(self.heap, (self.distance(sector), self.seq, sector))
+
+    def cancel(self, sector):
+        self.ops.pop(sector, None)
+
+    def recenter(self, center):
+        # As entradas velhas do heap ficam invalidas; reconstroi so com as operacoes vivas.
+        self.center = center
+        self.heap = [(self.distance(sector), seq, sector) for sector, (seq, func, args) in self.ops.items()]
+        heapq.heapify(self.heap)
+
+    def pop(self):
+        while self.heap:
+            distance, seq, sector = heapq.heappop(self.heap)
+            op = self.ops.get(sector)
+            if op is not None and op[0] == seq:
+                del self.ops[sector]
+                return op[1], op[2]
+        raise IndexError('fila vazia')
+
+    def __len__(self):
+        return len(self.ops)
+
+class FrameBudget(object):
+    """Tempo por tick para o trabalho em fila: o que sobra do frame alvo depois
+    do custo medido de desenhar e simular (media movel exponencial)."""
+
+    def __init__(self, target, minimum=0.002, smoothing=0.1):
+        self.target = target
+        self.minimum = minimum
+        self.smoothing = smoothing
+        self.cost = 0.0
+
+    def record(self, seconds):
+        self.cost += (seconds - self.cost) * self.smoothing
+
+    def __call__(self):
+        return max(self.minimum, self.target - self.cost)
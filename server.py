@@ -0,0 +1,435 @@
+import sys
+import json
+import math
+import time
+import zlib
+import struct
+import random
+import socket
+import asyncio
+import argparse
+import subprocess
+
+import numpy
+import pyglet
+# O servidor nao abre janela: sem janela de sombra o modulo main carrega sem display.
+pyglet.options['shadow_window'] = False
+
+import main
+import render
+import profiler
+from blocks import BLOCKS, BRICK, GRASS, SAND, STONE
+from world import SECTOR_SIZE, WORLD_BOTTOM, WORLD_HEIGHT, sectorize
+
+# Protocolo: cada mensagem e um cabecalho (tamanho do corpo, tipo) seguido do corpo.
+#   cliente -> servidor
+#     POSITION: x, y, z (float32) do jogador; o servidor manda os setores da visao.
+#     EDITS: lista de (x, y, z int32, bloco uint8), bloco 0 = remover.
+#     STATS: corpo vazio; a resposta e um STATS com JSON.
+#     CHECK: para cada setor a chave (x, z int32) e o crc32 dos blocos que o
+#       cliente tem; a resposta e um CHECK com quantos setores o servidor
+#       conferiu e quantos diferem (uint32).
+#   servidor -> cliente
+#     SECTOR: chave (x, z int32) + blocos do setor comprimidos com zlib.
+#     DELTA: tick (uint32) + para cada setor alterado no tick a chave (x, z
+#       int32) e a quantidade (uint16), e cada edicao em 3 bytes:
+#       x | z << 4 dentro do setor, y (a partir de WORLD_BOTTOM) e o bloco.
+HEADER = struct.Struct('<IB')
+POSITION, EDITS, SECTOR, DELTA, STATS, CHECK = range(1, 7)
+VECTOR = struct.Struct('<fff')
+EDIT = struct.Struct('<iiiB')
+KEY = struct.Struct('<ii')
+TICK = struct.Struct('<I')
+DELTA_SECTOR = struct.Struct('<iiH')
+CHECK_SECTOR = struct.Struct('<iiI')
+COUNTS = struct.Struct('<II')
+
+TICK_RATE = 20
+PORT = 25575
+# Setores enviados por cliente a cada tick, e bytes pendentes no socket acima
+# dos quais o envio de setores para aquele cliente espera o proximo tick.
+SECTORS_PER_TICK = 8
+WRITE_LIMIT = 1 << 20
+
+def frame(kind, body=b''):
+    return HEADER.pack(len(body), kind) + body
+
+async def read_frame(reader):
+    size, kind = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return kind, await reader.readexactly(size)
+
+def encode_edits(edits):
+    return b''.join(EDIT.pack(x, y, z, block) for (x, y, z), block in edits)
+
+def decode_edits(body):
+    return [((x, y, z), block) for x, y, z, block in EDIT.iter_unpack(body)]
+
+def encode_sector(key, blocks):
+    return KEY.pack(key[0], key[2]) + zlib.compress(blocks.tobytes(), 1)
+
+def decode_sector(body):
+    x, z = KEY.unpack_from(body)
+    blocks = numpy.frombuffer(zlib.decompress(body[KEY.size:]), dtype=numpy.uint8)
+    return (x, 0, z), blocks.reshape(SECTOR_SIZE, WORLD_HEIGHT, SECTOR_SIZE)
+
+def encode_delta(tick, changes):
+    """Corpo de um DELTA com as edicoes `changes` ({setor: {(x, y, z): bloco}})."""
+    parts = [TICK.pack(tick)]
+    for key, edits in changes.items():
+        cells = numpy.array([(x, y, z, block) for (x, y, z), block in edits.items()], dtype=numpy.int64)
+        packed = numpy.empty((len(cells), 3), dtype=numpy.uint8)
+        packed[:, 0] = (cells[:, 0] % SECTOR_SIZE) | (cells[:, 2] % SECTOR_SIZE) << 4
+        packed[:, 1] = cells[:, 1] - WORLD_BOTTOM
+        packed[:, 2] = cells[:, 3]
+        parts.append(DELTA_SECTOR.pack(key[0], key[2], len(cells)))
+        parts.append(packed.tobytes())
+    return b''.join(parts)
+
+def decode_delta(body):
+    """(tick, [((x, y, z), bloco), ...]) de um DELTA."""
+    tick, = TICK.unpack_from(body)
+    offset, edits = TICK.size, []
+    while offset < len(body):
+        sx, sz, count = DELTA_SECTOR.unpack_from(body, offset)
+        offset += DELTA_SECTOR.size
+        cells = numpy.frombuffer(body, dtype=numpy.uint8, count=3 * count, offset=offset).reshape(count, 3)
+        offset += 3 * count
+        for packed, y, block in cells.tolist():
+            position = (sx * SECTOR_SIZE + (packed & 15), y + WORLD_BOTTOM, sz * SECTOR_SIZE + (packed >> 4))
+            edits.append((position, block))
+    return tick, edits
+
+def view(sector, pad=main.VIEW_DISTANCE):
+    """Setores da distancia de visao em volta de `sector`, como em Model.change_sectors."""
+    x, y, z = sector
+    return set((x + dx, y, z + dz) for dx in range(-pad, pad + 1) for dz in range(-pad, pad + 1)
+               if dx ** 2 + dz ** 2 <= (pad + 1) ** 2)
+
+class Session(object):
+    """Um cliente conectado: onde ele esta, o que ja recebeu e o que falta mandar."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.sector = None
+        self.known = set()
+        self.wanted = []
+        self.sent = 0
+        self.connected = time.perf_counter()
+
+    def send(self, data):
+        self.writer.write(data)
+        self.sent += len(data)
+
+    def move(self, sector):
+        if sector == self.sector:
+            return
+        self.sector = sector
+        visible = view(sector)
+        # O cliente esquece os setores que sairam da visao; se voltarem, vao de novo.
+        self.known &= visible
+        distance = lambda key: (key[0] - sector[0]) ** 2 + (key[2] - sector[2]) ** 2
+        self.wanted = sorted(visible - self.known, key=distance, reverse=True)
+
+class Server(object):
+    """Servidor autoritativo: dono do mundo de um Model sem janela.
+
+    Edicoes recebidas sao aplicadas no tick seguinte, na ordem de chegada, e
+    cada cliente recebe um unico DELTA por tick com as edicoes dos setores que
+    ele tem. Os setores sao mandados aos poucos (SECTORS_PER_TICK, do mais
+    perto ao mais longe) e comprimidos uma vez por versao.
+    """
+
+    def __init__(self, model, tick_rate=TICK_RATE):
+        self.model = model
+        self.world = model.world
+        self.tick_rate = tick_rate
+        self.tick = 0
+        self.sessions = set()
+        self.edits = []
+        self.payloads = {}
+        self.profiler = profiler.Profiler()
+
+    async def handle(self, reader, writer):
+        session = Session(writer)
+        self.sessions.add(session)
+        try:
+            while True:
+                kind, body = await read_frame(reader)
+                if kind == POSITION:
+                    session.move(sectorize(VECTOR.unpack(body)))
+                elif kind == EDITS:
+                    self.edits.extend(decode_edits(body))
+                elif kind == STATS:
+                    session.send(frame(STATS, json.dumps(self.stats()).encode()))
+                elif kind == CHECK:
+                    session.send(frame(CHECK, self.check(body)))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            writer.close()
+
+    def payload(self, key):
+        sector = self.world.sectors[key]
+        cached = self.payloads.get(key)
+        if cached is None or cached[0] != sector.version:
+            cached = self.payloads[key] = (sector.version, frame(SECTOR, encode_sector(key, sector.blocks)))
+        return cached[1]
+
+    def apply(self):
+        """Aplica as edicoes pendentes pelo Model, com as mesmas regras das do
+        jogador; devolve {setor: {posicao: bloco}} com o estado final de cada celula."""
+        model, world, changes = self.model, self.world, {}
+        edits, self.edits = self.edits, []
+        with model.transaction():
+            for position, block in edits:
+                key = sectorize(position)
+                # Setores que nao estao carregados, fora da altura do mundo ou blocos desconhecidos: ignorados.
+                if key not in world.sectors or not world.in_bounds(position) or block >= len(BLOCKS):
+                    continue
+                old = world.get(position, 0)
+                # Pedra nao sai, como no jogo.
+                if old == block or old == STONE:
+                    continue
+                if block:
+                    model.add_block(position, block, immediate=False)
+                else:
+                    model.remove_block(position, immediate=False)
+                changes.setdefault(key, {})[position] = block
+        return changes
+
+    def check(self, body):
+        """Confere os crc32 de um CHECK com os setores do mundo; os que nao
+        estao carregados ficam de fora."""
+        compared = mismatched = 0
+        for x, z, crc in CHECK_SECTOR.iter_unpack(body):
+            sector = self.world.sectors.get((x, 0, z))
+            if sector is None:
+                continue
+            compared += 1
+            mismatched += zlib.crc32(sector.blocks.tobytes()) != crc
+        return COUNTS.pack(compared, mismatched)
+
+    def stream(self, session):
+        model, count = self.model, 0
+        while session.wanted and count < SECTORS_PER_TICK:
+            if session.writer.transport.get_write_buffer_size() > WRITE_LIMIT:
+                break
+            key = session.wanted[-1]
+            if key not in self.world.sectors:
+                model.request_sector(key)
+            if key in self.world.sectors:
+                session.wanted.pop()
+                session.send(self.payload(key))
+                session.known.add(key)
+                count += 1
+            elif key in model.generating:
+                break  # chega num dos proximos ticks
+            else:
+                session.wanted.pop()  # fora do mundo finito: nao ha o que mandar
+
+    def receive(self):
+        # Setores gerados chegam aqui sem luz nem malha: o servidor so guarda blocos.
+        model = self.model
+        for key in [key for key, future in model.generating.items() if future.done()]:
+            blocks = model.generating.pop(key).result()
+            if key not in self.world.sectors:
+                self.world.insert(key, blocks)
+                model.lru[key] = None
+
+    def step(self):
+        start = time.perf_counter()
+        self.tick += 1
+        # O diario do Model marca as edicoes com o tick do servidor.
+        self.model.tick = self.tick
+        self.receive()
+        changes = self.apply()
+        sessions = list(self.sessions)
+        if changes:
+            deltas = {}
+            for session in sessions:
+                mine = dict((key, edits) for key, edits in changes.items() if key in session.known)
+                if mine:
+                    body = deltas.get(frozenset(mine))
+                    if body is None:
+                        body = deltas[frozenset(mine)] = frame(DELTA, encode_delta(self.tick, mine))
+                    session.send(body)
+        for session in sessions:
+            self.stream(session)
+        self.model.near = set().union(*[view(session.sector) for session in sessions if session.sector])
+        self.model.evict_sectors()
+        self.model.autosave()
+        self.profiler.record('tick', start, time.perf_counter() - start)
+
+    def stats(self):
+        p50, p99 = self.profiler.percentiles('tick')
+        now = time.perf_counter()
+        rates = [session.sent / max(now - session.connected, 1e-6) for session in self.sessions]
+        return {
+            'tick': self.tick,
+            'clients': len(self.sessions),
+            'tick_p50_ms': p50 * 1000,
+            'tick_p99_ms': p99 * 1000,
+            'sectors': len(self.world.sectors),
+            'bytes_per_client_per_s': sum(rates) / max(len(rates), 1),
+        }
+
+    async def serve(self, host='127.0.0.1', port=PORT):
+        server = await asyncio.start_server(self.handle, host, port)
+        period = 1.0 / self.tick_rate
+        deadline = time.perf_counter()
+        async with server:
+            while True:
+                self.step()
+                deadline += period
+                await asyncio.sleep(max(0.0, deadline - time.perf_counter()))
+
+class SimulatedClient(object):
+    """Jogador falso para carga: anda ao acaso, manda a posicao a cada tick e
+    as vezes um lote de edicoes; conta o que recebe. Com `verify` guarda os
+    setores e aplica os DELTAs (custa memoria, use em poucos), e check()
+    confere essa copia com o servidor."""
+
+    def __init__(self, rng, edit_rate=0.05, verify=False):
+        self.rng = rng
+        self.edit_rate = edit_rate
+        self.verify = verify
+        self.position = [rng.uniform(-40, 40), 2.0, rng.uniform(-40, 40)]
+        self.heading = rng.uniform(0, 2 * math.pi)
+        self.received = dict((kind, [0, 0]) for kind in (SECTOR, DELTA, STATS, CHECK))
+        self.sectors = {}
+        self.stats = None
+        self.checked = None
+
+    async def read(self, reader):
+        try:
+            while True:
+                kind, body = await read_frame(reader)
+                self.received[kind][0] += 1
+                self.received[kind][1] += HEADER.size + len(body)
+                if kind == STATS:
+                    self.stats = json.loads(body.decode())
+                elif kind == CHECK:
+                    self.checked = COUNTS.unpack(body)
+                elif self.verify and kind == SECTOR:
+                    key, blocks = decode_sector(body)
+                    self.sectors[key] = blocks.copy()
+                elif self.verify and kind == DELTA:
+                    for (x, y, z), block in decode_delta(body)[1]:
+                        blocks = self.sectors.get(sectorize((x, y, z)))
+                        if blocks is not None:
+                            blocks[x % SECTOR_SIZE, y - WORLD_BOTTOM, z % SECTOR_SIZE] = block
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    async def run(self, host, port, seconds, tick_rate=TICK_RATE):
+        reader, writer = await asyncio.open_connection(host, port)
+        task = asyncio.ensure_future(self.read(reader))
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            self.heading += self.rng.uniform(-0.3, 0.3)
+            self.position[0] += math.cos(self.heading) * main.WALKING_SPEED / tick_rate
+            self.position[2] += math.sin(self.heading) * main.WALKING_SPEED / tick_rate
+            writer.write(frame(POSITION, VECTOR.pack(*self.position)))
+            if self.verify:
+                # Como o servidor, esquece o que saiu da visao (se voltar, vem inteiro de novo).
+                visible = view(sectorize(self.position))
+                self.sectors = dict((key, blocks) for key, blocks in self.sectors.items() if key in visible)
+            if self.rng.random() < self.edit_rate:
+                x, _, z = [int(round(c)) for c in self.position]
+                edits = [((x + self.rng.randint(-3, 3), self.rng.randint(1, 4), z + self.rng.randint(-3, 3)),
+                          self.rng.choice([0, BRICK, GRASS, SAND])) for _ in range(self.rng.randint(1, 4))]
+                writer.write(frame(EDITS, encode_edits(edits)))
+            await writer.drain()
+            await asyncio.sleep(1.0 / tick_rate)
+        return writer, task
+
+    async def check(self, writer):
+        """(setores conferidos, setores diferentes) da copia local contra o servidor."""
+        self.checked = None
+        body = b''.join(CHECK_SECTOR.pack(key[0], key[2], zlib.crc32(blocks.tobytes()))
+                        for key, blocks in self.sectors.items())
+        writer.write(frame(CHECK, body))
+        await writer.drain()
+        while self.checked is None:
+            await asyncio.sleep(0.01)
+        return self.checked
+
+async def simulate(host, port, clients, seconds, seed=0):
+    """Roda `clients` jogadores falsos por `seconds` e devolve o relatorio (com as
+    estatisticas do servidor e a conferencia da copia do mundo do primeiro)."""
+    rng = random.Random(seed)
+    players = [SimulatedClient(random.Random(rng.random()), verify=(i == 0)) for i in range(clients)]
+    results = await asyncio.gather(*[player.run(host, port, seconds) for player in players])
+    writer, task = results[0]
+    # Espera as ultimas edicoes chegarem como DELTA antes de conferir a copia do primeiro.
+    await asyncio.sleep(3.0 / TICK_RATE)
+    verified, mismatched = await players[0].check(writer)
+    writer.write(frame(STATS))
+    await writer.drain()
+    while players[0].stats is None:
+        await asyncio.sleep(0.01)
+    for writer, task in results:
+        writer.close()
+    await asyncio.gather(*[task for writer, task in results])
+    received = [sum(size for count, size in player.received.values()) for player in players]
+    return {
+        'clients': clients,
+        'seconds': seconds,
+        'received_bytes_per_client_per_s': sum(received) / float(clients * seconds),
+        'sectors_per_client': sum(player.received[SECTOR][0] for player in players) / float(clients),
+        'deltas_per_client': sum(player.received[DELTA][0] for player in players) / float(clients),
+        'verified_sectors': verified,
+        'mismatched_sectors': mismatched,
+        'server': players[0].stats,
+    }
+
+def wait_for(host, port, timeout=30.0):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1.0).close()
+            return
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            time.sleep(0.1)
+
+def command(args=None):
+    parser = argparse.ArgumentParser(description='servidor de mundo autoritativo e simulador de clientes')
+    parser.add_argument('mode', choices=['serve', 'simulate'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--infinite', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--path', help='diretorio do mundo salvo (sem ele o mundo fica so na memoria)')
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--spawn', action='store_true', help='simulate: sobe um servidor num processo a parte')
+    args = parser.parse_args(args)
+    if args.mode == 'serve':
+        model = main.Model(seed=args.seed, path=args.path, infinite=args.infinite, backend=render.NullBackend())
+        try:
+            asyncio.run(Server(model).serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            model.close()
+        return
+    process = None
+    if args.spawn:
+        command = [sys.executable, __file__, 'serve', '--host', args.host, '--port', str(args.port),
+                   '--seed', str(args.seed)] + (['--infinite'] if args.infinite else [])
+        process = subprocess.Popen(command)
+        wait_for(args.host, args.port)
+    try:
+        report = asyncio.run(simulate(args.host, args.port, args.clients, args.seconds, args.seed))
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+if __name__ == '__main__':
+    command()
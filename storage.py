@@ -0,0 +1,319 @@
+import os
+import json
+import mmap
+import queue
+import struct
+import zlib
+import threading
+
+import numpy
+
+from world import SECTOR_SIZE, WORLD_HEIGHT, sectorize
+
+# Cada arquivo de regiao guarda REGION_SIZE x REGION_SIZE setores:
+#   cabecalho (magic, versao, REGION_SIZE)
+#   indice com (offset, tamanho) uint32 de cada setor, 0 = ausente
+#   blocos dos setores comprimidos com zlib, na ordem em que foram gravados
+# Gravar um setor anexa o novo conteudo no fim do arquivo e so reescreve a
+# entrada dele no indice; o espaco antigo e recuperado por compact().
+REGION_SIZE = 8
+MAGIC = b'MCRG'
+VERSION = 1
+HEADER = struct.Struct('<4sHH')
+INDEX_OFFSET = HEADER.size
+DATA_OFFSET = INDEX_OFFSET + REGION_SIZE * REGION_SIZE * 8
+SECTOR_SHAPE = (SECTOR_SIZE, WORLD_HEIGHT, SECTOR_SIZE)
+
+# Diario de edicoes: segmentos journal.N.bin so com registros anexados de
+# (x, y, z int32, bloco antigo, bloco novo uint8, tick uint32).
+JOURNAL = struct.Struct('<iiiBBI')
+JOURNAL_PREFIX = 'journal.'
+# Registros que a thread do diario junta numa escrita.
+JOURNAL_BATCH = 4096
+
+def regionize(sector):
+    return (sector[0] // REGION_SIZE, sector[2] // REGION_SIZE)
+
+def _slot(sector):
+    return (sector[2] % REGION_SIZE) * REGION_SIZE + sector[0] % REGION_SIZE
+
+class Region(object):
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.map = None
+        self.index = numpy.zeros((REGION_SIZE * REGION_SIZE, 2), dtype=numpy.uint32)
+        if os.path.exists(path):
+            self.open()
+
+    def open(self):
+        self.file = open(self.path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, size = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION or size != REGION_SIZE:
+            self.close()
+            raise IOError('arquivo de regiao invalido: %s' % self.path)
+        self.index = numpy.frombuffer(self.map, dtype='<u4', count=REGION_SIZE * REGION_SIZE * 2,
+                                      offset=INDEX_OFFSET).reshape(-1, 2).astype(numpy.uint32)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.file.close()
+        self.map = self.file = None
+
+    def __contains__(self, sector):
+        return self.index[_slot(sector), 1] > 0
+
+    def read(self, sector):
+        offset, length = self.index[_slot(sector)].tolist()
+        if not length:
+            return None
+        data = zlib.decompress(self.map[offset:offset + length])
+        return numpy.frombuffer(data, dtype=numpy.uint8).reshape(SECTOR_SHAPE).copy()
+
+    def write(self, sectors):
+        """Grava `sectors` ({setor: blocos comprimidos, b'' = ausente}) sem tocar nos demais."""
+        self.close()
+        new = not os.path.exists(self.path)
+        with open(self.path, 'w+b' if new else 'r+b') as f:
+            if new:
+                f.write(HEADER.pack(MAGIC, VERSION, REGION_SIZE))
+                f.write(self.index.astype('<u4').tobytes())
+            end = f.seek(0, os.SEEK_END)
+            for sector, payload in sectors.items():
+                self.index[_slot(sector)] = (end if payload else 0, len(payload))
+                f.write(payload)
+                end += len(payload)
+            f.seek(INDEX_OFFSET)
+            f.write(self.index.astype('<u4').tobytes())
+        self.open()
+        if end > DATA_OFFSET + 2 * int(self.index[:, 1].sum()) + (1 << 16):
+            self.compact()
+
+    def compact(self):
+        payloads = [(slot, self.map[offset:offset + length])
+                    for slot, (offset, length) in enumerate(self.index.tolist()) if length]
+        self.close()
+        index = numpy.zeros_like(self.index)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, REGION_SIZE))
+            f.write(index.astype('<u4').tobytes())
+            for slot, payload in payloads:
+                index[slot] = (f.tell(), len(payload))
+                f.write(payload)
+            f.seek(INDEX_OFFSET)
+            f.write(index.astype('<u4').tobytes())
+        os.replace(tmp, self.path)
+        self.index = index
+        self.open()
+
+class Storage(object):
+    """Diretorio de arquivos de regiao de um mundo salvo.
+
+    Pode ser usado de duas threads: a do jogo le e a do diario grava. Setores
+    copiados por stage() e ainda nao gravados ficam em `pending` e sao lidos
+    de la, entao um setor descarregado e pedido de novo nunca volta velho.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.regions = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def region(self, key):
+        region = self.regions.get(key)
+        if region is None:
+            name = 'r.%d.%d.bin' % key
+            region = self.regions[key] = Region(os.path.join(self.path, name))
+        return region
+
+    def exists(self):
+        return any(name.startswith('r.') and name.endswith('.bin') for name in os.listdir(self.path))
+
+    def __contains__(self, sector):
+        with self.lock:
+            if sector in self.pending:
+                return self.pending[sector] is not None
+            return sector in self.region(regionize(sector))
+
+    def load(self, sector):
+        with self.lock:
+            if sector in self.pending:
+                blocks = self.pending[sector]
+                return None if blocks is None else blocks.copy()
+            return self.region(regionize(sector)).read(sector)
+
+    def read_meta(self):
+        path = os.path.join(self.path, 'level.json')
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def write_meta(self, meta):
+        with open(os.path.join(self.path, 'level.json'), 'w') as f:
+            json.dump(meta, f)
+
+    def stage(self, world, keys=None):
+        """Copia os setores alterados desde o ultimo save (ou so `keys`) para
+        gravar depois com write(), talvez em outra thread. Retorna {setor:
+        blocos ou None} e tira os setores de world.dirty."""
+        keys = set(world.dirty if keys is None else keys)
+        sectors = {}
+        for key in keys:
+            sector = world.sectors.get(key)
+            sectors[key] = sector.blocks.copy() if sector is not None and sector.count else None
+        with self.lock:
+            self.pending.update(sectors)
+        world.dirty -= keys
+        return sectors
+
+    def write(self, sectors):
+        """Grava {setor: blocos ou None}; a compressao fica fora do lock."""
+        regions = {}
+        for key, blocks in sectors.items():
+            payload = b'' if blocks is None else zlib.compress(blocks.tobytes(), 1)
+            regions.setdefault(regionize(key), {})[key] = payload
+        for key, payloads in regions.items():
+            with self.lock:
+                self.region(key).write(payloads)
+                for sector in payloads:
+                    # Um stage() mais novo do mesmo setor continua pendente.
+                    if self.pending.get(sector, self) is sectors[sector]:
+                        del self.pending[sector]
+
+    def save(self, world, keys=None):
+        """Grava apenas os setores alterados desde o ultimo save (ou so `keys`, se dado)."""
+        self.write(self.stage(world, keys))
+
+    def close(self):
+        with self.lock:
+            for region in self.regions.values():
+                region.close()
+
+class Journal(object):
+    """Diario append-only das edicoes de bloco de um mundo salvo.
+
+    append() so poe a edicao numa fila em memoria; uma thread junta o que
+    chegou e anexa ao segmento atual. Gravar setores nas regioes tambem
+    passa por essa thread (write e compact), na ordem da fila, entao um
+    retrato velho de um setor nunca e gravado por cima de um mais novo.
+
+    compact() comeca um segmento novo e, depois de gravar nas regioes os
+    setores alterados, apaga os segmentos anteriores: o que eles descrevem
+    ja esta na base. Segmentos que sobram ao abrir o mundo sao de uma sessao
+    que nao fechou direito, e read() os devolve para serem reaplicados.
+
+    Se a thread para num erro de E/S (disco cheio, permissao), append(),
+    write() e compact() levantam esse erro em vez de encher a fila.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        segments = self.segments()
+        self.segment = segments[-1] + 1 if segments else 0
+        # Edicoes desde o ultimo compact().
+        self.count = 0
+        self.error = None
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _path(self, segment):
+        return os.path.join(self.storage.path, '%s%d.bin' % (JOURNAL_PREFIX, segment))
+
+    def segments(self):
+        names = [name[len(JOURNAL_PREFIX):-len('.bin')] for name in os.listdir(self.storage.path)
+                 if name.startswith(JOURNAL_PREFIX) and name.endswith('.bin')]
+        return sorted(int(name) for name in names if name.isdigit())
+
+    def read(self):
+        """Registros (x, y, z, antigo, novo, tick) de todos os segmentos, em ordem."""
+        records = []
+        for segment in self.segments():
+            with open(self._path(segment), 'rb') as f:
+                data = f.read()
+            # Um registro cortado no fim e de uma escrita que nao terminou.
+            end = len(data) - len(data) % JOURNAL.size
+            records.extend(JOURNAL.iter_unpack(data[:end]))
+        return records
+
+    def discard(self, before=None):
+        """Apaga os segmentos anteriores a `before` (todos, sem ele)."""
+        for segment in self.segments():
+            if before is None or segment < before:
+                os.remove(self._path(segment))
+
+    def check(self):
+        """Levanta o erro que parou a thread do diario, se houve."""
+        if self.error is not None:
+            raise self.error
+
+    def append(self, position, old, new, tick):
+        self.check()
+        self.queue.put((position, old, new, tick))
+        self.count += 1
+
+    def write(self, sectors):
+        """Grava na thread do diario setores copiados por Storage.stage()."""
+        self.check()
+        if sectors: self.queue.put((sectors, None))
+
+    def compact(self, sectors):
+        """Grava `sectors` (Storage.stage() de tudo que mudou) e descarta o diario ate aqui."""
+        self.check()
+        self.segment += 1
+        self.count = 0
+        self.queue.put((sectors, self.segment))
+
+    def close(self):
+        """Espera a fila esvaziar e para a thread."""
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
+
+    def _append(self, f, segment, records):
+        if records:
+            if f is None: f = open(self._path(segment), 'ab')
+            f.write(b''.join(records))
+            f.flush()
+        return f
+
+    def _run(self):
+        segment, f = self.segment, None
+        try:
+            while True:
+                items = [self.queue.get()]
+                try:
+                    while len(items) < JOURNAL_BATCH:
+                        items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    pass
+                records = []
+                for item in items:
+                    if item is not None and len(item) == 4:
+                        (x, y, z), old, new, tick = item
+                        records.append(JOURNAL.pack(x, y, z, old, new, tick))
+                        continue
+                    f, records = self._append(f, segment, records), []
+                    if item is None:
+                        return
+                    sectors, start = item
+                    if start is not None and f is not None:
+                        f.close()
+                        f = None
+                    self.storage.write(sectors)
+                    if start is not None:
+                        segment = start
+                        self.discard(start)
+                f = self._append(f, segment, records)
+        except Exception as error:
+            self.error = error
+        finally:
+            if f is not None: f.close()
@@ -1,28 +1,87 @@
 import random
 
+import numpy
+
+class Blueprint(object):
+    """Blueprint compilado: array denso int8 [x, y, z] com o tipo de cada celula (-1 = vazio).
+
+    Rotacoes (passos de 90 graus em torno de Y) e espelhamento (eixo X) sao
+    calculados uma vez e guardados, assim como as paletas de material.
+    """
+
+    def __init__(self, cells):
+        self.cells = cells
+        self.shape = cells.shape
+        self._variants = {}
+        self._palettes = {}
+
+    def transform(self, rotation=0, mirror=False):
+        key = (rotation % 4, bool(mirror))
+        if key == (0, False):
+            return self
+        variant = self._variants.get(key)
+        if variant is None:
+            cells = self.cells[::-1] if mirror else self.cells
+            variant = self._variants[key] = Blueprint(numpy.ascontiguousarray(numpy.rot90(cells, key[0], axes=(0, 2))))
+        return variant
+
+    def palette(self, materials):
+        """Tabela tipo + 1 -> ID do bloco; tipos fora de `materials` viram ar (nao escritos)."""
+        key = tuple(sorted(materials.items()))
+        table = self._palettes.get(key)
+        if table is None:
+            table = numpy.zeros(max([int(self.cells.max()), 0] + list(materials)) + 2, dtype=numpy.uint8)
+            for block_type, block in materials.items():
+                if block_type >= 0:
+                    table[block_type + 1] = block
+            table = self._palettes[key] = table
+        return table
+
+    def volume(self, materials):
+        return self.palette(materials)[self.cells + 1]
+
+_compiled = {}
+
+def compile_blueprint(structure_data):
+    """Converte as listas aninhadas [y][z][x] de um blueprint; o resultado fica em cache."""
+    entry = _compiled.get(id(structure_data))
+    if entry is None or entry[0] is not structure_data:
+        cells = numpy.array(structure_data, dtype=numpy.int8).transpose(2, 0, 1)
+        entry = _compiled[id(structure_data)] = (structure_data, Blueprint(numpy.ascontiguousarray(cells)))
+    return entry[1]
+
 class StructureBuilder:
     def __init__(self, model):
         self.model = model
 
-    def build(self, position, structure_data, materials):
-        start_x, start_y, start_z = position
-        
-        for y, layer in enumerate(structure_data):
-            # Itera sobre as linhas (profundidade Z)
-            for z, row in enumerate(layer):
-                # Itera sobre as colunas (largura X)
-                for x, block_type in enumerate(row):
-                    # Se o bloco for -1 (ou None), é ar, então pulamos
-                    if block_type == -1:
-                        continue
-                    
-                    # Pega a textura correspondente ao ID (0, 1, 2, etc)
-                    if block_type in materials:
-                        texture = materials[block_type]
-                        # Calcula a posição real no mundo
-                        world_pos = (start_x + x, start_y + y, start_z + z)
-                        # Adiciona o bloco (immediate=False para ser rápido na geração inicial)
-                        self.model.add_block(world_pos, texture, immediate=False)
+    def build(self, position, structure_data, materials, rotation=0, mirror=False):
+        """Coloca uma estrutura com o canto minimo em `position`."""
+        return self.build_many([(position, structure_data, materials, rotation, mirror)])
+
+    def build_many(self, jobs):
+        """Carimba varias estruturas numa passada so.
+
+        Cada job e (position, blueprint, materials[, rotation[, mirror]]). As
+        celulas vazias e os tipos sem material nao tocam o mundo; os setores
+        tocados tem mascaras e malhas atualizadas uma unica vez no fim.
+        """
+        return self.model.stamp(self.volumes(jobs))
+
+    def fits(self, jobs):
+        """Para cada job (como em build_many), se a caixa da estrutura esta vazia no mundo."""
+        stamps = self.volumes(jobs)
+        los = [origin for origin, volume in stamps]
+        his = [[origin[k] + volume.shape[k] - 1 for k in range(3)] for origin, volume in stamps]
+        return self.model.spatial.empty_many(los, his)
+
+    def volumes(self, jobs):
+        """Os (origin, volume) que build_many escreveria, para juntar a outros pastes."""
+        stamps = []
+        for job in jobs:
+            position, structure_data, materials = job[:3]
+            blueprint = compile_blueprint(structure_data).transform(*job[3:])
+            stamps.append((position, blueprint.volume(materials)))
+        return stamps
 
 # --- DEFINIÇÃO DAS ESTRUTURAS (BLUEPRINTS) ---
 # 0: Chão (Ex: Pedra/Areia)
@@ -0,0 +1,113 @@
+import sys
+import random
+import time
+
+import numpy
+
+from blocks import GRASS, SAND, BRICK, STONE, DIRT
+from world import World, SECTOR_SIZE, WORLD_BOTTOM, WORLD_HEIGHT
+
+# Mundo infinito: altura do terreno em cada coluna vem de ruido de valor com
+# varias oitavas, funcao pura de (seed, x, z); setores vizinhos sempre batem.
+SEA_LEVEL = -1
+BASE_HEIGHT = 0
+OCTAVES = [(64.0, 12.0), (32.0, 6.0), (16.0, 3.0), (8.0, 1.5)]
+
+def generate(n=80, seed=None):
+    """Gera a ilha (terreno base, borda de pedra e morros) como um volume denso.
+
+    Retorna (origin, volume), com volume indexado [x, y, z] a partir de origin.
+    Consome o RNG na mesma ordem do laco original, entao a mesma seed produz
+    o mesmo mundo.
+    """
+    rng = random.Random(seed)
+    y, o = 0, n - 10
+    hills = []
+    for _ in range(120):
+        a, b, c = rng.randint(-o, o), rng.randint(-o, o), -1
+        h, s = rng.randint(1, 6), rng.randint(4, 8)
+        hills.append((a, b, c, h, s, rng.choice([GRASS, SAND, BRICK])))
+
+    bottom = y - 3
+    top = max([y + 2] + [c + h - 1 for a, b, c, h, s, t in hills])
+    origin = (-n, bottom, -n)
+    volume = numpy.zeros((2 * n + 1, top - bottom + 1, 2 * n + 1), dtype=numpy.uint8)
+
+    # Terreno base
+    volume[:, y - 2 - bottom] = GRASS
+    volume[:, y - 3 - bottom] = STONE
+    border = slice(y - 2 - bottom, y + 3 - bottom)
+    volume[0, border] = volume[-1, border] = STONE
+    volume[:, border, 0] = volume[:, border, -1] = STONE
+
+    # Morros
+    for a, b, c, h, s, t in hills:
+        for y_hill in range(c, c + h):
+            if s >= 0:
+                xs = numpy.arange(a - s, a + s + 1)[:, None]
+                zs = numpy.arange(b - s, b + s + 1)[None, :]
+                inside = ((xs - a) ** 2 + (zs - b) ** 2 <= (s + 1) ** 2) & (xs ** 2 + zs ** 2 >= 25)
+                layer = volume[a - s + n:a + s + n + 1, y_hill - bottom, b - s + n:b + s + n + 1]
+                layer[inside] = t
+            s -= 1
+    return origin, volume
+
+def _hash(seed, xs, zs):
+    h = xs.astype(numpy.uint64) * numpy.uint64(374761393) + zs.astype(numpy.uint64) * numpy.uint64(668265263)
+    h = (h + numpy.uint64(seed & 0xFFFFFFFF) * numpy.uint64(2246822519)) & numpy.uint64(0xFFFFFFFF)
+    h = ((h ^ (h >> numpy.uint64(13))) * numpy.uint64(1274126177)) & numpy.uint64(0xFFFFFFFF)
+    h ^= h >> numpy.uint64(16)
+    return h.astype(numpy.float64) / 4294967296.0
+
+def _value_noise(seed, xs, zs, scale):
+    fx, fz = xs / scale, zs / scale
+    x0, z0 = numpy.floor(fx), numpy.floor(fz)
+    tx, tz = fx - x0, fz - z0
+    tx, tz = tx * tx * (3 - 2 * tx), tz * tz * (3 - 2 * tz)
+    x0, z0 = x0.astype(numpy.int64), z0.astype(numpy.int64)
+    a, b = _hash(seed, x0, z0), _hash(seed, x0 + 1, z0)
+    c, d = _hash(seed, x0, z0 + 1), _hash(seed, x0 + 1, z0 + 1)
+    return (a + (b - a) * tx) + ((c + (d - c) * tx) - (a + (b - a) * tx)) * tz
+
+def height(seed, xs, zs):
+    """Altura (y do bloco do topo) das colunas xs, zs; aceita escalares ou arrays."""
+    xs, zs = numpy.asarray(xs, dtype=numpy.float64), numpy.asarray(zs, dtype=numpy.float64)
+    total = numpy.zeros(numpy.broadcast(xs, zs).shape)
+    for i, (scale, amplitude) in enumerate(OCTAVES):
+        total += (_value_noise(seed + i, xs, zs, scale) - 0.5) * 2 * amplitude
+    return (BASE_HEIGHT + numpy.floor(total)).astype(numpy.int64)
+
+def generate_sector(seed, sector):
+    """Blocos de um setor do mundo infinito. Roda nos processos do gerador."""
+    xs = numpy.arange(SECTOR_SIZE) + sector[0] * SECTOR_SIZE
+    zs = numpy.arange(SECTOR_SIZE) + sector[2] * SECTOR_SIZE
+    top = height(seed, xs[:, None], zs[None, :])[:, None, :]
+    ys = (numpy.arange(WORLD_HEIGHT) + WORLD_BOTTOM)[None, :, None]
+    blocks = numpy.zeros((SECTOR_SIZE, WORLD_HEIGHT, SECTOR_SIZE), dtype=numpy.uint8)
+    blocks[numpy.broadcast_to(ys <= top - 3, blocks.shape)] = STONE
+    blocks[numpy.broadcast_to((ys > top - 3) & (ys < top), blocks.shape)] = DIRT
+    surface = numpy.where(top > SEA_LEVEL, GRASS, SAND).astype(numpy.uint8)
+    return numpy.where(ys == top, surface, blocks)
+
+def surface(seed, sector):
+    """Mapa de alturas (como mesher.heightmap) de generate_sector sem gerar os
+    blocos; usado pelas malhas LOD de setores que nao estao na memoria."""
+    xs = numpy.arange(SECTOR_SIZE) + sector[0] * SECTOR_SIZE
+    zs = numpy.arange(SECTOR_SIZE) + sector[2] * SECTOR_SIZE
+    top = height(seed, xs[:, None], zs[None, :])
+    tops = numpy.where(top > SEA_LEVEL, GRASS, SAND).astype(numpy.uint8)
+    return numpy.clip(top - WORLD_BOTTOM, -1, WORLD_HEIGHT - 1).astype(numpy.int16), tops
+
+def main(args):
+    for n in [int(arg) for arg in args] or [80]:
+        start = time.perf_counter()
+        origin, volume = generate(n, seed=0)
+        generated = time.perf_counter()
+        world = World()
+        world.paste(origin, volume)
+        pasted = time.perf_counter()
+        print('n=%d generate=%.4fs paste=%.4fs blocks=%d' % (
+            n, generated - start, pasted - generated, len(world)))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,41 @@
+import os
+
+# Sem display: o pyglet cria os contextos GL dos testes pelo EGL.
+os.environ.setdefault('PYGLET_HEADLESS', '1')
+
+import pytest
+import pyglet
+pyglet.options['shadow_window'] = False
+
+import main
+import render
+from world import SECTOR_SIZE
+
+@pytest.fixture(scope='module')
+def island():
+    """Mundo finito da seed 1 (ilha e estruturas), com os setores em volta do spawn carregados."""
+    model = main.Model(seed=1, backend=render.NullBackend())
+    model.change_sectors(None, (0, 0, 0))
+    model.process_entire_queue()
+    yield model
+    model.close()
+
+@pytest.fixture
+def walk(monkeypatch):
+    """(model, walk): um mundo infinito com MAX_SECTORS baixo e uma funcao que
+    anda com ele para leste, chamando visit(x) em cada parada (x em blocos).
+    walk devolve quantos setores foram descartados no caminho."""
+    monkeypatch.setattr(main, 'MAX_SECTORS', 120)
+    model = main.Model(seed=7, infinite=True, backend=render.NullBackend())
+    def walk(visit, stops=range(0, 24, 2)):
+        before, evicted = None, 0
+        for step in stops:
+            loaded = set(model.world.sectors)
+            model.change_sectors(before, (step, 0, 0))
+            model.process_entire_queue()
+            evicted += len(loaded - set(model.world.sectors))
+            before = (step, 0, 0)
+            visit(step * SECTOR_SIZE)
+        return evicted
+    yield model, walk
+    model.close()
@@ -0,0 +1,127 @@
+import os
+import errno
+import random
+
+import pytest
+import pyglet
+pyglet.options['shadow_window'] = False
+
+import main
+import render
+import storage
+from blocks import BRICK, GRASS, SAND
+from world import SECTOR_SIZE, sectorize
+
+def abandon(model):
+    """Larga o Model como uma sessao que caiu: o que a thread do diario ja
+    recebeu chega ao disco, mas as regioes nao sao salvas nem o diario apagado."""
+    model.journal.queue.put(None)
+    model.journal.thread.join()
+    model.executor.shutdown()
+    if model.generator: model.generator.shutdown()
+
+def block_at(model, position):
+    model.request_sector(sectorize(position))
+    model.process_entire_queue()
+    return model.world.get(position, 0)
+
+def edit(model, rng, x0, z0, count):
+    """`count` edicoes ao acaso na coluna de setores de (x0, z0); devolve o estado final de cada celula."""
+    edits = {}
+    for _ in range(count):
+        position = (x0 + rng.randrange(SECTOR_SIZE), rng.randint(20, 40), z0 + rng.randrange(SECTOR_SIZE))
+        if rng.random() < 0.3 and position in model.world:
+            model.remove_block(position)
+            edits[position] = 0
+        else:
+            block = rng.choice([BRICK, GRASS, SAND])
+            model.add_block(position, block)
+            edits[position] = block
+    return edits
+
+def reopen(path, edits, **kwargs):
+    model = main.Model(path=path, backend=render.NullBackend(), **kwargs)
+    try:
+        return dict((position, block_at(model, position)) for position in edits)
+    finally:
+        model.close()
+
+def test_new_finite_world_keeps_its_seed(tmp_path):
+    path = str(tmp_path / 'mundo')
+    model = main.Model(path=path, backend=render.NullBackend())
+    abandon(model)
+    assert storage.Storage(path).read_meta() == {'seed': model.seed, 'infinite': False}
+    reopened = main.Model(seed=model.seed + 1, path=path, infinite=True, backend=render.NullBackend())
+    try:
+        assert (reopened.seed, reopened.infinite) == (model.seed, False)
+    finally:
+        reopened.close()
+
+def test_edits_survive_an_unclean_exit(tmp_path):
+    path = str(tmp_path / 'mundo')
+    model = main.Model(seed=1, path=path, backend=render.NullBackend())
+    edits = edit(model, random.Random(1), 0, 0, 200)
+    abandon(model)
+    assert reopen(path, edits) == edits
+
+def test_edits_survive_across_a_compaction(tmp_path):
+    path = str(tmp_path / 'mundo')
+    model = main.Model(seed=1, path=path, backend=render.NullBackend())
+    rng = random.Random(2)
+    edits = edit(model, rng, 0, 0, 100)
+    model.autosave(force=True)
+    edits.update(edit(model, rng, 0, 0, 100))
+    edits.update(edit(model, rng, -SECTOR_SIZE, 0, 50))
+    abandon(model)
+    assert reopen(path, edits) == edits
+
+def test_edits_survive_across_an_eviction(tmp_path, monkeypatch):
+    # Os setores editados saem da memoria (gravados pela thread do diario) e
+    # mais edicoes chegam depois, longe deles.
+    monkeypatch.setattr(main, 'MAX_SECTORS', 120)
+    path = str(tmp_path / 'mundo')
+    model = main.Model(seed=1, path=path, infinite=True, backend=render.NullBackend())
+    rng = random.Random(3)
+    model.change_sectors(None, (0, 0, 0))
+    model.process_entire_queue()
+    edits = edit(model, rng, 0, 0, 100)
+    before = (0, 0, 0)
+    for step in range(2, 24, 2):
+        model.change_sectors(before, (step, 0, 0))
+        model.process_entire_queue()
+        before = (step, 0, 0)
+    assert (0, 0, 0) not in model.world.sectors
+    edits.update(edit(model, rng, 22 * SECTOR_SIZE, 0, 100))
+    abandon(model)
+    assert reopen(path, edits) == edits
+
+def test_torn_final_record_is_ignored(tmp_path):
+    path = str(tmp_path / 'mundo')
+    model = main.Model(seed=1, path=path, backend=render.NullBackend())
+    edits = edit(model, random.Random(4), 0, 0, 50)
+    abandon(model)
+    segment = model.journal._path(model.journal.segments()[-1])
+    # A sessao caiu no meio de um registro: sobra so o comeco dele.
+    with open(segment, 'ab') as f:
+        f.write(storage.JOURNAL.pack(1, 30, 1, 0, BRICK, 0)[:storage.JOURNAL.size // 2])
+    assert os.path.getsize(segment) % storage.JOURNAL.size
+    assert reopen(path, edits) == edits
+
+def test_writer_error_stops_the_journal(tmp_path, monkeypatch):
+    model = main.Model(seed=1, path=str(tmp_path / 'mundo'), backend=render.NullBackend())
+    def full(self, sectors):
+        raise OSError(errno.ENOSPC, 'disco cheio')
+    monkeypatch.setattr(storage.Storage, 'write', full)
+    model.add_block((3, 30, 3), BRICK)
+    model.autosave(force=True)
+    model.journal.thread.join(5)
+    assert not model.journal.thread.is_alive()
+    # Com a thread parada, as edicoes e o autosave levantam o erro em vez de enfileirar.
+    with pytest.raises(OSError):
+        model.add_block((4, 30, 3), BRICK)
+    with pytest.raises(OSError):
+        model.autosave()
+    assert model.journal.queue.empty()
+    monkeypatch.undo()
+    with pytest.raises(OSError):
+        model.close()
@@ -0,0 +1,63 @@
+import random
+
+import numpy
+import pytest
+
+import light
+import terrain
+from blocks import LAMP, STONE
+from world import World, SECTOR_SIZE, WORLD_BOTTOM
+
+S = SECTOR_SIZE
+
+def island(seed):
+    """Ilha pequena com tetos (lajes a 4 blocos do chao) e lampadas embaixo deles, ja acesa."""
+    world = World(None)
+    world.paste(*terrain.generate(24, seed))
+    rng = random.Random(seed)
+    roofs = []
+    for _ in range(6):
+        x, z = rng.randint(-20, 14), rng.randint(-20, 14)
+        y = world.sectors[(x // S, 0, z // S)].blocks[x % S, :, z % S].nonzero()[0][-1] + WORLD_BOTTOM + 5
+        slab = numpy.full((6, 1, 6), STONE, dtype=numpy.uint8)
+        world.paste((x, y, z), slab)
+        world[(x + 2, y - 2, z + 2)] = LAMP
+        roofs.append((x, y, z))
+    light.relight(world, list(world.sectors))
+    return world, roofs
+
+def relit(world):
+    """Os mesmos blocos num mundo novo, acesos do zero."""
+    fresh = World(None)
+    for key, sector in world.sectors.items():
+        fresh.insert(key, sector.blocks.copy())
+    light.relight(fresh, list(fresh.sectors))
+    return fresh
+
+def assert_same_light(world):
+    fresh = relit(world)
+    for key, sector in world.sectors.items():
+        for channel in (light.SKY, light.BLOCK):
+            assert numpy.array_equal(sector.light[channel], fresh.sectors[key].light[channel]), (key, channel)
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_edits_match_a_full_relight(seed):
+    world, roofs = island(seed)
+    assert_same_light(world)
+    rng = random.Random(seed)
+    for step in range(150):
+        # Perto de uma lampada, embaixo ou em cima de um teto.
+        x, y, z = rng.choice(roofs)
+        position = (x + rng.randint(-2, 7), y + rng.randint(-4, 1), z + rng.randint(-2, 7))
+        before = dict((key, sector.light.copy()) for key, sector in world.sectors.items())
+        if position in world:
+            del world[position]
+            changed = light.block_removed(world, position)
+        else:
+            world[position] = rng.choice([STONE, STONE, LAMP])
+            changed = light.block_added(world, position)
+        # Todo setor cuja luz mudou tem de ser refeito pelo Model.
+        assert set(key for key, sector in world.sectors.items() if (sector.light != before[key]).any()) <= changed
+        if step % 10 == 9:
+            assert_same_light(world)
+    assert_same_light(world)
@@ -0,0 +1,139 @@
+import collections
+import random
+
+import numpy
+import pytest
+
+import pathfind
+from blocks import STONE
+from physics import PLAYER_HEIGHT
+from world import World, SECTOR_SIZE, WORLD_BOTTOM, WORLD_HEIGHT
+
+S = SECTOR_SIZE
+
+def test_caches_follow_evicted_sectors(walk):
+    # Anda o bastante para descartar setores; os caches do pathfinder nao
+    # podem guardar setores que sairam do mundo.
+    model, walk = walk
+    top = lambda x, z: (x, model.spatial.top(x, z)[0] + 1, z)
+    def visit(x):
+        model.paths.find(top(x - 40, -20), top(x + 40, 20))
+        sectors = model.world.sectors
+        assert all(key in sectors and local.sector is sectors[key] for key, local in model.paths.locals.items())
+        assert all(a in sectors and b in sectors for a, b in model.paths.edges)
+    assert walk(visit) > 0
+
+class Grid(object):
+    """As regras de andar lidas celula a celula de um array com todos os
+    setores carregados, para conferir o pathfinder."""
+
+    def __init__(self, world):
+        keys = list(world.sectors)
+        x0, z0 = min(key[0] for key in keys), min(key[2] for key in keys)
+        x1, z1 = max(key[0] for key in keys), max(key[2] for key in keys)
+        self.origin = (x0 * S, WORLD_BOTTOM, z0 * S)
+        self.blocks = numpy.zeros(((x1 - x0 + 1) * S, WORLD_HEIGHT, (z1 - z0 + 1) * S), dtype=numpy.uint8)
+        for (kx, _, kz), sector in world.sectors.items():
+            self.blocks[(kx - x0) * S:(kx - x0 + 1) * S, :, (kz - z0) * S:(kz - z0 + 1) * S] = sector.blocks
+
+    def solid(self, cell):
+        x, y, z = (c - o for c, o in zip(cell, self.origin))
+        shape = self.blocks.shape
+        return 0 <= x < shape[0] and 0 <= y < shape[1] and 0 <= z < shape[2] and self.blocks[x, y, z] != 0
+
+    def walk(self, cell):
+        x, y, z = cell
+        inside = 0 <= y - WORLD_BOTTOM < WORLD_HEIGHT
+        return inside and self.solid((x, y - 1, z)) and not any(self.solid((x, y + dy, z)) for dy in range(PLAYER_HEIGHT))
+
+    def tall(self, cell):
+        x, y, z = cell
+        return self.walk(cell) and not self.solid((x, y + PLAYER_HEIGHT, z))
+
+    def step(self, a, b):
+        """Se um passo leva de a a b: lateral, subindo com espaco para a cabeca em a
+        ou descendo para uma celula com espaco para a cabeca."""
+        if abs(a[0] - b[0]) + abs(a[2] - b[2]) != 1 or not self.walk(b):
+            return False
+        dy = b[1] - a[1]
+        return dy == 0 or (dy == 1 and self.tall(a)) or (dy == -1 and self.tall(b))
+
+    def reachable(self, start):
+        seen = {start}
+        queue = collections.deque([start])
+        while queue:
+            x, y, z = cell = queue.popleft()
+            for dx, dz in pathfind.STEPS:
+                for dy in (-1, 0, 1):
+                    neighbour = (x + dx, y + dy, z + dz)
+                    if neighbour not in seen and self.step(cell, neighbour):
+                        seen.add(neighbour)
+                        queue.append(neighbour)
+        return seen
+
+    def drop(self, x, z):
+        """A celula de pe mais alta da coluna, ou None."""
+        for y in range(WORLD_BOTTOM + WORLD_HEIGHT - 1, WORLD_BOTTOM, -1):
+            if self.walk((x, y, z)):
+                return (x, y, z)
+
+@pytest.fixture(scope='module')
+def grid(island):
+    return Grid(island.world)
+
+def check(grid, path, start, goal):
+    assert path[0] == start and path[-1] == goal
+    assert all(grid.walk(cell) for cell in path)
+    assert all(grid.step(a, b) for a, b in zip(path, path[1:]))
+
+def test_paths_match_a_flood_fill(island, grid):
+    rng = random.Random(1)
+    found = 0
+    for _ in range(6):
+        start = None
+        while start is None:
+            start = grid.drop(rng.randint(-60, 60), rng.randint(-60, 60))
+        reachable = grid.reachable(start)
+        inside = rng.sample(sorted(reachable), 4)
+        goals = inside + [grid.drop(rng.randint(-60, 60), rng.randint(-60, 60)) for _ in range(4)]
+        for goal in filter(None, goals):
+            path = island.paths.find(start, goal)
+            assert (path is not None) == (goal in reachable)
+            if path is not None:
+                found += 1
+                check(grid, path, start, goal)
+    assert found
+
+def corridor():
+    """Corredor de largura 1 com um degrau: chao em y=0 ate x=4 e em y=1 de x=5 a 9."""
+    world = World(None)
+    for x in range(10):
+        world[(x, 0, 0)] = STONE
+        if x >= 5:
+            world[(x, 1, 0)] = STONE
+    return world
+
+def test_steps_need_headroom():
+    world = corridor()
+    paths = pathfind.Pathfinder(world)
+    start, goal = (0, 1, 0), (9, 2, 0)
+    grid = Grid(world)
+    check(grid, paths.find(start, goal), start, goal)
+    check(grid, paths.find(goal, start), goal, start)
+    # Um teto em cima da celula do degrau: da para andar embaixo dele, mas
+    # nao subir nem descer por ali.
+    world[(4, 1 + PLAYER_HEIGHT, 0)] = STONE
+    paths.invalidate((4, 1 + PLAYER_HEIGHT, 0))
+    assert paths.region((4, 1, 0)) is not None
+    assert paths.find(start, goal) is None
+    assert paths.find(goal, start) is None
+
+def test_unreachable_goals():
+    world = corridor()
+    paths = pathfind.Pathfinder(world)
+    # Celula de pe sem ligacao com o corredor, em outro setor.
+    world[(40, 0, 40)] = STONE
+    assert paths.region((40, 1, 40)) is not None
+    assert paths.find((0, 1, 0), (40, 1, 40)) is None
+    # Sem chao ate GROUND abaixo do objetivo.
+    assert paths.find((0, 1, 0), (0, 1 + pathfind.GROUND + 2, 5)) is None
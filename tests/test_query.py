@@ -0,0 +1,117 @@
+import random
+
+import numpy
+import pytest
+
+import query
+from blocks import BRICK, GRASS, SAND, STONE
+from world import World, SECTOR_SIZE, WORLD_BOTTOM, WORLD_HEIGHT
+
+S = SECTOR_SIZE
+TYPES = [None, GRASS, SAND, STONE, BRICK]
+
+@pytest.fixture(scope='module')
+def grid(island):
+    """(origin, blocks): todos os setores carregados num array so, com ar nos que faltam."""
+    keys = list(island.world.sectors)
+    x0, z0 = min(key[0] for key in keys), min(key[2] for key in keys)
+    x1, z1 = max(key[0] for key in keys), max(key[2] for key in keys)
+    blocks = numpy.zeros(((x1 - x0 + 1) * S, WORLD_HEIGHT, (z1 - z0 + 1) * S), dtype=numpy.uint8)
+    for (kx, _, kz), sector in island.world.sectors.items():
+        blocks[(kx - x0) * S:(kx - x0 + 1) * S, :, (kz - z0) * S:(kz - z0 + 1) * S] = sector.blocks
+    return numpy.array([x0 * S, WORLD_BOTTOM, z0 * S]), blocks
+
+def scan(grid, lo, hi, block):
+    """Posicoes (N, 3) dos blocos do tipo (ou solidos) na caixa lo..hi, olhando celula a celula."""
+    origin, blocks = grid
+    a = numpy.maximum(numpy.asarray(lo) - origin, 0)
+    b = numpy.minimum(numpy.asarray(hi) - origin + 1, blocks.shape)
+    if (a >= b).any():
+        return numpy.zeros((0, 3), dtype=numpy.int64)
+    part = blocks[a[0]:b[0], a[1]:b[1], a[2]:b[2]]
+    mask = part != 0 if block is None else part == block
+    return numpy.argwhere(mask) + a + origin
+
+def boxes(rng, n, size=12):
+    los = numpy.array([(rng.randint(-70, 60), rng.randint(-40, 40), rng.randint(-70, 60)) for _ in range(n)])
+    return los, los + [(rng.randint(0, size), rng.randint(0, size), rng.randint(0, size)) for _ in range(n)]
+
+def test_summaries_follow_evicted_sectors(walk):
+    # Consultas em volta do jogador enquanto ele anda: os resumos dos setores
+    # descartados saem junto com eles.
+    model, walk = walk
+    def visit(x):
+        model.spatial.count((x - 64, -32, -64), (x + 64, 40, 64))
+        assert set(model.spatial.summaries) <= set(model.world.sectors)
+    assert walk(visit) > 0
+
+def test_count_many_matches_scan(island, grid):
+    rng = random.Random(1)
+    los, his = boxes(rng, 300)
+    # Muitas caixas no mesmo setor passam pelas somas acumuladas.
+    inner = numpy.array([(rng.randint(0, 10), rng.randint(-10, 20), rng.randint(0, 10)) for _ in range(40)])
+    los, his = numpy.concatenate([los, inner]), numpy.concatenate([his, inner + 5])
+    for block in TYPES:
+        expected = [len(scan(grid, lo, hi, block)) for lo, hi in zip(los, his)]
+        assert island.spatial.count_many(los, his, block).tolist() == expected
+        assert island.spatial.count(los[0], his[0], block) == expected[0]
+    empty = [len(scan(grid, lo, hi, None)) == 0 for lo, hi in zip(los, his)]
+    assert island.spatial.empty_many(los, his).tolist() == empty
+    assert any(empty) and not all(empty)
+
+def test_box_and_sphere_match_scan(island, grid):
+    rng = random.Random(2)
+    los, his = boxes(rng, 60, size=20)
+    for block in TYPES:
+        for lo, hi in zip(los, his):
+            found = set(map(tuple, island.spatial.box(lo, hi, block).tolist()))
+            assert found == set(map(tuple, scan(grid, lo, hi, block).tolist()))
+    for _ in range(60):
+        center = numpy.array([rng.uniform(-60, 60), rng.uniform(-20, 30), rng.uniform(-60, 60)])
+        radius = rng.uniform(0.5, 9)
+        block = rng.choice(TYPES)
+        lo, hi = numpy.floor(center - radius).astype(int), numpy.ceil(center + radius).astype(int)
+        cells = scan(grid, lo, hi, block)
+        expected = cells[((cells - center) ** 2).sum(axis=1) <= radius * radius]
+        found = island.spatial.sphere(center, radius, block)
+        assert set(map(tuple, found.tolist())) == set(map(tuple, expected.tolist()))
+
+def test_tops_match_scan(island, grid):
+    origin, blocks = grid
+    rng = random.Random(3)
+    columns = [(rng.randint(-70, 70), rng.randint(-70, 70)) for _ in range(400)] + [(5000, 5000)]
+    ys, tops = island.spatial.tops(columns)
+    for (x, z), y, top in zip(columns, ys.tolist(), tops.tolist()):
+        lx, lz = x - origin[0], z - origin[2]
+        column = blocks[lx, :, lz] if 0 <= lx < blocks.shape[0] and 0 <= lz < blocks.shape[2] else numpy.zeros(1)
+        solid = numpy.flatnonzero(column)
+        if len(solid):
+            assert (y, top) == (solid[-1] + WORLD_BOTTOM, column[solid[-1]])
+        else:
+            assert (y, top) == (query.NO_TOP, 0)
+    assert island.spatial.top(5000, 5000) is None
+
+def test_nearest_many_matches_scan(island, grid):
+    origin, blocks = grid
+    rng = random.Random(4)
+    positions = numpy.array([(rng.uniform(-60, 60), rng.uniform(-20, 30), rng.uniform(-60, 60)) for _ in range(150)])
+    for block in TYPES:
+        cells = numpy.argwhere(blocks != 0 if block is None else blocks == block) + origin
+        found_cells, found = island.spatial.nearest_many(positions, block, 16)
+        for position, cell, ok in zip(positions, found_cells, found):
+            d2 = ((cells - position) ** 2).sum(axis=1)
+            assert ok == (len(d2) > 0 and d2.min() <= 16 * 16)
+            if ok:
+                # Qualquer empate serve, mas o bloco tem de estar a distancia minima.
+                assert ((cell - position) ** 2).sum() == d2.min()
+                assert tuple(cell.tolist()) == island.spatial.nearest(position, block, 16)
+
+def test_nearest_ties_keep_the_first_visited():
+    world = World(None)
+    index = query.SpatialIndex(world)
+    # No mesmo setor fica o de menor (x, y, z).
+    world[(2, 5, 5)] = world[(8, 5, 5)] = BRICK
+    assert index.nearest((5.0, 5, 5), BRICK) == (2, 5, 5)
+    # Em setores a mesma distancia, fica o do setor de menor chave.
+    world[(-1, 5, 40)] = world[(16, 5, 40)] = BRICK
+    assert index.nearest((7.5, 5, 40), BRICK) == (-1, 5, 40)
@@ -0,0 +1,77 @@
+import math
+
+import numpy
+import pytest
+import pyglet
+pyglet.options['shadow_window'] = False
+from pyglet.gl import *
+
+import main
+import render
+
+WIDTH, HEIGHT = 400, 300
+# Os dois backends passam por pipelines diferentes (fixo e GLSL), que arredondam
+# diferente nas bordas dos triangulos e dos texels: alguns pixels trocam de
+# texel ou de face, mas so uma fracao pequena da imagem.
+MAX_CHANGED = 0.005
+MAX_MEAN_DIFF = 0.5
+VIEWS = [((0, 0), (0, 3, 0)), ((90, -20), (5, 4, 5)), ((200, 10), (-10, 2, 20)),
+         ((45, -60), (20, 10, -20)), ((300, 30), (0, 1.5, 0))]
+
+@pytest.fixture(scope='module')
+def models():
+    try:
+        window = pyglet.window.Window(width=WIDTH, height=HEIGHT, visible=False)
+    except Exception as error:
+        pytest.skip('sem contexto GL: %s' % error)
+    main.setup()
+    glEnable(GL_DEPTH_TEST)
+    models = {}
+    try:
+        for name in ('quads', 'instanced'):
+            try:
+                backend = render.BACKENDS[name](main.TEXTURE_PATH)
+            except RuntimeError as error:
+                pytest.skip('sem GL 3.3: %s' % error)
+            model = models[name] = main.Model(seed=1, backend=backend)
+            model.change_sectors(None, (0, 0, 0))
+            model.process_entire_queue()
+        yield models
+    finally:
+        for model in models.values():
+            model.close()
+        window.close()
+
+def frame(model, rotation, position):
+    glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+    glMatrixMode(GL_PROJECTION)
+    glLoadIdentity()
+    gluPerspective(main.FOV, WIDTH / float(HEIGHT), main.NEAR, main.FAR)
+    glMatrixMode(GL_MODELVIEW)
+    glLoadIdentity()
+    x, y = rotation
+    glRotatef(x, 0, 1, 0)
+    glRotatef(-y, math.cos(math.radians(x)), 0, math.sin(math.radians(x)))
+    glTranslatef(*[-p for p in position])
+    glColor3d(1, 1, 1)
+    model.draw()
+    glFinish()
+    pixels = (GLubyte * (WIDTH * HEIGHT * 4))()
+    glReadPixels(0, 0, WIDTH, HEIGHT, GL_RGBA, GL_UNSIGNED_BYTE, pixels)
+    return numpy.frombuffer(pixels, dtype=numpy.uint8).reshape(HEIGHT, WIDTH, 4).astype(numpy.int64)
+
+def sky():
+    glClear(GL_COLOR_BUFFER_BIT)
+    pixel = (GLubyte * 4)()
+    glReadPixels(0, 0, 1, 1, GL_RGBA, GL_UNSIGNED_BYTE, pixel)
+    return tuple(pixel)[:3]
+
+@pytest.mark.parametrize('rotation, position', VIEWS)
+def test_instanced_matches_quads(models, rotation, position):
+    quads = frame(models['quads'], rotation, position)
+    instanced = frame(models['instanced'], rotation, position)
+    # O mundo precisa aparecer: um quadro so de ceu nao prova nada.
+    assert (quads[..., :3] != sky()).any(axis=2).mean() > 0.1
+    diff = numpy.abs(quads - instanced).max(axis=2)
+    assert (diff > 0).mean() <= MAX_CHANGED
+    assert diff.mean() <= MAX_MEAN_DIFF
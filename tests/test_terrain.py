@@ -0,0 +1,51 @@
+import random
+
+import numpy
+import pytest
+
+import terrain
+from blocks import BRICK, GRASS, SAND, STONE
+from world import World
+
+def reference(n, seed):
+    """A ilha montada bloco a bloco, como o laco original de Model._initialize."""
+    world = World(None)
+    rng = random.Random(seed)
+    y = 0
+
+    # Terreno base
+    for x in range(-n, n + 1):
+        for z in range(-n, n + 1):
+            world[(x, y - 2, z)] = GRASS
+            world[(x, y - 3, z)] = STONE
+            if x in (-n, n) or z in (-n, n):
+                for dy in range(-2, 3):
+                    world[(x, y + dy, z)] = STONE
+
+    # Morros
+    o = n - 10
+    for _ in range(120):
+        a, b, c = rng.randint(-o, o), rng.randint(-o, o), -1
+        h, s = rng.randint(1, 6), rng.randint(4, 8)
+        t = rng.choice([GRASS, SAND, BRICK])
+        for y_hill in range(c, c + h):
+            for x_hill in range(a - s, a + s + 1):
+                for z_hill in range(b - s, b + s + 1):
+                    if (x_hill - a) ** 2 + (z_hill - b) ** 2 > (s + 1) ** 2: continue
+                    if x_hill ** 2 + z_hill ** 2 < 25: continue
+                    world[(x_hill, y_hill, z_hill)] = t
+            s -= 1
+    return world
+
+@pytest.mark.parametrize('n, seed', [(80, 1), (40, 2), (40, 7), (24, 11)])
+def test_generate_and_paste_match_the_block_loop(n, seed):
+    expected = reference(n, seed)
+    world = World(None)
+    world.paste(*terrain.generate(n, seed))
+    assert set(world.sectors) == set(expected.sectors)
+    assert world.count == expected.count
+    for key, sector in world.sectors.items():
+        other = expected.sectors[key]
+        assert numpy.array_equal(sector.blocks, other.blocks), key
+        assert numpy.array_equal(sector.masks, other.masks), key
+        assert sector.count == other.count, key
@@ -0,0 +1,304 @@
+import numpy
+
+from blocks import AIR
+
+SECTOR_SIZE = 16
+WORLD_BOTTOM = -32
+WORLD_HEIGHT = 128
+
+FACES = [(0, 1, 0), (0, -1, 0), (-1, 0, 0), (1, 0, 0), (0, 0, 1), (0, 0, -1)]
+
+# Bit i da mascara de uma celula indica que o vizinho em FACES[i] e solido.
+# Faces opostas sao pares (i, i ^ 1).
+ALL_FACES = 0x3F
+
+def normalize(position):
+    x, y, z = position
+    return (int(round(x)), int(round(y)), int(round(z)))
+
+def sectorize(position):
+    x, y, z = normalize(position)
+    return (x // SECTOR_SIZE, 0, z // SECTOR_SIZE)
+
+def _stitch(sector, masks, blocks, bit):
+    sector.version += 1
+    masks &= ALL_FACES ^ (1 << bit)
+    masks |= (blocks != AIR).view(numpy.uint8) << bit
+
+class Sector(object):
+    """Coluna SECTOR_SIZE x WORLD_HEIGHT x SECTOR_SIZE de IDs de bloco, indexada [x, y, z].
+
+    `masks` guarda, para toda celula (ar ou nao), quais dos seis vizinhos sao solidos.
+    `light` guarda os niveis de luz do ceu e dos blocos (ver light.py).
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.origin = (key[0] * SECTOR_SIZE, WORLD_BOTTOM, key[2] * SECTOR_SIZE)
+        self.blocks = numpy.zeros((SECTOR_SIZE, WORLD_HEIGHT, SECTOR_SIZE), dtype=numpy.uint8)
+        self.masks = numpy.zeros((SECTOR_SIZE, WORLD_HEIGHT, SECTOR_SIZE), dtype=numpy.uint8)
+        self.light = numpy.zeros((2, SECTOR_SIZE, WORLD_HEIGHT, SECTOR_SIZE), dtype=numpy.uint8)
+        self.count = 0
+        # Incrementado sempre que blocos, mascaras ou luz mudam; invalida malhas em construcao.
+        self.version = 0
+
+    def positions(self):
+        ox, oy, oz = self.origin
+        xs, ys, zs = numpy.nonzero(self.blocks)
+        return list(zip((xs + ox).tolist(), (ys + oy).tolist(), (zs + oz).tolist()))
+
+    def __len__(self):
+        return self.count
+
+class World(object):
+    """Mapeamento (x, y, z) -> ID do bloco guardado em arrays densos por setor.
+
+    Mantem a interface de dicionario que o resto do jogo usa (`in`, `[]`,
+    `del`, `len`), mas o custo de memoria e de um byte por celula do setor.
+    """
+
+    def __init__(self, storage=None):
+        self.sectors = {}
+        self.count = 0
+        self.storage = storage
+        self.dirty = set()
+        # Contador global de alteracoes, para caches que dependem do mundo todo.
+        self.edits = 0
+
+    def _locate(self, position):
+        x, y, z = position
+        y -= WORLD_BOTTOM
+        if not 0 <= y < WORLD_HEIGHT:
+            return None, None
+        sector = self.sectors.get((x // SECTOR_SIZE, 0, z // SECTOR_SIZE))
+        return sector, (x % SECTOR_SIZE, y, z % SECTOR_SIZE)
+
+    def _sector(self, key):
+        sector = self.sectors.get(key)
+        if sector is None:
+            sector = self.sectors[key] = Sector(key)
+            x, _, z = key
+            # As celulas da borda herdam os bits dos vizinhos que ja existem.
+            neighbour = self.sectors.get((x - 1, 0, z))
+            if neighbour is not None: sector.masks[0] |= (neighbour.blocks[-1] != AIR).view(numpy.uint8) << 2
+            neighbour = self.sectors.get((x + 1, 0, z))
+            if neighbour is not None: sector.masks[-1] |= (neighbour.blocks[0] != AIR).view(numpy.uint8) << 3
+            neighbour = self.sectors.get((x, 0, z + 1))
+            if neighbour is not None: sector.masks[:, :, -1] |= (neighbour.blocks[:, :, 0] != AIR).view(numpy.uint8) << 4
+            neighbour = self.sectors.get((x, 0, z - 1))
+            if neighbour is not None: sector.masks[:, :, 0] |= (neighbour.blocks[:, :, -1] != AIR).view(numpy.uint8) << 5
+        return sector
+
+    def _link(self, position, solid):
+        # Atualiza o bit correspondente na mascara dos seis vizinhos.
+        x, y, z = position
+        for i, (dx, dy, dz) in enumerate(FACES):
+            sector, index = self._locate((x + dx, y + dy, z + dz))
+            if sector is None: continue
+            bit = 1 << (i ^ 1)
+            sector.version += 1
+            if solid:
+                sector.masks[index] |= bit
+            else:
+                sector.masks[index] &= ALL_FACES ^ bit
+
+    def mask(self, position):
+        sector, index = self._locate(position)
+        return 0 if sector is None else int(sector.masks[index])
+
+    def in_bounds(self, position):
+        return 0 <= position[1] - WORLD_BOTTOM < WORLD_HEIGHT
+
+    def get(self, position, default=None):
+        sector, index = self._locate(position)
+        if sector is None:
+            return default
+        block = sector.blocks[index]
+        return int(block) if block else default
+
+    def get_many(self, positions):
+        """IDs dos blocos em varias posicoes ((N, 3) inteiros) de uma vez; 0 = ar."""
+        positions = numpy.asarray(positions, dtype=numpy.int64).reshape(-1, 3)
+        result = numpy.zeros(len(positions), dtype=numpy.uint8)
+        xs, ys, zs = positions.T
+        ys = ys - WORLD_BOTTOM
+        rows = numpy.nonzero((ys >= 0) & (ys < WORLD_HEIGHT))[0]
+        if not len(rows):
+            return result
+        # Agrupa por setor ordenando uma chave inteira (x, z) unica por setor.
+        cx, cz = xs[rows] // SECTOR_SIZE, zs[rows] // SECTOR_SIZE
+        order = numpy.argsort(cx * (1 << 32) + cz, kind='stable')
+        rows, cx, cz = rows[order], cx[order], cz[order]
+        starts = numpy.flatnonzero(numpy.r_[True, (cx[1:] != cx[:-1]) | (cz[1:] != cz[:-1])])
+        for start, end in zip(starts.tolist(), numpy.r_[starts[1:], len(rows)].tolist()):
+            sector = self.sectors.get((int(cx[start]), 0, int(cz[start])))
+            if sector is not None:
+                group = rows[start:end]
+                result[group] = sector.blocks[xs[group] % SECTOR_SIZE, ys[group], zs[group] % SECTOR_SIZE]
+        return result
+
+    def __contains__(self, position):
+        sector, index = self._locate(position)
+        return sector is not None and sector.blocks[index] != AIR
+
+    def __getitem__(self, position):
+        block = self.get(position)
+        if block is None:
+            raise KeyError(position)
+        return block
+
+    def __setitem__(self, position, block):
+        if not self.in_bounds(position):
+            raise IndexError('altura fora do mundo: %r' % (position,))
+        x, y, z = position
+        sector = self._sector((x // SECTOR_SIZE, 0, z // SECTOR_SIZE))
+        index = (x % SECTOR_SIZE, y - WORLD_BOTTOM, z % SECTOR_SIZE)
+        self.dirty.add(sector.key)
+        self.edits += 1
+        if sector.blocks[index] == AIR:
+            sector.count += 1
+            self.count += 1
+            self._link(position, True)
+        sector.blocks[index] = block
+
+    def __delitem__(self, position):
+        sector, index = self._locate(position)
+        if sector is None or sector.blocks[index] == AIR:
+            raise KeyError(position)
+        self.dirty.add(sector.key)
+        self.edits += 1
+        sector.blocks[index] = AIR
+        sector.count -= 1
+        self.count -= 1
+        self._link(position, False)
+
+    def remask(self, sector, lo=0, hi=WORLD_HEIGHT):
+        """Recalcula de uma vez as mascaras de um setor (so das camadas lo:hi, se dadas)."""
+        S = SECTOR_SIZE
+        # solid[:, r] e a camada lo - 1 + r; a e b limitam as camadas que existem.
+        a, b = max(lo - 1, 0), min(hi + 1, WORLD_HEIGHT)
+        o = a - lo + 1
+        rows = slice(o, o + b - a)
+        solid = numpy.zeros((S + 2, hi - lo + 2, S + 2), dtype=numpy.uint8)
+        solid[1:-1, rows, 1:-1] = sector.blocks[:, a:b] != AIR
+        x, _, z = sector.key
+        neighbour = self.sectors.get((x - 1, 0, z))
+        if neighbour is not None: solid[0, rows, 1:-1] = neighbour.blocks[-1, a:b] != AIR
+        neighbour = self.sectors.get((x + 1, 0, z))
+        if neighbour is not None: solid[-1, rows, 1:-1] = neighbour.blocks[0, a:b] != AIR
+        neighbour = self.sectors.get((x, 0, z - 1))
+        if neighbour is not None: solid[1:-1, rows, 0] = neighbour.blocks[:, a:b, -1] != AIR
+        neighbour = self.sectors.get((x, 0, z + 1))
+        if neighbour is not None: solid[1:-1, rows, -1] = neighbour.blocks[:, a:b, 0] != AIR
+        sector.version += 1
+        masks = sector.masks[:, lo:hi]
+        masks[...] = 0
+        for i, (dx, dy, dz) in enumerate(FACES):
+            masks |= solid[1 + dx:S + 1 + dx, 1 + dy:hi - lo + 1 + dy, 1 + dz:S + 1 + dz] << i
+
+    def load(self, key):
+        """Decodifica o setor do armazenamento na primeira vez que e pedido."""
+        sector = self.sectors.get(key)
+        if sector is not None or self.storage is None:
+            return sector
+        blocks = self.storage.load(key)
+        if blocks is None:
+            return None
+        return self.insert(key, blocks)
+
+    def insert(self, key, blocks):
+        """Coloca um setor inteiro (carregado ou gerado) no mundo, sem marca-lo como sujo."""
+        sector = self.sectors[key] = Sector(key)
+        sector.blocks[...] = blocks
+        sector.count = int(numpy.count_nonzero(blocks))
+        self.count += sector.count
+        self.edits += 1
+        self.remask(sector)
+        self._stitch_neighbours(key, sector.blocks)
+        return sector
+
+    def evict(self, key):
+        """Tira um setor da memoria; para os vizinhos ele passa a ser ar."""
+        sector = self.sectors.pop(key)
+        self.count -= sector.count
+        self.edits += 1
+        self.dirty.discard(key)
+        self._stitch_neighbours(key, numpy.zeros_like(sector.blocks))
+        return sector
+
+    def _stitch_neighbours(self, key, blocks):
+        # So a borda dos vizinhos ja carregados muda.
+        x, _, z = key
+        neighbour = self.sectors.get((x - 1, 0, z))
+        if neighbour is not None: _stitch(neighbour, neighbour.masks[-1], blocks[0], 3)
+        neighbour = self.sectors.get((x + 1, 0, z))
+        if neighbour is not None: _stitch(neighbour, neighbour.masks[0], blocks[-1], 2)
+        neighbour = self.sectors.get((x, 0, z - 1))
+        if neighbour is not None: _stitch(neighbour, neighbour.masks[:, :, -1], blocks[:, :, 0], 4)
+        neighbour = self.sectors.get((x, 0, z + 1))
+        if neighbour is not None: _stitch(neighbour, neighbour.masks[:, :, 0], blocks[:, :, -1], 5)
+
+    def paste(self, origin, volume):
+        """Escreve os blocos nao-ar de `volume` ([x, y, z] a partir de origin) em massa.
+
+        Equivale a um add_block(immediate=False) por celula, mas cada setor
+        tocado e atualizado com operacoes de array e suas mascaras (e a borda
+        dos vizinhos) sao recalculadas uma unica vez. Retorna os setores tocados.
+        """
+        return self.paste_many([(origin, volume)])
+
+    def paste_many(self, volumes):
+        """paste() de varios (origin, volume) em ordem, recalculando as mascaras so no fim."""
+        touched = {}
+        for origin, volume in volumes:
+            self._write(origin, volume, touched)
+        self.dirty.update(touched)
+        self.edits += 1
+        # So as camadas escritas, mais uma acima e uma abaixo, mudam (nos setores
+        # tocados e na borda dos vizinhos).
+        remask = {}
+        for (kx, _, kz), (lo, hi) in touched.items():
+            lo, hi = max(lo - 1, 0), min(hi + 1, WORLD_HEIGHT)
+            for key in [(kx, 0, kz), (kx - 1, 0, kz), (kx + 1, 0, kz), (kx, 0, kz - 1), (kx, 0, kz + 1)]:
+                old = remask.get(key, (lo, hi))
+                remask[key] = (min(old[0], lo), max(old[1], hi))
+        for key, (lo, hi) in remask.items():
+            if key in self.sectors:
+                self.remask(self.sectors[key], lo, hi)
+        return set(touched)
+
+    def _write(self, origin, volume, touched):
+        ox, oy, oz = origin
+        sx, sy, sz = volume.shape
+        y0, y1 = max(oy, WORLD_BOTTOM), min(oy + sy, WORLD_BOTTOM + WORLD_HEIGHT)
+        if y0 >= y1:
+            return
+        for kx in range(ox // SECTOR_SIZE, (ox + sx - 1) // SECTOR_SIZE + 1):
+            for kz in range(oz // SECTOR_SIZE, (oz + sz - 1) // SECTOR_SIZE + 1):
+                x0, x1 = max(ox, kx * SECTOR_SIZE), min(ox + sx, (kx + 1) * SECTOR_SIZE)
+                z0, z1 = max(oz, kz * SECTOR_SIZE), min(oz + sz, (kz + 1) * SECTOR_SIZE)
+                src = volume[x0 - ox:x1 - ox, y0 - oy:y1 - oy, z0 - oz:z1 - oz]
+                solid = src != AIR
+                if not solid.any():
+                    continue
+                sector = self._sector((kx, 0, kz))
+                dst = sector.blocks[x0 - kx * SECTOR_SIZE:x1 - kx * SECTOR_SIZE, y0 - WORLD_BOTTOM:y1 - WORLD_BOTTOM,
+                                    z0 - kz * SECTOR_SIZE:z1 - kz * SECTOR_SIZE]
+                added = int(numpy.count_nonzero(solid & (dst == AIR)))
+                sector.count += added
+                self.count += added
+                dst[solid] = src[solid]
+                lo, hi = touched.get(sector.key, (WORLD_HEIGHT, 0))
+                touched[sector.key] = (min(lo, y0 - WORLD_BOTTOM), max(hi, y1 - WORLD_BOTTOM))
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for sector in list(self.sectors.values()):
+            for position in sector.positions():
+                yield position
+
+    def items(self):
+        for position in self:
+            yield position, self[position]